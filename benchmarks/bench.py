@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2024 Rafał Kuźnia <rafal.kuznia@protonmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+# Pipeline benchmarks. A synthetic game tree is generated in a temporary
+# directory and the pipeline is run against it with the stand-in executables
+# from tools/ substituted for Blender and Godot. Results are printed as JSON,
+# so that runs on different commits can be compared:
+#
+#   python benchmarks/bench.py --tracks 500 --cars 2000 -o before.json
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR / "src"))
+
+from spt_pipeline.concurrency import ConcurrencyPolicy  # noqa: E402
+from spt_pipeline.dsl import Foreach, GetFiles, GodotPostprocess, Root  # noqa: E402
+from spt_pipeline.index import DirectoryIndex  # noqa: E402
+from spt_pipeline.processor import PipelineProcessor  # noqa: E402
+from spt_pipeline.utils import RESOURCE_DIR, get_path_case_insensitive  # noqa: E402
+
+FAKE_BLENDER = REPO_DIR / "tools" / "fake_blender.py"
+FAKE_GODOT = REPO_DIR / "tools" / "fake_godot.py"
+# Only imported on the code paths that use them. The startup benchmark fails
+# if importing spt_pipeline.main pulls any of them in.
+LAZY_MODULES = ("yaml", "dataclass_wizard", "multiprocessing", "tkinter")
+
+
+def mixed_case(name: str, rng: random.Random) -> str:
+    return "".join(c.upper() if rng.random() < 0.5 else c.lower() for c in name)
+
+
+def generate_tree(root: Path, tracks: int, cars: int, seed: int = 0) -> list[Path]:
+    rng = random.Random(seed)
+    data = root / "Data"
+    track_dir = data / "TRACKS"
+    car_dir = data / "CARS"
+    files = []
+    for i in range(tracks):
+        directory = track_dir / mixed_case(f"trk{i:04}", rng)
+        directory.mkdir(parents=True)
+        for name in ("TR.FRD", "TR.COL", "TR0.QFS"):
+            files.append(directory / mixed_case(name, rng))
+    for i in range(cars):
+        directory = car_dir / mixed_case(f"car{i:04}", rng)
+        # Some mods keep cars one level deeper
+        if i % 7 == 0:
+            directory = directory / mixed_case("pack", rng)
+        directory.mkdir(parents=True)
+        for name in ("CAR.VIV", "CARP.TXT"):
+            files.append(directory / mixed_case(name, rng))
+    for i, path in enumerate(files):
+        path.write_bytes(fake_asset(path.suffix.lower(), i))
+    return files
+
+
+def fake_asset(suffix: str, i: int) -> bytes:
+    # Unique and valid enough for the GetFiles dedupe checks
+    content = i.to_bytes(8, "little") + b"\0" * 56
+    if suffix == ".viv":
+        return struct.pack(">4sIII", b"BIGF", 16 + len(content), 0, 16) + content
+    if suffix == ".frd":
+        return b"\0" * 28 + struct.pack("<I", 0) + content
+    return content
+
+
+def measure(fn: Callable[[], object], repeat: int) -> dict[str, float]:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return {
+        "min": min(samples),
+        "mean": statistics.mean(samples),
+        "max": max(samples),
+        "repeat": repeat,
+    }
+
+
+def make_processor(game: Path, destination: Path, workers: int) -> PipelineProcessor:
+    paths = {
+        "blender": FAKE_BLENDER,
+        "godot": FAKE_GODOT,
+        "ffmpeg": Path("ffmpeg"),
+    }
+    return PipelineProcessor(
+        source=game,
+        destination=destination,
+        paths=paths,
+        policy=ConcurrencyPolicy(workers=workers),
+    )
+
+
+def bench_end_to_end(game: Path, workdir: Path, args) -> dict[str, float]:
+    import yaml
+
+    with open(RESOURCE_DIR / "pipeline.yaml", "r", encoding="utf-8") as f:
+        config = Root.from_dict(yaml.safe_load(f))
+    runs = iter(range(args.repeat))
+
+    def run():
+        destination = workdir / f"out{next(runs)}"
+        destination.mkdir()
+        make_processor(game, destination, args.workers).run_actions(config.pipelines)
+
+    return measure(run, args.repeat)
+
+
+def bench_get_files(game: Path, workdir: Path, args) -> dict[str, float]:
+    processor = make_processor(game, workdir, args.workers)
+    actions = [
+        GetFiles(match="*/TR.FRD", directory="{_source}/Data/TRACKS"),
+        GetFiles(match="*/CAR.VIV", directory="{_source}/Data/CARS", recursive=True),
+    ]
+    return measure(lambda: [processor.run_action(action) for action in actions], args.repeat)
+
+
+def bench_case_insensitive(game: Path, files: list[Path], args) -> dict[str, float]:
+    rng = random.Random(1)
+    sample = rng.sample(files, min(len(files), args.lookups))
+    targets = [game / Path(*(part.upper() for part in p.relative_to(game).parts)) for p in sample]
+    return measure(
+        lambda: [get_path_case_insensitive(game, target) for target in targets], args.repeat
+    )
+
+
+def bench_index_lookup(game: Path, files: list[Path], args) -> dict[str, float]:
+    rng = random.Random(1)
+    sample = rng.sample(files, min(len(files), args.lookups))
+    targets = [game / Path(*(part.upper() for part in p.relative_to(game).parts)) for p in sample]
+    index = DirectoryIndex(game)
+    return measure(lambda: [index.resolve(target) for target in targets], args.repeat)
+
+
+def bench_scheduler(game: Path, workdir: Path, args) -> dict[str, float]:
+    # No file was written, so GodotPostprocess does no work and this measures the
+    # dispatch overhead of the Foreach items and of its postprocess stage
+    processor = make_processor(game, workdir, args.workers)
+    processor.path = [workdir / f"item{i}" for i in range(args.jobs)]
+    pipeline = [Foreach(actions=[GodotPostprocess(script=""), GodotPostprocess(script="")])]
+    return measure(lambda: processor.run_actions(pipeline), args.repeat)
+
+
+def bench_startup(workdir: Path, args) -> dict[str, object]:
+    # Every sample runs in a fresh interpreter, as spt-run does
+    env = os.environ | {"PYTHONPATH": str(REPO_DIR / "src")}
+    plans = workdir / "plans"
+    load_plan = (
+        "from pathlib import Path\n"
+        "from spt_pipeline.cache import PlanCache\n"
+        f"PlanCache(Path({str(plans)!r})).load(Path({str(RESOURCE_DIR / 'pipeline.yaml')!r})"
+        ".read_text(encoding='utf-8'))"
+    )
+    probe = (
+        "import json, sys\n"
+        "import spt_pipeline.main\n"
+        f"print(json.dumps([m for m in {LAZY_MODULES!r} if m in sys.modules]))"
+    )
+
+    def python(code: str) -> str:
+        result = subprocess.run(
+            [sys.executable, "-c", code], env=env, capture_output=True, check=True, text=True
+        )
+        return result.stdout
+
+    def load_uncached():
+        shutil.rmtree(plans, ignore_errors=True)
+        python(load_plan)
+
+    results: dict[str, object] = {
+        "interpreter": measure(lambda: python("pass"), args.repeat),
+        "import_main": measure(lambda: python("import spt_pipeline.main"), args.repeat),
+        "plan_miss": measure(load_uncached, args.repeat),
+    }
+    results["plan_hit"] = measure(lambda: python(load_plan), args.repeat)
+    results["eager_imports"] = json.loads(python(probe))
+    return results
+
+
+def git_revision() -> str | None:
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, check=True
+        )
+        return result.stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+BENCHMARKS = (
+    "end_to_end",
+    "get_files",
+    "case_insensitive",
+    "index_lookup",
+    "scheduler",
+    "startup",
+)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tracks", type=int, default=200)
+    parser.add_argument("--cars", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--lookups", type=int, default=500)
+    parser.add_argument("--jobs", type=int, default=5000, help="Jobs for the scheduler benchmark")
+    parser.add_argument("--blender-delay", type=float, default=0.0)
+    parser.add_argument("--blender-lines", type=int, default=0)
+    parser.add_argument("--godot-delay", type=float, default=0.0)
+    parser.add_argument("--only", action="append", choices=BENCHMARKS)
+    parser.add_argument("-o", "--output", type=Path)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    os.environ["FAKE_BLENDER_DELAY"] = str(args.blender_delay)
+    os.environ["FAKE_BLENDER_LINES"] = str(args.blender_lines)
+    os.environ["FAKE_GODOT_DELAY"] = str(args.godot_delay)
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="spt-bench-") as temp:
+        workdir = Path(temp)
+        game = workdir / "game"
+        files = generate_tree(game, args.tracks, args.cars)
+        selected = args.only or BENCHMARKS
+        for name in selected:
+            print(f"Running {name}...", file=sys.stderr)
+            if name == "end_to_end":
+                results[name] = bench_end_to_end(game, workdir, args)
+            elif name == "get_files":
+                results[name] = bench_get_files(game, workdir, args)
+            elif name == "case_insensitive":
+                results[name] = bench_case_insensitive(game, files, args)
+            elif name == "index_lookup":
+                results[name] = bench_index_lookup(game, files, args)
+            elif name == "scheduler":
+                results[name] = bench_scheduler(game, workdir, args)
+            elif name == "startup":
+                results[name] = bench_startup(workdir, args)
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {k: v for k, v in vars(args).items() if k not in ("output", "only")},
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(output + "\n", encoding="utf-8")
+    print(output)
+    eager = results.get("startup", {}).get("eager_imports")
+    if eager:
+        print(f"spt_pipeline.main imports {', '.join(eager)} on startup", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+#
+# Copyright (c) 2024 Rafał Kuźnia <rafal.kuznia@protonmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+import tomllib
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+EXTENSION_ID = "speedtools"
+EXTENSION_REPOSITORY = "user_default"
+
+
+class AddonError(Exception):
+    pass
+
+
+def blender_config_roots() -> list[Path]:
+    if "BLENDER_USER_RESOURCES" in os.environ:
+        return [Path(os.environ["BLENDER_USER_RESOURCES"])]
+    if os.name == "nt":
+        base = Path(os.environ.get("APPDATA", Path.home() / "AppData" / "Roaming"))
+        return [base / "Blender Foundation" / "Blender"]
+    if sys.platform == "darwin":
+        return [Path.home() / "Library" / "Application Support" / "Blender"]
+    base = Path(os.environ.get("XDG_CONFIG_HOME", Path.home() / ".config"))
+    return [base / "blender"]
+
+
+def extension_manifests() -> list[Path]:
+    manifests = []
+    for root in blender_config_roots():
+        if "BLENDER_USER_RESOURCES" in os.environ:
+            candidates = [root]
+        else:
+            candidates = [d for d in root.glob("*") if d.is_dir()]
+        for directory in candidates:
+            manifest = (
+                directory
+                / "extensions"
+                / EXTENSION_REPOSITORY
+                / EXTENSION_ID
+                / "blender_manifest.toml"
+            )
+            if manifest.is_file():
+                manifests.append(manifest)
+    return manifests
+
+
+def manifest_version(manifest: Path) -> str | None:
+    try:
+        with open(manifest, "rb") as f:
+            return str(tomllib.load(f).get("version"))
+    except (OSError, tomllib.TOMLDecodeError):
+        return None
+
+
+def installed_manifest(version: str) -> Path | None:
+    for manifest in extension_manifests():
+        if manifest_version(manifest) == version:
+            return manifest
+    return None
+
+
+def _blender_identity(blender: Path) -> dict[str, str | int]:
+    resolved = str(shutil.which(blender) or blender)
+    try:
+        mtime = os.stat(resolved).st_mtime_ns
+    except OSError:
+        mtime = 0
+    return {"blender": resolved, "blender_mtime_ns": mtime}
+
+
+def _zip_digest(addon_path: Path) -> str:
+    with open(addon_path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+class AddonStamp:
+    def __init__(self, path: Path, blender: Path, addon_path: Path, version: str):
+        self.path = path
+        self.version = version
+        try:
+            digest = _zip_digest(addon_path)
+        except OSError as e:
+            raise AddonError(f"Cannot read the speedtools addon {addon_path}: {e}") from e
+        self.expected = {
+            **_blender_identity(blender),
+            "addon": digest,
+            "version": version,
+        }
+
+    def is_current(self) -> bool:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                recorded = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if any(recorded.get(k) != v for k, v in self.expected.items()):
+            return False
+        # Without a known manifest (portable, snap or flatpak Blender), the
+        # successful install of the same bundle into the same Blender is
+        # taken as proof
+        if not recorded.get("manifest"):
+            return True
+        manifest = Path(recorded["manifest"])
+        return manifest.is_file() and manifest_version(manifest) == self.version
+
+    def record(self, manifest: Path | None):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(
+                {**self.expected, "manifest": str(manifest) if manifest else None}, f, indent=1
+            )
+
+    def clear(self):
+        self.path.unlink(missing_ok=True)
+
+
+def wait_for_install(version: str, timeout: float, interval: float = 0.1) -> Path | None:
+    deadline = time.monotonic() + timeout
+    while True:
+        manifest = installed_manifest(version)
+        if manifest or time.monotonic() > deadline:
+            return manifest
+        time.sleep(interval)
@@ -0,0 +1,262 @@
+#
+# Copyright (c) 2024 Rafał Kuźnia <rafal.kuznia@protonmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+# Conversion outputs shared between machines. An artifact is the list of files
+# one Track2GLTF or Car2GLTF conversion wrote, stored under a hash of the input
+# contents, the action parameters, the converter script and the tool versions.
+# A machine that converts the same game data with the same speedtools version
+# fetches the files instead of running Blender.
+#
+# A store is a directory, local or on a shared file system, or an HTTP server
+# with the same layout (see tools/artifact_server.py):
+#
+#   KEY[:2]/KEY/meta.json   {"files": ["0.glb", ...], "size": N}
+#   KEY[:2]/KEY/0.glb       the outputs in the order convert() lists them
+#
+# An artifact is complete once meta.json is there. Directories are published by
+# renaming them into place, and the least recently fetched are evicted once the
+# store grows past its size limit.
+
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+from typing import Any
+
+from spt_pipeline.assets import link
+from spt_pipeline.cache import fingerprint_directory
+
+logger = logging.getLogger(__name__)
+
+ARTIFACT_VERSION = 1
+META = "meta.json"
+DEFAULT_STORE_SIZE = 20 * 1024**3
+HTTP_TIMEOUT = 60
+KEY_PATTERN = re.compile(r"[0-9a-f]{64}")
+FILE_PATTERN = re.compile(r"[0-9]+(\.[0-9A-Za-z]+)?")
+
+
+def artifact_files(outputs: list[Path]) -> list[str]:
+    # Names inside the artifact, independent of where the outputs go
+    return [f"{index}{output.suffix}" for index, output in enumerate(outputs)]
+
+
+class ArtifactStore:
+    def __init__(self, manifest: dict[str, str]):
+        self.manifest = manifest
+        self.fetched = 0
+        self.published = 0
+        self.lock = threading.Lock()
+        self._script_digests: dict[Path, str] = {}
+
+    def key(self, script: Path, input: Path, params: dict[str, Any]) -> str:
+        # Unlike the build cache key, only contents go in, never paths or
+        # modification times, so that it is the same on every machine
+        if script not in self._script_digests:
+            with open(script, "rb") as f:
+                self._script_digests[script] = hashlib.file_digest(f, "sha256").hexdigest()
+        data = {
+            "version": ARTIFACT_VERSION,
+            "manifest": self.manifest,
+            "script": self._script_digests[script],
+            "params": params,
+            "input": fingerprint_directory(input, hash_contents=True),
+        }
+        encoded = json.dumps(data, sort_keys=True, default=str).encode("utf-8")
+        return hashlib.sha256(encoded).hexdigest()
+
+    def fetch(self, key: str, outputs: list[Path]) -> bool:
+        # Returns whether all outputs were written from the store. A store that
+        # cannot be reached is a miss, the conversion runs as usual.
+        try:
+            found = self._fetch(key, outputs)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Could not fetch artifact {key[:12]}: {e}")
+            return False
+        if found:
+            with self.lock:
+                self.fetched += 1
+        return found
+
+    def publish(self, key: str, outputs: list[Path]):
+        try:
+            published = self._publish(key, outputs)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not publish artifact {key[:12]}: {e}")
+            return
+        if published:
+            with self.lock:
+                self.published += 1
+
+    def _fetch(self, key: str, outputs: list[Path]) -> bool:
+        raise NotImplementedError
+
+    def _publish(self, key: str, outputs: list[Path]) -> bool:
+        raise NotImplementedError
+
+    def report(self):
+        logger.info(f"Artifact store: {self.fetched} fetched, {self.published} published")
+
+
+class LocalStore(ArtifactStore):
+    def __init__(
+        self, directory: Path, manifest: dict[str, str] = {}, max_size: int = DEFAULT_STORE_SIZE
+    ):
+        super().__init__(manifest)
+        self.directory = directory
+        self.max_size = max_size
+
+    def path(self, key: str) -> Path:
+        if not KEY_PATTERN.fullmatch(key):
+            raise ValueError(f"Invalid artifact key {key!r}")
+        return self.directory / key[:2] / key
+
+    def file(self, key: str, name: str) -> Path:
+        if name != META and not FILE_PATTERN.fullmatch(name):
+            raise ValueError(f"Invalid artifact file {name!r}")
+        return self.path(key) / name
+
+    def open(self, key: str) -> dict[str, Any] | None:
+        # The meta data of a complete artifact, marked as recently used
+        meta = self.path(key) / META
+        try:
+            data = json.loads(meta.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return None
+        os.utime(meta)
+        return data
+
+    def _fetch(self, key: str, outputs: list[Path]) -> bool:
+        meta = self.open(key)
+        if not meta or len(meta["files"]) != len(outputs):
+            return False
+        directory = self.path(key)
+        for name, output in zip(meta["files"], outputs):
+            # Hard links where the store is on the same file system. Tools
+            # that rewrite an output replace it or break the link first.
+            link(directory / name, output)
+        return True
+
+    def stage(self) -> Path:
+        staging = self.directory / "staging"
+        staging.mkdir(parents=True, exist_ok=True)
+        return Path(tempfile.mkdtemp(dir=staging))
+
+    def _publish(self, key: str, outputs: list[Path]) -> bool:
+        if (self.path(key) / META).exists():
+            return False
+        staging = self.stage()
+        for name, output in zip(artifact_files(outputs), outputs):
+            link(output, staging / name)
+        return self.commit(key, staging, artifact_files(outputs))
+
+    def commit(self, key: str, staging: Path, files: list[str]) -> bool:
+        # Renaming the whole directory publishes the artifact atomically. When
+        # another machine got there first, its copy is kept.
+        size = sum((staging / name).stat().st_size for name in files)
+        meta = {"files": files, "size": size}
+        (staging / META).write_text(json.dumps(meta), encoding="utf-8")
+        destination = self.path(key)
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.rename(staging, destination)
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
+            return False
+        self.evict()
+        return True
+
+    def artifacts(self) -> list[tuple[float, int, Path]]:
+        # (last use, size, directory) of every complete artifact
+        found = []
+        for prefix in os.scandir(self.directory):
+            if len(prefix.name) != 2 or not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                meta = Path(entry.path) / META
+                try:
+                    used = meta.stat().st_mtime
+                    size = json.loads(meta.read_text(encoding="utf-8"))["size"]
+                except (OSError, ValueError, KeyError):
+                    continue
+                found.append((used, size, Path(entry.path)))
+        return found
+
+    def evict(self):
+        with self.lock:
+            artifacts = sorted(self.artifacts())
+            total = sum(size for _, size, _ in artifacts)
+            for _, size, directory in artifacts:
+                if total <= self.max_size:
+                    break
+                # Moved out of the way first, so that nobody fetches half of it
+                doomed = self.stage()
+                try:
+                    os.rename(directory, doomed / directory.name)
+                except OSError:
+                    continue
+                shutil.rmtree(doomed, ignore_errors=True)
+                total -= size
+                logger.debug(f"Evicted artifact {directory.name[:12]}, {size} bytes")
+
+
+# Client of tools/artifact_server.py or of any server that serves and accepts
+# the store layout with GET and PUT. Eviction is up to the server.
+class HttpStore(ArtifactStore):
+    def __init__(self, url: str, manifest: dict[str, str] = {}, timeout: float = HTTP_TIMEOUT):
+        super().__init__(manifest)
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def _url(self, key: str, name: str) -> str:
+        return f"{self.url}/{key[:2]}/{key}/{name}"
+
+    def _fetch(self, key: str, outputs: list[Path]) -> bool:
+        from urllib.error import HTTPError
+        from urllib.request import urlopen
+
+        try:
+            with urlopen(self._url(key, META), timeout=self.timeout) as response:
+                meta = json.load(response)
+        except HTTPError as e:
+            if e.code == 404:
+                return False
+            raise
+        if len(meta["files"]) != len(outputs):
+            return False
+        for name, output in zip(meta["files"], outputs):
+            output.parent.mkdir(parents=True, exist_ok=True)
+            temporary = output.with_name(f".{output.name}.tmp")
+            with urlopen(self._url(key, name), timeout=self.timeout) as response:
+                with open(temporary, "wb") as f:
+                    shutil.copyfileobj(response, f)
+            os.replace(temporary, output)
+        return True
+
+    def _publish(self, key: str, outputs: list[Path]) -> bool:
+        from urllib.request import Request, urlopen
+
+        # The server commits the artifact when meta.json arrives, after the files
+        files = artifact_files(outputs)
+        meta = {"files": files, "size": sum(output.stat().st_size for output in outputs)}
+        uploads = [(name, output.read_bytes) for name, output in zip(files, outputs)]
+        uploads.append((META, lambda: json.dumps(meta).encode("utf-8")))
+        for name, read in uploads:
+            request = Request(self._url(key, name), data=read(), method="PUT")
+            with urlopen(request, timeout=self.timeout):
+                pass
+        return True
+
+
+def open_store(location: str, manifest: dict[str, str], max_size: int) -> ArtifactStore:
+    if location.startswith(("http://", "https://")):
+        return HttpStore(location, manifest)
+    return LocalStore(Path(location), manifest, max_size)
@@ -0,0 +1,154 @@
+#
+# Copyright (c) 2024 Rafał Kuźnia <rafal.kuznia@protonmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+# Input checks and fingerprints for GetFiles matches. Files are mapped into
+# memory: the checks only touch the VIV directory or the FRD header, and the
+# hash reads the mapping page by page instead of loading whole archives.
+
+import filecmp
+import hashlib
+import mmap
+import os
+import shutil
+import struct
+import threading
+from pathlib import Path
+
+VIV_MAGICS = (b"BIGF", b"BIGH", b"BIG4")
+VIV_HEADER = 16
+# No archive in the original games or in mods comes close to these
+MAX_VIV_ENTRIES = 65536
+FRD_HEADER = 32
+MAX_FRD_BLOCKS = 4096
+
+
+class AssetError(Exception):
+    pass
+
+
+def parse_viv(data: memoryview) -> dict[str, tuple[int, int]]:
+    # Name: (offset, size) of every archived file
+    if len(data) < VIV_HEADER:
+        raise AssetError("File too short for a VIV archive")
+    # Mod tools are sloppy with the archive and directory size fields, only the
+    # entries themselves are checked against the file
+    magic, _, count, _ = struct.unpack_from(">4sIII", data)
+    if magic not in VIV_MAGICS:
+        raise AssetError("Not a VIV archive")
+    if count > MAX_VIV_ENTRIES:
+        raise AssetError(f"Implausible VIV entry count {count}")
+    entries = {}
+    offset = VIV_HEADER
+    for _ in range(count):
+        if offset + 8 > len(data):
+            raise AssetError("Truncated VIV directory")
+        start, size = struct.unpack_from(">II", data, offset)
+        end = bytes(data[offset + 8 : offset + 8 + 256]).find(b"\0")
+        if end < 0:
+            raise AssetError("Truncated VIV directory")
+        name = bytes(data[offset + 8 : offset + 8 + end]).decode("latin-1")
+        offset += 8 + end + 1
+        if start + size > len(data):
+            raise AssetError(
+                f"Truncated VIV archive, {name} ends at {start + size}, file has {len(data)}"
+            )
+        entries[name] = (start, size)
+    return entries
+
+
+def check_frd(data: memoryview):
+    # An FRD has no directory, only the header and the block count are checked
+    if len(data) < FRD_HEADER:
+        raise AssetError("File too short for an FRD")
+    (blocks,) = struct.unpack_from("<I", data, FRD_HEADER - 4)
+    if blocks >= MAX_FRD_BLOCKS:
+        raise AssetError(f"Implausible FRD block count {blocks + 1}")
+
+
+CHECKS = {".viv": parse_viv, ".frd": check_frd}
+
+
+def check(path: Path):
+    parse = CHECKS.get(path.suffix.lower())
+    if not parse:
+        return
+    if not path.stat().st_size:
+        raise AssetError("Empty file")
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        with memoryview(mapped) as data:
+            parse(data)
+
+
+def fingerprint(path: Path) -> str:
+    # The converters read the whole directory of the matched file (textures,
+    # collision data, carp.txt), so every file in it is part of the
+    # fingerprint. The name and size of each file go in before the content.
+    check(path)
+    digest = hashlib.sha256()
+    files = sorted(
+        (entry.name.lower(), entry.path) for entry in os.scandir(path.parent) if entry.is_file()
+    )
+    for name, file in files:
+        with open(file, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            digest.update(f"{name}\0{size}\0".encode("utf-8"))
+            if size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    digest.update(mapped)
+    return digest.hexdigest()
+
+
+# Directories that GetFiles found to hold the same asset as another. Only the
+# first one is converted, the others get links to its outputs.
+class DuplicateSet:
+    def __init__(self):
+        self.duplicates: dict[Path, list[Path]] = {}
+        self.lock = threading.Lock()
+
+    def add(self, original: Path, duplicate: Path):
+        with self.lock:
+            self.duplicates.setdefault(original, []).append(duplicate)
+
+    def of(self, original) -> list[Path]:
+        with self.lock:
+            return list(self.duplicates.get(original, []))
+
+    def detach(self, path: Path) -> list[Path]:
+        # Ends the group path is in, once one of its members changed they are
+        # converted separately. Returns all members of the group.
+        with self.lock:
+            for original, duplicates in self.duplicates.items():
+                if path == original or path in duplicates:
+                    del self.duplicates[original]
+                    return [original] + duplicates
+        return [path]
+
+
+def link(source: Path, destination: Path) -> bool:
+    # Returns whether the destination was written. Tools that rewrite a GLB
+    # (OptimizeGLB) replace it by renaming, which leaves other links alone.
+    if destination.exists():
+        # A link or copy from an earlier run, possibly optimised on its own
+        if os.path.samefile(source, destination) or filecmp.cmp(
+            source, destination, shallow=False
+        ):
+            return False
+        destination.unlink()
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(source, destination)
+    except OSError:
+        # Across file systems, or on ones without hard links
+        shutil.copy2(source, destination)
+    return True
+
+
+def unshare(path: Path):
+    # Gives a hard-linked file a copy of its own
+    if path.stat().st_nlink > 1:
+        temporary = path.with_name(f".{path.name}.tmp")
+        shutil.copy2(path, temporary)
+        os.replace(temporary, path)
@@ -0,0 +1,192 @@
+#
+# Copyright (c) 2024 Rafał Kuźnia <rafal.kuznia@protonmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+import json
+import logging
+import subprocess
+import threading
+import time
+from functools import partial
+from pathlib import Path
+
+from spt_pipeline.cancel import get_cancel_scope
+from spt_pipeline.concurrency import ProcessMonitor
+from spt_pipeline.metrics import get_metrics
+from spt_pipeline.retry import JobFailed, JobTimeout
+from spt_pipeline.tracing import get_tracer
+from spt_pipeline.utils import (
+    PROCESS_GROUP,
+    RESOURCE_DIR,
+    blender_env,
+    kill_process_tree,
+    log_line,
+    process_env,
+)
+
+logger = logging.getLogger(__name__)
+
+REPLY_PREFIX = "@spt-worker "
+WORKER_SCRIPT = RESOURCE_DIR / "worker.py"
+
+
+class WorkerCrashed(Exception):
+    pass
+
+
+class BlenderWorker:
+    def __init__(self, paths: dict[str, Path]):
+        self.jobs = 0
+        self.process = subprocess.Popen(
+            [paths["blender"], "--background", "--python", WORKER_SCRIPT],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            env=process_env(blender_env(paths)),
+            text=True,
+            encoding="utf-8",
+            errors="replace",
+            **PROCESS_GROUP,
+        )
+        logger.debug(f"Started Blender worker pid={self.process.pid}")
+        reply = self._read_reply()
+        if reply.get("status") != "ready":
+            self.close()
+            raise WorkerCrashed(f"Unexpected worker handshake: {reply}")
+
+    def _read_reply(self, on_progress=None) -> dict:
+        assert self.process.stdout
+        for line in self.process.stdout:
+            if line.startswith(REPLY_PREFIX):
+                return dict(json.loads(line[len(REPLY_PREFIX) :]))
+            log_line(line.rstrip(), on_progress)
+        raise WorkerCrashed(f"Blender worker pid={self.process.pid} exited unexpectedly")
+
+    def run(self, script: str, args: dict, on_progress=None, timeout=None) -> dict:
+        assert self.process.stdin
+        request = {"script": script, "args": {k: _jsonable(v) for k, v in args.items()}}
+        self.jobs += 1
+        try:
+            self.process.stdin.write(json.dumps(request) + "\n")
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            raise WorkerCrashed(f"Blender worker pid={self.process.pid} is gone") from e
+        if timeout is None:
+            return self._read_reply(on_progress)
+        # The reply is read with a blocking readline, so a hung worker is
+        # killed from a timer, which ends the read with WorkerCrashed
+        timer = threading.Timer(timeout, kill_process_tree, args=(self.process,))
+        timer.start()
+        try:
+            return self._read_reply(on_progress)
+        except WorkerCrashed:
+            if not timer.is_alive():
+                raise JobTimeout(timeout) from None
+            raise
+        finally:
+            timer.cancel()
+
+    def close(self):
+        if self.process.poll() is None:
+            assert self.process.stdin
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=10)
+            except (OSError, subprocess.TimeoutExpired):
+                kill_process_tree(self.process)
+                self.process.wait()
+        logger.debug(f"Stopped Blender worker pid={self.process.pid}")
+
+
+class BlenderPool:
+    def __init__(self, paths: dict[str, Path], size: int, max_jobs: int = 25):
+        self.paths = paths
+        self.size = size
+        self.max_jobs = max_jobs
+        self.idle: list[BlenderWorker] = []
+        self.started = 0
+        self.condition = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _acquire(self) -> BlenderWorker:
+        with self.condition:
+            while not self.idle and self.started >= self.size:
+                self.condition.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.started += 1
+        return BlenderWorker(self.paths)
+
+    def _release(self, worker: BlenderWorker | None):
+        if worker is not None and worker.jobs < self.max_jobs:
+            with self.condition:
+                self.idle.append(worker)
+                self.condition.notify()
+            return
+        if worker is not None:
+            logger.debug(f"Recycling Blender worker pid={worker.process.pid}")
+            worker.close()
+        with self.condition:
+            self.started -= 1
+            self.condition.notify()
+
+    def run(
+        self,
+        script: str,
+        on_progress=None,
+        timeout=None,
+        monitor: ProcessMonitor | None = None,
+        **args,
+    ) -> float:
+        # Returns the seconds the worker spent on the job. The monitor gets the
+        # peak memory of the worker during the job.
+        monitor = monitor if monitor else ProcessMonitor()
+        worker: BlenderWorker | None = None
+        scope = get_cancel_scope()
+        scope.check()
+        try:
+            worker = self._acquire()
+            with (
+                get_tracer().span(script, "process", pid=worker.process.pid) as span,
+                scope.guard(partial(kill_process_tree, worker.process)),
+                get_metrics().inflight("spt_processes_running", program="blender"),
+                monitor.measure(worker.process.pid),
+            ):
+                start = time.monotonic()
+                reply = worker.run(script, args, on_progress, timeout)
+                seconds = time.monotonic() - start
+                span["status"] = reply.get("status")
+        except (WorkerCrashed, JobTimeout) as e:
+            logger.error(f"Blender args: {script} {args}")
+            logger.error(str(e))
+            if worker is not None:
+                worker.close()
+                worker = None
+            if isinstance(e, JobTimeout):
+                raise
+            raise JobFailed(str(e)) from e
+        finally:
+            self._release(worker)
+        if reply.get("status") != "ok":
+            logger.error(f"Blender args: {script} {args}")
+            logger.error(reply.get("error", "Blender failed"))
+            raise JobFailed("Blender reported an error")
+        return seconds
+
+    def close(self):
+        with self.condition:
+            idle, self.idle = self.idle, []
+            self.started -= len(idle)
+        for worker in idle:
+            worker.close()
+
+
+def _jsonable(value):
+    return str(value) if isinstance(value, Path) else value
@@ -0,0 +1,199 @@
+#
+# Copyright (c) 2024 Rafał Kuźnia <rafal.kuznia@protonmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+import threading
+from pathlib import Path
+from typing import Any
+
+from spt_pipeline import dsl
+from spt_pipeline.dsl import Root
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+PLAN_CACHE_SIZE = 8
+
+
+def _file_digest(path: Path) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def fingerprint_directory(directory: Path, hash_contents: bool = False) -> list[tuple]:
+    entries = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            path = Path(root) / name
+            relative = path.relative_to(directory).as_posix().lower()
+            stat = path.stat()
+            if hash_contents:
+                entries.append((relative, _file_digest(path)))
+            else:
+                entries.append((relative, stat.st_size, stat.st_mtime_ns))
+    return entries
+
+
+class BuildCache:
+    def __init__(self, path: Path, manifest: dict[str, str], hash_contents: bool = False):
+        self.path = path
+        self.manifest = manifest
+        self.hash_contents = hash_contents
+        self.entries: dict[str, dict[str, Any]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self._script_digests: dict[Path, str] = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable build cache {self.path}: {e}")
+            return
+        if data.get("version") == CACHE_VERSION:
+            self.entries = dict(data.get("entries", {}))
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        (self.path.parent / ".gdignore").touch()
+        with self.lock:
+            data = {"version": CACHE_VERSION, "entries": self.entries}
+            temp = self.path.with_suffix(".tmp")
+            with open(temp, "w", encoding="utf-8") as f:
+                json.dump(data, f, indent=1, sort_keys=True)
+            os.replace(temp, self.path)
+
+    def _script_digest(self, script: Path) -> str:
+        if script not in self._script_digests:
+            self._script_digests[script] = _file_digest(script)
+        return self._script_digests[script]
+
+    def key(self, script: Path, input: Path, params: dict[str, Any]) -> str:
+        data = {
+            "manifest": self.manifest,
+            "script": self._script_digest(script),
+            "params": params,
+            "input": fingerprint_directory(input, self.hash_contents),
+        }
+        encoded = json.dumps(data, sort_keys=True, default=str).encode("utf-8")
+        return hashlib.sha256(encoded).hexdigest()
+
+    def is_fresh(self, outputs: list[Path], key: str) -> bool:
+        with self.lock:
+            entries = [self.entries.get(str(output)) for output in outputs]
+        fresh = all(
+            entry and entry["key"] == key and self._matches(output, entry)
+            for output, entry in zip(outputs, entries)
+        )
+        with self.lock:
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return fresh
+
+    @staticmethod
+    def _matches(output: Path, entry: dict[str, Any]) -> bool:
+        try:
+            stat = output.stat()
+        except FileNotFoundError:
+            return False
+        return stat.st_size == entry["size"] and stat.st_mtime_ns == entry["mtime_ns"]
+
+    def record(self, outputs: list[Path], key: str):
+        stats = [output.stat() for output in outputs]
+        with self.lock:
+            for output, stat in zip(outputs, stats):
+                self.entries[str(output)] = {
+                    "key": key,
+                    "size": stat.st_size,
+                    "mtime_ns": stat.st_mtime_ns,
+                }
+
+    def refresh(self, outputs: list[Path]):
+        # Outputs rewritten in place by a later action stay up to date
+        stats = [output.stat() for output in outputs]
+        with self.lock:
+            for output, stat in zip(outputs, stats):
+                entry = self.entries.get(str(output))
+                if entry:
+                    entry["size"] = stat.st_size
+                    entry["mtime_ns"] = stat.st_mtime_ns
+
+    def forget(self, outputs: list[Path]):
+        with self.lock:
+            for output in outputs:
+                self.entries.pop(str(output), None)
+
+    def report(self):
+        logger.info(f"Build cache: {self.hits} up to date, {self.misses} converted")
+
+
+# Parsed pipeline definitions, pickled under the digest of the YAML text and of
+# dsl.py, so that a plan is parsed again whenever either changes. A hit skips
+# importing yaml and dataclass_wizard. Unpickling runs code, so the cache lives
+# in a per-user directory (see utils.user_cache_dir) rather than next to the
+# destination, and files that other users could have written are ignored.
+def _trusted(stat: os.stat_result) -> bool:
+    if os.name == "nt":
+        return True
+    return stat.st_uid == os.getuid() and not stat.st_mode & 0o022
+
+
+class PlanCache:
+    def __init__(self, directory: Path, size: int = PLAN_CACHE_SIZE):
+        self.directory = directory
+        self.size = size
+
+    def key(self, text: str) -> str:
+        digest = hashlib.sha256(Path(dsl.__file__).read_bytes())
+        digest.update(text.encode("utf-8"))
+        return digest.hexdigest()
+
+    def load(self, text: str) -> Root:
+        path = self.directory / f"{self.key(text)}.pickle"
+        try:
+            with open(path, "rb") as f:
+                if not _trusted(os.fstat(f.fileno())):
+                    raise PermissionError("not private to this user")
+                plan = pickle.load(f)
+            if isinstance(plan, Root):
+                logger.debug(f"Loaded pipeline plan from {path}")
+                os.utime(path)
+                return plan
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable plan cache {path}: {e!r}")
+        from yaml import safe_load
+
+        plan = Root.from_dict(safe_load(text))
+        try:
+            self.save(path, plan)
+        except OSError as e:
+            logger.warning(f"Could not cache the pipeline plan: {e}")
+        return plan
+
+    def save(self, path: Path, plan: Root):
+        self.directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+        temp = path.with_suffix(".tmp")
+        with open(temp, "wb") as f:
+            pickle.dump(plan, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, path)
+        # Keep the most recently used plans
+        plans = sorted(self.directory.glob("*.pickle"), key=lambda p: p.stat().st_mtime_ns)
+        for old in plans[: -self.size]:
+            old.unlink(missing_ok=True)
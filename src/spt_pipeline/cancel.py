@@ -0,0 +1,84 @@
+#
+# Copyright (c) 2024 Rafał Kuźnia <rafal.kuznia@protonmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+logger = logging.getLogger(__name__)
+
+
+class Cancelled(Exception):
+    pass
+
+
+# Cancellation of a whole run. Whatever keeps a child process or a remote job
+# alive registers a callback that ends it, so that cancelling the scope stops
+# all running work at once. Jobs check the scope before they start anything.
+class CancelScope:
+    def __init__(self):
+        self.event = threading.Event()
+        self.reason = ""
+        self.callbacks: list[Callable[[], None]] = []
+        self.lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.event.is_set()
+
+    def check(self):
+        if self.event.is_set():
+            raise Cancelled(self.reason)
+
+    def sleep(self, seconds: float):
+        if self.event.wait(seconds):
+            raise Cancelled(self.reason)
+
+    def cancel(self, reason: str = "cancelled"):
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.reason = reason
+            self.event.set()
+            callbacks = list(self.callbacks)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.debug(f"Cancel callback {callback} failed: {e!r}")
+
+    def add(self, callback: Callable[[], None]):
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def remove(self, callback: Callable[[], None]):
+        with self.lock:
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+
+    @contextmanager
+    def guard(self, callback: Callable[[], None]) -> Iterator[None]:
+        self.add(callback)
+        try:
+            yield
+        finally:
+            self.remove(callback)
+
+
+_scope = CancelScope()
+
+
+def get_cancel_scope() -> CancelScope:
+    return _scope
+
+
+def set_cancel_scope(scope: CancelScope):
+    global _scope
+    _scope = scope
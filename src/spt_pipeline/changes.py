@@ -0,0 +1,44 @@
+#
+# Copyright (c) 2024 Rafał Kuźnia <rafal.kuznia@protonmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+import logging
+import os
+import threading
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+# Files written or rewritten during this run. Outputs that the build cache
+# found up to date are not part of it.
+class ChangeSet:
+    def __init__(self):
+        self.paths: set[Path] = set()
+        self.lock = threading.Lock()
+
+    def __contains__(self, path) -> bool:
+        with self.lock:
+            return Path(os.path.abspath(path)) in self.paths
+
+    def add(self, paths: list[Path]):
+        with self.lock:
+            self.paths.update(Path(os.path.abspath(path)) for path in paths)
+
+    def under(self, directory: Path) -> list[Path]:
+        root = Path(os.path.abspath(directory))
+        with self.lock:
+            return sorted(path for path in self.paths if path.is_relative_to(root))
+
+    def write(self, path: Path, directory: Path) -> int:
+        # One res:// path per line, for Godot scripts that import just these
+        root = Path(os.path.abspath(directory))
+        changed = self.under(root)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        (path.parent / ".gdignore").touch()
+        with open(path, "w", encoding="utf-8") as f:
+            for changed_path in changed:
+                f.write(f"res://{changed_path.relative_to(root).as_posix()}\n")
+        return len(changed)
@@ -0,0 +1,185 @@
+#
+# Copyright (c) 2024 Rafał Kuźnia <rafal.kuznia@protonmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+import logging
+import os
+import subprocess
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Iterator
+
+logger = logging.getLogger(__name__)
+
+MiB = 1024 * 1024
+GiB = 1024 * MiB
+
+# Initial peak RSS guesses per job kind. They are replaced by measurements of
+# the actual children as soon as the first job of a kind has finished.
+DEFAULT_ESTIMATES = {
+    "track": 3 * GiB,
+    "car": 1 * GiB,
+    "godot": 2 * GiB,
+}
+SAMPLE_INTERVAL = 0.25
+MEMORY_HEADROOM = 0.8
+
+
+def _read_proc_kib(path: str, field: str) -> int | None:
+    try:
+        with open(path, "r", encoding="ascii") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def available_memory() -> int | None:
+    return _read_proc_kib("/proc/meminfo", "MemAvailable")
+
+
+def peak_rss(pid: int) -> int | None:
+    return _read_proc_kib(f"/proc/{pid}/status", "VmHWM")
+
+
+def reset_peak_rss(pid: int) -> bool:
+    # Linux sets the peak to the current RSS when 5 is written to clear_refs
+    try:
+        with open(f"/proc/{pid}/clear_refs", "w", encoding="ascii") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def default_workers() -> int:
+    if sys.platform == "win32":
+        return 1
+    return os.cpu_count() or 1
+
+
+def default_limits(workers: int) -> dict[str, int]:
+    return {
+        "track": max(1, workers // 2),
+        "car": workers,
+        "godot": 1,
+    }
+
+
+class ProcessMonitor:
+    def __init__(self):
+        self.peak: int | None = None
+        self.threads: list[threading.Thread] = []
+
+    def watch(self, process: subprocess.Popen):
+        thread = threading.Thread(target=self._sample, args=(process,), daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def _sample(self, process: subprocess.Popen):
+        while True:
+            rss = peak_rss(process.pid)
+            if rss is not None:
+                self.peak = max(self.peak or 0, rss)
+            try:
+                process.wait(timeout=SAMPLE_INTERVAL)
+                return
+            except subprocess.TimeoutExpired:
+                pass
+
+    @contextmanager
+    def measure(self, pid: int) -> Iterator[None]:
+        # For a process that outlives the job, e.g. a pool worker, the peak is
+        # that of the job only. Where it cannot be reset, the peak of earlier
+        # jobs would be attributed to this one, so nothing is recorded.
+        reset = reset_peak_rss(pid)
+        try:
+            yield
+        finally:
+            rss = peak_rss(pid) if reset else None
+            if rss is not None:
+                self.peak = max(self.peak or 0, rss)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+
+@dataclass
+class Slot:
+    kind: str
+    estimate: int
+    monitor: ProcessMonitor = field(default_factory=ProcessMonitor)
+
+
+class ConcurrencyPolicy:
+    def __init__(
+        self,
+        workers: int | None = None,
+        memory_budget: int | None = None,
+        limits: dict[str, int] = {},
+    ):
+        self.workers = workers or default_workers()
+        if memory_budget is None:
+            available = available_memory()
+            memory_budget = int(available * MEMORY_HEADROOM) if available else None
+        self.memory_budget = memory_budget
+        self.limits = default_limits(self.workers) | limits
+        self.estimates = dict(DEFAULT_ESTIMATES)
+        self.running: Counter[str] = Counter()
+        self.reserved = 0
+        self.condition = threading.Condition()
+        budget = f"{self.memory_budget // MiB} MiB" if self.memory_budget else "unlimited"
+        logger.debug(f"Concurrency: {self.workers} workers, {self.limits}, memory {budget}")
+
+    def _admits(self, kind: str, estimate: int) -> bool:
+        if sum(self.running.values()) >= self.workers:
+            return False
+        if self.running[kind] >= self.limits.get(kind, self.workers):
+            return False
+        if self.memory_budget and self.reserved:
+            return self.reserved + estimate <= self.memory_budget
+        return True
+
+    def _update_estimate(self, kind: str, peak: int):
+        old = self.estimates.get(kind, peak)
+        # Grow immediately, shrink slowly
+        self.estimates[kind] = peak if peak > old else (3 * old + peak) // 4
+
+    def acquire(self, kind: str) -> Slot | None:
+        # Does not wait, the Scheduler keeps the jobs that are not admitted yet
+        with self.condition:
+            estimate = self.estimates.get(kind, 0)
+            if not self._admits(kind, estimate):
+                return None
+            self.running[kind] += 1
+            self.reserved += estimate
+        return Slot(kind, estimate)
+
+    def release(self, slot: Slot):
+        slot.monitor.join()
+        with self.condition:
+            self.running[slot.kind] -= 1
+            self.reserved -= slot.estimate
+            if slot.monitor.peak:
+                logger.debug(f"{slot.kind} job peak RSS {slot.monitor.peak // MiB} MiB")
+                self._update_estimate(slot.kind, slot.monitor.peak)
+            self.condition.notify_all()
+
+    @contextmanager
+    def slot(self, kind: str) -> Iterator[ProcessMonitor]:
+        # Waits for a slot, for callers that do not run as Scheduler jobs
+        with self.condition:
+            while not (slot := self.acquire(kind)):
+                self.condition.wait()
+        try:
+            yield slot.monitor
+        finally:
+            self.release(slot)
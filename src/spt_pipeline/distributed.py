@@ -0,0 +1,367 @@
+#
+# Copyright (c) 2024 Rafał Kuźnia <rafal.kuznia@protonmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+# Coordinator side of distributed builds. The coordinator runs the pipeline as
+# usual, but Blender conversions are sent to build nodes (see node.py) that
+# connect over TCP. Every message is a JSON header line followed by the raw
+# bytes of the files listed in its "sizes" field:
+#
+#   node -> coordinator: hello, heartbeat, progress, result
+#   coordinator -> node: job, exit
+#
+# A job carries the files of its input directory. Paths in the job arguments
+# are rewritten to "{job}/..." placeholders that the node replaces with its own
+# scratch directory, and the outputs are shipped back with the result.
+
+import itertools
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path, PurePosixPath
+from typing import Any, BinaryIO, Callable
+
+from spt_pipeline.cancel import get_cancel_scope
+from spt_pipeline.retry import JobBroken, JobFailed, JobTimeout
+from spt_pipeline.tracing import get_tracer
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_INTERVAL = 2.0
+HEARTBEAT_TIMEOUT = 15.0
+MAX_ATTEMPTS = 3
+JOB_DIR = "{job}"
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def send_message(sock: socket.socket, header: dict[str, Any], blobs: list[bytes] = []):
+    header = header | {"sizes": [len(blob) for blob in blobs]}
+    sock.sendall(json.dumps(header).encode("utf-8") + b"\n")
+    for blob in blobs:
+        sock.sendall(blob)
+
+
+def read_message(stream: BinaryIO) -> tuple[dict[str, Any], list[bytes]] | None:
+    line = stream.readline()
+    if not line:
+        return None
+    try:
+        header = dict(json.loads(line))
+    except ValueError as e:
+        raise ProtocolError(f"Malformed message header: {line[:80]!r}") from e
+    blobs = []
+    for size in header.get("sizes", []):
+        blob = stream.read(size)
+        if len(blob) != size:
+            raise ProtocolError("Connection closed in the middle of a message")
+        blobs.append(blob)
+    return header, blobs
+
+
+def parse_address(value: str) -> tuple[str, int]:
+    host, _, port = value.rpartition(":")
+    if not port.isdigit():
+        raise ValueError(f"Expected [HOST:]PORT, got {value!r}")
+    return host, int(port)
+
+
+def pack_directory(directory: Path) -> tuple[list[str], list[bytes]]:
+    names, blobs = [], []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            path = Path(root) / name
+            names.append(path.relative_to(directory).as_posix())
+            blobs.append(path.read_bytes())
+    return names, blobs
+
+
+def write_atomic(path: Path, data: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp = path.with_name(path.name + ".part")
+    temp.write_bytes(data)
+    os.replace(temp, path)
+
+
+def output_path(outputs: dict[str, Path], name: str) -> Path | None:
+    # Where a file the node sent back goes. An output may be a directory (the
+    # chunks of a track), its files come back as out/N.chunks/FILE.
+    if name in outputs:
+        return outputs[name]
+    parts = PurePosixPath(name).parts
+    directory = "/".join(parts[:2])
+    if directory not in outputs or len(parts) < 3 or ".." in parts:
+        return None
+    return outputs[directory].joinpath(*parts[2:])
+
+
+@dataclass
+class RemoteJob:
+    id: int
+    script: str
+    args: dict[str, Any]
+    inputs: list[str]
+    blobs: list[bytes]
+    outputs: dict[str, Path]
+    timeout: float | None = None
+    on_progress: Callable[[int, int], None] | None = None
+    attempts: int = 0
+    node: str = ""
+    status: str = ""
+    error: str = ""
+    # Whether another attempt could succeed
+    retry: bool = True
+    # Seconds the build node spent converting
+    seconds: float = 0.0
+    log: list[tuple[int, str]] = field(default_factory=list)
+    done: threading.Event = field(default_factory=threading.Event)
+
+
+class RemoteWorker:
+    def __init__(self, sock: socket.socket, name: str, slots: int):
+        self.sock = sock
+        self.name = name
+        self.slots = slots
+        self.assigned: dict[int, RemoteJob] = {}
+        self.connected = True
+        self.last_seen = time.monotonic()
+        self.send_lock = threading.Lock()
+
+    def send(self, header: dict[str, Any], blobs: list[bytes] = []):
+        with self.send_lock:
+            send_message(self.sock, header, blobs)
+
+
+class Coordinator:
+    def __init__(
+        self,
+        address: tuple[str, int],
+        heartbeat_timeout: float = HEARTBEAT_TIMEOUT,
+        max_attempts: int = MAX_ATTEMPTS,
+    ):
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_attempts = max_attempts
+        self.pending: deque[RemoteJob] = deque()
+        self.workers: list[RemoteWorker] = []
+        self.condition = threading.Condition()
+        self.ids = itertools.count()
+        self.closing = False
+        self.server = socket.create_server(address)
+        self.address = self.server.getsockname()[:2]
+        logger.info(f"Waiting for build nodes on {self.address[0]}:{self.address[1]}")
+        # Cancelling the run releases the jobs waiting for a result
+        self.scope = get_cancel_scope()
+        self.scope.add(self.close)
+        for target in (self._accept, self._watch_heartbeats):
+            threading.Thread(target=target, daemon=True).start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _accept(self):
+        while True:
+            try:
+                sock, peer = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(sock, peer), daemon=True).start()
+
+    def _serve(self, sock: socket.socket, peer):
+        stream = sock.makefile("rb")
+        try:
+            message = read_message(stream)
+            if message is None or message[0].get("type") != "hello":
+                raise ProtocolError(f"Expected hello from {peer}")
+            hello = message[0]
+            worker = RemoteWorker(sock, hello.get("name", str(peer)), int(hello.get("slots", 1)))
+        except (OSError, ProtocolError, ValueError) as e:
+            logger.warning(f"Rejected build node {peer}: {e}")
+            sock.close()
+            return
+        with self.condition:
+            if self.closing:
+                sock.close()
+                return
+            self.workers.append(worker)
+            self.condition.notify_all()
+        logger.info(f"Build node {worker.name} connected with {worker.slots} slots")
+        threading.Thread(target=self._dispatch, args=(worker,), daemon=True).start()
+        try:
+            while message := read_message(stream):
+                worker.last_seen = time.monotonic()
+                self._handle(worker, *message)
+        except (OSError, ProtocolError) as e:
+            logger.warning(f"Lost build node {worker.name}: {e}")
+        finally:
+            self._drop(worker)
+
+    def _handle(self, worker: RemoteWorker, header: dict[str, Any], blobs: list[bytes]):
+        kind = header.get("type")
+        if kind == "heartbeat":
+            return
+        job = worker.assigned.get(header.get("job", -1))
+        if job is None:
+            return
+        if kind == "progress" and job.on_progress:
+            job.on_progress(header["done"], header["total"])
+        elif kind == "result":
+            job.status = header.get("status", "error")
+            job.error = header.get("error", "")
+            job.retry = header.get("retry", True)
+            job.seconds = header.get("seconds", 0.0)
+            job.log = [tuple(entry) for entry in header.get("log", [])]
+            for name, blob in zip(header.get("outputs", []), blobs):
+                if path := output_path(job.outputs, name):
+                    write_atomic(path, blob)
+            with self.condition:
+                worker.assigned.pop(job.id, None)
+                self.condition.notify_all()
+            job.done.set()
+
+    def _dispatch(self, worker: RemoteWorker):
+        while True:
+            with self.condition:
+                while worker.connected and (
+                    not self.pending or len(worker.assigned) >= worker.slots
+                ):
+                    self.condition.wait()
+                if not worker.connected:
+                    return
+                job = self.pending.popleft()
+                job.attempts += 1
+                job.node = worker.name
+                worker.assigned[job.id] = job
+            header = {
+                "type": "job",
+                "job": job.id,
+                "script": job.script,
+                "args": job.args,
+                "timeout": job.timeout,
+            }
+            try:
+                worker.send(header | {"inputs": job.inputs}, job.blobs)
+            except OSError as e:
+                logger.warning(f"Could not send job to {worker.name}: {e}")
+                self._disconnect(worker)
+                return
+
+    def _watch_heartbeats(self):
+        while not self.closing:
+            time.sleep(HEARTBEAT_INTERVAL)
+            now = time.monotonic()
+            with self.condition:
+                stale = [w for w in self.workers if now - w.last_seen > self.heartbeat_timeout]
+            for worker in stale:
+                logger.warning(f"Build node {worker.name} missed its heartbeats")
+                self._disconnect(worker)
+
+    def _disconnect(self, worker: RemoteWorker):
+        # The reader in _serve wakes up and reassigns the jobs
+        try:
+            worker.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _drop(self, worker: RemoteWorker):
+        with self.condition:
+            if not worker.connected:
+                return
+            worker.connected = False
+            if worker in self.workers:
+                self.workers.remove(worker)
+            failed = []
+            for job in worker.assigned.values():
+                if job.attempts < self.max_attempts and not self.closing:
+                    logger.warning(f"Reassigning {job.script} job {job.id} from {worker.name}")
+                    self.pending.appendleft(job)
+                else:
+                    failed.append(job)
+            worker.assigned.clear()
+            self.condition.notify_all()
+        worker.sock.close()
+        for job in failed:
+            job.status = "error"
+            job.error = f"Build node {worker.name} was lost after {job.attempts} attempts"
+            job.done.set()
+        logger.info(f"Build node {worker.name} disconnected")
+
+    def _prepare(self, script: str, args: dict[str, Any]) -> RemoteJob:
+        outputs: dict[str, Path] = {}
+
+        def rewrite(key, value):
+            if isinstance(value, dict):
+                return {k: rewrite(k, v) for k, v in value.items()}
+            if isinstance(value, list):
+                return [rewrite(key, item) for item in value]
+            if key == "output":
+                name = f"out/{len(outputs)}{Path(value).suffix}"
+                outputs[name] = Path(value)
+                return f"{JOB_DIR}/{name}"
+            return str(value) if isinstance(value, Path) else value
+
+        remote_args = {k: rewrite(k, v) for k, v in args.items() if k != "input"}
+        remote_args["input"] = f"{JOB_DIR}/input"
+        inputs, blobs = pack_directory(Path(args["input"]))
+        return RemoteJob(next(self.ids), script, remote_args, inputs, blobs, outputs)
+
+    def run(self, script: str, on_progress=None, timeout=None, **args) -> float:
+        job = self._prepare(script, args)
+        job.on_progress = on_progress
+        job.timeout = timeout
+        with get_tracer().span(script, "remote", input=str(args["input"])) as span:
+            with self.condition:
+                if not self.workers:
+                    logger.info(f"No build node connected yet, {script} job {job.id} is queued")
+                self.pending.append(job)
+                self.condition.notify_all()
+            job.done.wait()
+            span["status"] = job.status
+            span["attempts"] = job.attempts
+            span["node"] = job.node
+        for level, line in job.log:
+            logger.log(level, f"[{job.node}] {line}")
+        if job.status == "timeout" and timeout:
+            raise JobTimeout(timeout)
+        if job.status != "ok":
+            logger.error(f"Blender args: {script} {args}")
+            logger.error(job.error or "Remote conversion failed")
+            if not job.retry:
+                raise JobBroken(job.error)
+            raise JobFailed(job.error or f"failed on {job.node}")
+        return job.seconds
+
+    def close(self):
+        with self.condition:
+            if self.closing:
+                return
+            self.closing = True
+            workers = list(self.workers)
+            abandoned = list(self.pending)
+            abandoned += [job for worker in workers for job in worker.assigned.values()]
+            self.pending.clear()
+            self.condition.notify_all()
+        self.scope.remove(self.close)
+        self.server.close()
+        for job in abandoned:
+            job.status = "error"
+            job.error = "Coordinator shut down before the job finished"
+            job.done.set()
+        for worker in workers:
+            try:
+                worker.send({"type": "exit"})
+            except OSError:
+                pass
+            self._disconnect(worker)
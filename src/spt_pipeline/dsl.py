@@ -6,12 +6,12 @@
 
 from __future__ import annotations
 
-from dataclasses import dataclass
-from typing import Self, Union
+from dataclasses import dataclass, field
+from typing import Any, Self, Union
 
-from dataclass_wizard import JSONWizard
-
-DslTypes = Union["GetFiles", "Track2GLTF", "Car2GLTF", "GodotPostprocess", "GodotRun"]
+DslTypes = Union[
+    "GetFiles", "Track2GLTF", "Car2GLTF", "OptimizeGLB", "GodotPostprocess", "GodotRun"
+]
 
 
 @dataclass
@@ -21,6 +21,21 @@ class GetFiles:
     dir_only: bool = False
     required: bool = False
     recursive: bool = False
+    # Hand matches to the following Foreach while the scan is still running.
+    # The items are then processed in scan order instead of longest first.
+    stream: bool = False
+    # Check each match (VIV directory, FRD header) and fingerprint the files
+    # next to it. Corrupt matches are dropped, and of matches with the same
+    # content only the first is converted. The others get hard links to its
+    # outputs. Needs the whole scan, so it does not stream.
+    dedupe: bool = False
+
+
+@dataclass
+class TrackVariant:
+    destination: str
+    night: bool = False
+    weather: bool = False
 
 
 @dataclass
@@ -28,22 +43,39 @@ class Track2GLTF:
     destination: str = "{_temp}/{_filename}/{_filename.glb}"
     night: bool = False
     weather: bool = False
+    variants: list[TrackVariant] = field(default_factory=list)
+    # Number of spatial chunks to split the exports into, 0 or 1 exports the
+    # whole track into one GLB
+    chunks: int = 0
+    timeout: float | None = None
 
 
 @dataclass
 class Car2GLTF:
     destination: str = "{_temp}/{_filename}/{_filename.glb}"
+    timeout: float | None = None
+
+
+@dataclass
+class OptimizeGLB:
+    quantize: bool = False
+    strip: bool = True
 
 
 @dataclass
 class GodotPostprocess:
     script: str
+    # Seconds per file, a batch of files gets the sum
+    timeout: float | None = None
 
 
 @dataclass
 class GodotRun:
     workdir: str
     args: list[str]
+    timeout: float | None = None
+    # Skip Godot when no file under workdir was written during the run
+    only_changed: bool = True
 
 
 @dataclass
@@ -52,10 +84,23 @@ class Foreach:
 
 
 @dataclass
-class Root(JSONWizard):
-    class Meta(JSONWizard.Meta):
-        tag_key = "action"
-        auto_assign_tags = True
-
+class Root:
     # pipelines: list[Pipeline]
     pipelines: list[DslTypes | Foreach]
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> Root:
+        # dataclass_wizard takes longer to import than the rest of the package,
+        # and runs that find the plan in the plan cache do not need it
+        from dataclass_wizard import LoadMeta, fromdict
+
+        LoadMeta(tag_key="action", auto_assign_tags=True).bind_to(cls)
+        return fromdict(cls, data)
+
+
+def uses_action(actions: list, kind: type) -> bool:
+    return any(
+        isinstance(action, kind)
+        or (isinstance(action, Foreach) and uses_action(action.actions, kind))
+        for action in actions
+    )
@@ -0,0 +1,62 @@
+#
+# Copyright (c) 2024 Rafał Kuźnia <rafal.kuznia@protonmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable
+
+# Life cycle of a Foreach item. An item that failed stays failed when its chain
+# of actions finishes, and an item whose outputs were up to date is done
+# without running.
+QUEUED = "queued"
+RUNNING = "running"
+PROGRESS = "progress"
+UP_TO_DATE = "up to date"
+FAILED = "failed"
+DONE = "done"
+
+
+@dataclass
+class Event:
+    item: str
+    state: str
+    action: str = ""
+    done: int = 0
+    total: int = 0
+    time: float = field(default_factory=time.monotonic)
+
+
+# Progress of the run for user interfaces, independent of the log output.
+# Listeners are called on the worker threads and must not block.
+class Events:
+    def __init__(self):
+        self.listeners: list[Callable[[Event], None]] = []
+        self.lock = threading.Lock()
+
+    def subscribe(self, listener: Callable[[Event], None]):
+        with self.lock:
+            self.listeners = self.listeners + [listener]
+
+    def emit(self, item, state: str, **kwargs):
+        listeners = self.listeners
+        if not listeners:
+            return
+        event = Event(str(item), state, **kwargs)
+        for listener in listeners:
+            listener(event)
+
+
+_events = Events()
+
+
+def get_events() -> Events:
+    return _events
+
+
+def set_events(events: Events):
+    global _events
+    _events = events
@@ -0,0 +1,514 @@
+#
+# Copyright (c) 2024 Rafał Kuźnia <rafal.kuznia@protonmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+# GLB post-processing. The file is mapped into memory and the binary chunk is
+# only ever sliced through memoryviews: buffer views that are kept unchanged
+# are written straight from the mapping into the new file. Identical buffer
+# views and accessors are merged, vertex attributes can be quantised
+# (KHR_mesh_quantization) and data nothing refers to anymore is dropped.
+
+import hashlib
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+from array import array
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Iterator
+
+GLB_MAGIC = b"glTF"
+JSON_CHUNK = 0x4E4F534A
+BIN_CHUNK = 0x004E4942
+MARKER = "spt_optimized"
+ALREADY_OPTIMISED = "already optimised"
+
+FLOAT = 5126
+SHORT = 5122
+UNSIGNED_SHORT = 5123
+TYPE_SIZES = {"SCALAR": 1, "VEC2": 2, "VEC3": 3, "VEC4": 4, "MAT2": 4, "MAT3": 9, "MAT4": 16}
+ARRAY_BUFFER = 34962
+
+# Extensions known not to refer to accessors or buffer views. Files using any
+# other extension are left as they are.
+SAFE_EXTENSIONS = {
+    "KHR_lights_punctual",
+    "KHR_materials_clearcoat",
+    "KHR_materials_emissive_strength",
+    "KHR_materials_ior",
+    "KHR_materials_sheen",
+    "KHR_materials_specular",
+    "KHR_materials_transmission",
+    "KHR_materials_unlit",
+    "KHR_materials_variants",
+    "KHR_materials_volume",
+    "KHR_mesh_quantization",
+    "KHR_texture_transform",
+}
+
+
+class GLBError(Exception):
+    pass
+
+
+@dataclass
+class Stats:
+    size_before: int = 0
+    size_after: int = 0
+    views_merged: int = 0
+    accessors_merged: int = 0
+    attributes_quantized: int = 0
+    skipped: str = ""
+
+
+def parse_glb(data: memoryview) -> tuple[dict[str, Any], memoryview]:
+    if len(data) < 20:
+        raise GLBError("File too short for a GLB")
+    magic, version, length = struct.unpack_from("<4sII", data)
+    if magic != GLB_MAGIC or version != 2:
+        raise GLBError("Not a glTF 2.0 binary file")
+    if length > len(data):
+        raise GLBError(f"Truncated GLB, header says {length} bytes, file has {len(data)}")
+    document = None
+    binary = data[0:0]
+    offset = 12
+    while offset + 8 <= length:
+        chunk_length, chunk_type = struct.unpack_from("<II", data, offset)
+        chunk = data[offset + 8 : offset + 8 + chunk_length]
+        if chunk_type == JSON_CHUNK and document is None:
+            document = json.loads(bytes(chunk))
+        elif chunk_type == BIN_CHUNK and not binary:
+            binary = chunk
+        offset += 8 + chunk_length
+    if document is None:
+        raise GLBError("GLB has no JSON chunk")
+    return document, binary
+
+
+def read_document(path: Path) -> dict[str, Any]:
+    # Only the JSON chunk, for checks that do not need the binary data
+    with open(path, "rb") as f:
+        header = f.read(20)
+        if len(header) < 20:
+            raise GLBError("File too short for a GLB")
+        magic, version, _, chunk_length, chunk_type = struct.unpack("<4sIIII", header)
+        if magic != GLB_MAGIC or version != 2 or chunk_type != JSON_CHUNK:
+            raise GLBError("Not a glTF 2.0 binary file")
+        return dict(json.loads(f.read(chunk_length)))
+
+
+def _pad(length: int) -> int:
+    return -length % 4
+
+
+def write_glb(path: Path, document: dict[str, Any], pieces: list[bytes | memoryview]):
+    encoded = json.dumps(document, separators=(",", ":")).encode("utf-8")
+    encoded += b" " * _pad(len(encoded))
+    binary_length = sum(len(piece) for piece in pieces)
+    length = 12 + 8 + len(encoded) + (8 + binary_length if pieces else 0)
+    with open(path, "wb") as f:
+        f.write(struct.pack("<4sII", GLB_MAGIC, 2, length))
+        f.write(struct.pack("<II", len(encoded), JSON_CHUNK))
+        f.write(encoded)
+        if pieces:
+            f.write(struct.pack("<II", binary_length, BIN_CHUNK))
+            for piece in pieces:
+                f.write(piece)
+
+
+def accessor_references(document: dict[str, Any]) -> Iterator[tuple[Any, Any]]:
+    # (container, key) pairs of every place that holds an accessor index
+    for mesh in document.get("meshes", []):
+        for primitive in mesh.get("primitives", []):
+            attributes = primitive.get("attributes", {})
+            yield from ((attributes, name) for name in attributes)
+            if "indices" in primitive:
+                yield primitive, "indices"
+            for target in primitive.get("targets", []):
+                yield from ((target, name) for name in target)
+    for skin in document.get("skins", []):
+        if "inverseBindMatrices" in skin:
+            yield skin, "inverseBindMatrices"
+    for animation in document.get("animations", []):
+        for sampler in animation.get("samplers", []):
+            yield sampler, "input"
+            yield sampler, "output"
+
+
+def view_references(document: dict[str, Any]) -> Iterator[tuple[Any, Any]]:
+    for accessor in document.get("accessors", []):
+        if "bufferView" in accessor:
+            yield accessor, "bufferView"
+        sparse = accessor.get("sparse")
+        if sparse:
+            yield sparse["indices"], "bufferView"
+            yield sparse["values"], "bufferView"
+    for image in document.get("images", []):
+        if "bufferView" in image:
+            yield image, "bufferView"
+
+
+def _remap(references: Iterator[tuple[Any, Any]], mapping: dict[int, int]):
+    for container, key in references:
+        container[key] = mapping.get(container[key], container[key])
+
+
+class Optimizer:
+    def __init__(self, document: dict[str, Any], binary: memoryview):
+        self.document = document
+        self.binary = binary
+        self.stats = Stats()
+        # Contents of every buffer view, slices of the mapped file until a
+        # view is replaced with newly encoded data
+        self.views: list[bytes | memoryview] = []
+        for view in document.get("bufferViews", []):
+            start = view.get("byteOffset", 0)
+            end = start + view["byteLength"]
+            if view.get("buffer", 0) != 0 or end > len(binary):
+                raise GLBError("Buffer view outside of the GLB binary chunk")
+            self.views.append(binary[start:end])
+
+    def dedupe_views(self):
+        seen: dict[tuple, int] = {}
+        mapping = {}
+        for index, view in enumerate(self.document.get("bufferViews", [])):
+            digest = hashlib.blake2b(self.views[index], digest_size=16).digest()
+            key = (digest, len(self.views[index]), view.get("byteStride"), view.get("target"))
+            if key in seen:
+                mapping[index] = seen[key]
+            else:
+                seen[key] = index
+        _remap(view_references(self.document), mapping)
+        self.stats.views_merged = len(mapping)
+
+    def dedupe_accessors(self):
+        seen: dict[str, int] = {}
+        mapping = {}
+        for index, accessor in enumerate(self.document.get("accessors", [])):
+            key = json.dumps({k: v for k, v in accessor.items() if k != "name"}, sort_keys=True)
+            if key in seen:
+                mapping[index] = seen[key]
+            else:
+                seen[key] = index
+        _remap(accessor_references(self.document), mapping)
+        self.stats.accessors_merged = len(mapping)
+
+    def read_floats(self, index: int) -> array:
+        accessor = self.document["accessors"][index]
+        width = TYPE_SIZES[accessor["type"]]
+        view_index = accessor["bufferView"]
+        data = self.views[view_index]
+        size = 4 * width
+        stride = self.document["bufferViews"][view_index].get("byteStride") or size
+        start = accessor.get("byteOffset", 0)
+        count = accessor["count"]
+        if stride == size:
+            raw = bytes(data[start : start + count * size])
+        else:
+            raw = b"".join(
+                data[offset : offset + size]
+                for offset in range(start, start + count * stride, stride)
+            )
+        values = array("f")
+        values.frombytes(raw)
+        if sys.byteorder == "big":
+            values.byteswap()
+        return values
+
+    def add_accessor(
+        self, source: int, values: array, component: int, width: int, **fields
+    ) -> int:
+        # Elements are padded to 4 bytes as required for vertex attributes
+        padded = width + (-width * values.itemsize) % 4 // values.itemsize
+        if padded != width:
+            out = array(values.typecode, bytes(values.itemsize * padded * (len(values) // width)))
+            for i in range(width):
+                out[i::padded] = values[i::width]
+            values = out
+        if sys.byteorder == "big":
+            values.byteswap()
+        data = values.tobytes()
+        views = self.document.setdefault("bufferViews", [])
+        view = {"buffer": 0, "byteLength": len(data), "target": ARRAY_BUFFER}
+        if padded != width:
+            view["byteStride"] = padded * values.itemsize
+        views.append(view)
+        self.views.append(data)
+        old = self.document["accessors"][source]
+        accessor = {k: v for k, v in old.items() if k in ("name", "type", "count")}
+        accessor |= {"bufferView": len(views) - 1, "componentType": component} | fields
+        self.document["accessors"].append(accessor)
+        return len(self.document["accessors"]) - 1
+
+    def _quantizable(self, index: int) -> bool:
+        accessor = self.document["accessors"][index]
+        return (
+            accessor.get("componentType") == FLOAT
+            and "bufferView" in accessor
+            and "sparse" not in accessor
+        )
+
+    def quantize(self):
+        document = self.document
+        meshes = document.get("meshes", [])
+        users: dict[int, set[int]] = {}
+        for mesh_index, mesh in enumerate(meshes):
+            for primitive in mesh.get("primitives", []):
+                for accessor in primitive.get("attributes", {}).values():
+                    users.setdefault(accessor, set()).add(mesh_index)
+        animated = {
+            channel.get("target", {}).get("node")
+            for animation in document.get("animations", [])
+            for channel in animation.get("channels", [])
+        }
+        nodes_of: dict[int, list[dict[str, Any]]] = {}
+        foldable: dict[int, bool] = {}
+        for index, node in enumerate(document.get("nodes", [])):
+            if "mesh" in node:
+                nodes_of.setdefault(node["mesh"], []).append(node)
+                mesh_foldable = foldable.get(node["mesh"], True)
+                foldable[node["mesh"]] = mesh_foldable and node_foldable(node, index in animated)
+
+        replaced: dict[int, int] = {}
+        for mesh_index, mesh in enumerate(meshes):
+            primitives = mesh.get("primitives", [])
+            if any("targets" in primitive for primitive in primitives):
+                continue
+            for primitive in primitives:
+                attributes = primitive.get("attributes", {})
+                for name, index in attributes.items():
+                    if index in replaced:
+                        attributes[name] = replaced[index]
+                    elif self._quantizable(index):
+                        if name == "NORMAL":
+                            new = self.quantize_normals(index)
+                        elif name.startswith("TEXCOORD_"):
+                            new = self.quantize_uvs(index)
+                        else:
+                            continue
+                        if new is not None:
+                            replaced[index] = attributes[name] = new
+            nodes = nodes_of.get(mesh_index, [])
+            positions = [primitive["attributes"].get("POSITION") for primitive in primitives]
+            if (
+                nodes
+                and foldable[mesh_index]
+                and all(p is not None and self._quantizable(p) for p in positions)
+                and all(users.get(p) == {mesh_index} for p in positions)
+            ):
+                self.quantize_positions(primitives, nodes)
+
+        if self.stats.attributes_quantized:
+            for key in ("extensionsUsed", "extensionsRequired"):
+                extensions = document.setdefault(key, [])
+                if "KHR_mesh_quantization" not in extensions:
+                    extensions.append("KHR_mesh_quantization")
+
+    def quantize_normals(self, index: int) -> int | None:
+        values = self.read_floats(index)
+        if not is_finite(values):
+            return None
+        out = array("h", (max(-32767, min(32767, round(v * 32767))) for v in values))
+        self.stats.attributes_quantized += 1
+        return self.add_accessor(index, out, SHORT, 3, normalized=True)
+
+    def quantize_uvs(self, index: int) -> int | None:
+        # UVs outside of [-1, 1] would need KHR_texture_transform to rescale
+        values = self.read_floats(index)
+        if not values or not is_finite(values):
+            return None
+        low, high = min(values), max(values)
+        if low >= 0 and high <= 1:
+            out = array("H", (round(v * 65535) for v in values))
+            component = UNSIGNED_SHORT
+        elif low >= -1 and high <= 1:
+            out = array("h", (round(v * 32767) for v in values))
+            component = SHORT
+        else:
+            return None
+        self.stats.attributes_quantized += 1
+        return self.add_accessor(index, out, component, 2, normalized=True)
+
+    def quantize_positions(self, primitives: list[dict[str, Any]], nodes: list[dict[str, Any]]):
+        # One offset and uniform scale for the whole mesh, so that all nodes
+        # showing it can absorb the dequantisation in their transform
+        indices = list(dict.fromkeys(p["attributes"]["POSITION"] for p in primitives))
+        data = {index: self.read_floats(index) for index in indices}
+        if not all(is_finite(values) for values in data.values()):
+            return
+        low = [
+            min(min(values[axis::3], default=0.0) for values in data.values()) for axis in range(3)
+        ]
+        high = [
+            max(max(values[axis::3], default=0.0) for values in data.values()) for axis in range(3)
+        ]
+        center = [(a + b) / 2 for a, b in zip(low, high)]
+        extent = max(b - a for a, b in zip(low, high)) / 2
+        scale = extent / 32767 if extent > 0 else 1.0
+        replaced = {}
+        for index, values in data.items():
+            out = array(
+                "h",
+                (
+                    max(-32767, min(32767, round((v - center[i % 3]) / scale)))
+                    for i, v in enumerate(values)
+                ),
+            )
+            bounds = {
+                "min": [min(out[axis::3], default=0) for axis in range(3)],
+                "max": [max(out[axis::3], default=0) for axis in range(3)],
+            }
+            replaced[index] = self.add_accessor(index, out, SHORT, 3, **bounds)
+            self.stats.attributes_quantized += 1
+        for primitive in primitives:
+            primitive["attributes"]["POSITION"] = replaced[primitive["attributes"]["POSITION"]]
+        for node in nodes:
+            fold_transform(node, center, scale)
+
+    def strip_unused(self):
+        document = self.document
+        accessors = document.get("accessors", [])
+        used_accessors = sorted({c[k] for c, k in accessor_references(document)})
+        mapping = {old: new for new, old in enumerate(used_accessors)}
+        _remap(accessor_references(document), mapping)
+        if "accessors" in document:
+            document["accessors"] = [accessors[i] for i in used_accessors]
+
+        views = document.get("bufferViews", [])
+        used_views = sorted({c[k] for c, k in view_references(document)})
+        mapping = {old: new for new, old in enumerate(used_views)}
+        _remap(view_references(document), mapping)
+        if "bufferViews" in document:
+            document["bufferViews"] = [views[i] for i in used_views]
+        self.views = [self.views[i] for i in used_views]
+
+    def layout(self) -> list[bytes | memoryview]:
+        pieces: list[bytes | memoryview] = []
+        offset = 0
+        for view, data in zip(self.document.get("bufferViews", []), self.views):
+            view["buffer"] = 0
+            view["byteOffset"] = offset
+            view["byteLength"] = len(data)
+            pieces.append(data)
+            padding = _pad(len(data))
+            if padding:
+                pieces.append(bytes(padding))
+            offset += len(data) + padding
+        if offset:
+            self.document["buffers"] = [{"byteLength": offset}]
+        else:
+            self.document.pop("buffers", None)
+        return pieces
+
+
+def unsupported(document: dict[str, Any]) -> str:
+    buffers = document.get("buffers", [])
+    if len(buffers) > 1 or any("uri" in buffer for buffer in buffers):
+        return "external buffers"
+    unknown = set(document.get("extensionsUsed", [])) - SAFE_EXTENSIONS
+    if unknown:
+        return f"unsupported extensions {sorted(unknown)}"
+    return ""
+
+
+def node_foldable(node: dict[str, Any], animated: bool = False) -> bool:
+    # Changing the transform of a node also moves its children and anything
+    # else attached to it, and an animation channel would overwrite it
+    if animated:
+        return False
+    return not any(key in node for key in ("children", "skin", "camera", "extensions", "weights"))
+
+
+def fold_transform(node: dict[str, Any], center: list[float], scale: float):
+    if "matrix" in node:
+        m = node["matrix"]
+        translation = [sum(m[4 * col + row] * center[col] for col in range(3)) for row in range(3)]
+        node["matrix"] = [v * scale for v in m[:12]] + [
+            m[12] + translation[0],
+            m[13] + translation[1],
+            m[14] + translation[2],
+            m[15],
+        ]
+        return
+    t = node.get("translation", [0.0, 0.0, 0.0])
+    r = node.get("rotation", [0.0, 0.0, 0.0, 1.0])
+    s = node.get("scale", [1.0, 1.0, 1.0])
+    offset = rotate(r, [s[i] * center[i] for i in range(3)])
+    node["translation"] = [t[i] + offset[i] for i in range(3)]
+    node["scale"] = [v * scale for v in s]
+
+
+def rotate(q: list[float], v: list[float]) -> list[float]:
+    x, y, z, w = q
+    # v + 2w(q x v) + 2q x (q x v)
+    cx, cy, cz = y * v[2] - z * v[1], z * v[0] - x * v[2], x * v[1] - y * v[0]
+    ccx, ccy, ccz = y * cz - z * cy, z * cx - x * cz, x * cy - y * cx
+    return [v[0] + 2 * (w * cx + ccx), v[1] + 2 * (w * cy + ccy), v[2] + 2 * (w * cz + ccz)]
+
+
+def optimize(data: memoryview, output: Path, quantize: bool, strip: bool) -> Stats:
+    document, binary = parse_glb(data)
+    reason = unsupported(document)
+    if reason:
+        return Stats(size_before=len(data), skipped=reason)
+    optimizer = Optimizer(document, binary)
+    stats = optimizer.stats
+    stats.size_before = len(data)
+    optimizer.dedupe_views()
+    optimizer.dedupe_accessors()
+    if quantize:
+        optimizer.quantize()
+    if strip:
+        optimizer.strip_unused()
+    pieces = optimizer.layout()
+    asset = document.setdefault("asset", {"version": "2.0"})
+    asset.setdefault("extras", {})[MARKER] = {"quantize": quantize, "strip": strip}
+    write_glb(output, document, pieces)
+    stats.size_after = output.stat().st_size
+    return stats
+
+
+def optimize_file(path: Path, quantize: bool = False, strip: bool = True) -> Stats:
+    # The result is written next to the original and renamed over it once the
+    # mapping of the original is closed
+    options = {"quantize": quantize, "strip": strip}
+    extras = read_document(path).get("asset", {}).get("extras", {})
+    if extras.get(MARKER) == options:
+        return Stats(skipped=ALREADY_OPTIMISED)
+    temp = path.with_name(path.name + ".tmp")
+    error = None
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            with memoryview(mapped) as data:
+                try:
+                    stats = optimize(data, temp, quantize, strip)
+                except Exception as e:
+                    # The frames of the traceback hold slices of the mapping,
+                    # closing it would fail and hide the error
+                    error = detach(e)
+        if error:
+            raise error
+        if not stats.skipped:
+            os.replace(temp, path)
+    except BaseException:
+        temp.unlink(missing_ok=True)
+        raise
+    return stats
+
+
+def detach(error: BaseException) -> BaseException:
+    # Drops the tracebacks of an exception and of those it was raised from
+    chained: BaseException | None = error
+    while chained is not None:
+        chained.__traceback__ = None
+        chained = chained.__cause__ or chained.__context__
+    return error
+
+
+def is_finite(values: array) -> bool:
+    return all(math.isfinite(v) for v in values)
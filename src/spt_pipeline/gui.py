@@ -7,26 +7,90 @@
 import logging
 import os
 import queue
+import time
 import tkinter as tk
 from pathlib import Path
 from threading import Thread
-from tkinter import filedialog, messagebox, scrolledtext
-
+from tkinter import filedialog, messagebox, scrolledtext, ttk
+
+from spt_pipeline.cancel import CancelScope
+from spt_pipeline.events import (
+    DONE,
+    FAILED,
+    PROGRESS,
+    QUEUED,
+    RUNNING,
+    UP_TO_DATE,
+    Event,
+    Events,
+)
 from spt_pipeline.main import main
-from spt_pipeline.utils import get_manifest, format_paths, RESOURCE_DIR
+from spt_pipeline.utils import RESOURCE_DIR, format_paths, get_manifest
+
+# The log and the progress panel are redrawn from the Tk main loop on a timer,
+# a redraw per record froze the window when several conversions were logging.
+REFRESH_MS = 100
+MAX_LOG_LINES = 5000
 
 
 class GuiLogHandler(logging.Handler):
-    def __init__(self, root):
+    def __init__(self):
         super().__init__()
-        self.root = root
         self.queue = queue.Queue()
 
     def emit(self, record):
         msg = self.format(record)
         level = record.levelname
         self.queue.put((level, msg))
-        self.root.event_generate("<<NewLog>>")
+
+
+# Per-asset state of the import, updated from processor events
+class Progress:
+    def __init__(self):
+        self.states: dict[str, str] = {}
+        self.steps: dict[str, str] = {}
+        self.started: float | None = None
+        self.finished = 0
+
+    def update(self, event: Event) -> bool:
+        # Returns whether the item gained a row
+        new = event.item not in self.states
+        state = self.states.setdefault(event.item, QUEUED)
+        if event.state == PROGRESS:
+            self.steps[event.item] = f"{event.done}/{event.total}"
+            return new
+        if event.state == RUNNING:
+            if self.started is None:
+                self.started = event.time
+            if event.action:
+                self.steps[event.item] = event.action
+        if event.state == DONE and state in (FAILED, UP_TO_DATE):
+            # The chain of a failed or skipped item still finishes
+            return new
+        if event.state in (DONE, FAILED) and state == RUNNING:
+            self.finished += 1
+        self.states[event.item] = event.state
+        return new
+
+    def counts(self) -> dict[str, int]:
+        counts = dict.fromkeys((QUEUED, RUNNING, DONE, FAILED, UP_TO_DATE), 0)
+        for state in self.states.values():
+            counts[state] += 1
+        return counts
+
+    def summary(self) -> str:
+        counts = self.counts()
+        text = ", ".join(f"{count} {state}" for state, count in counts.items())
+        if self.started is None or not self.finished:
+            return text
+        elapsed = time.monotonic() - self.started
+        rate = self.finished / elapsed * 60
+        text += f" | {rate:.1f} assets/min"
+        remaining = counts[QUEUED] + counts[RUNNING]
+        if remaining:
+            eta = remaining / rate * 60
+            text += f" | ETA {int(eta // 60)}:{int(eta % 60):02d}"
+        return text
 
 
 class PathSelector:
@@ -42,10 +106,17 @@ class PathSelector:
 
         self.install_blender = tk.BooleanVar(value=False)
 
+        self.thread: Thread | None = None
+        self.scope = CancelScope()
+        self.events: queue.Queue[Event] = queue.Queue()
+        self.progress = Progress()
+
         self.logger = logging.getLogger(__name__)
 
         self.create_widgets()
         self.setup_logging()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.root.after(REFRESH_MS, self.refresh)
 
     def create_widgets(self):
         input_group = tk.LabelFrame(self.root, text="Configuration", padx=10, pady=10)
@@ -80,6 +151,21 @@ class PathSelector:
             input_group, text="Browse...", command=lambda: self.directory_dialog(self.game_path)
         ).grid(row=1, column=2, padx=10)
 
+        progress_label = tk.Label(self.root, text="Progress", font=("Arial", 10, "bold"))
+        progress_label.pack(anchor="w", padx=20, pady=(10, 0))
+
+        self.summary = tk.Label(self.root, text="", anchor="w")
+        self.summary.pack(fill="x", padx=20)
+
+        self.jobs = ttk.Treeview(self.root, columns=("state", "step"), height=6)
+        self.jobs.heading("#0", text="Asset", anchor="w")
+        self.jobs.heading("state", text="State", anchor="w")
+        self.jobs.heading("step", text="Step", anchor="w")
+        self.jobs.column("#0", width=360)
+        self.jobs.column("state", width=90)
+        self.jobs.column("step", width=120)
+        self.jobs.pack(fill="both", expand=True, padx=20, pady=5)
+
         log_label = tk.Label(self.root, text="Logs", font=("Arial", 10, "bold"))
         log_label.pack(anchor="w", padx=20, pady=(10, 0))
 
@@ -124,6 +210,11 @@ class PathSelector:
         file = open(pipeline_path, "r", encoding="utf-8")
         paths = self.paths
         paths["blender"] = Path(self.blender_exe.get())
+        self.scope = CancelScope()
+        events = Events()
+        events.subscribe(self.events.put)
+        self.progress = Progress()
+        self.jobs.delete(*self.jobs.get_children())
         self.thread = Thread(
             target=main,
             kwargs={
@@ -131,32 +222,75 @@ class PathSelector:
                 "file": file,
                 "blender_install": self.install_blender.get(),
                 "paths": paths,
+                "scope": self.scope,
+                "events": events,
             },
         )
         self.thread.start()
 
+    def on_close(self):
+        if self.thread and self.thread.is_alive():
+            if not self.scope.cancelled:
+                self.logger.warning("Cancelling the import")
+                self.scope.cancel("window closed")
+            # The log handler needs the window until the import has stopped
+            self.root.after(100, self.on_close)
+            return
+        self.root.destroy()
+
     def setup_logging(self):
         self.logger = logging.getLogger()
         self.logger.setLevel(logging.INFO)
 
-        handler = GuiLogHandler(self.root)
+        handler = GuiLogHandler()
         formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s", "%H:%M:%S")
         handler.setFormatter(formatter)
         self.logger.addHandler(handler)
 
         self.gui_handler = handler
-        self.root.bind("<<NewLog>>", self.handle_new_log)
-
-    def handle_new_log(self, event):
-        try:
-            while True:
-                lvl, msg = self.gui_handler.queue.get(block=False)
-                self.log_display.configure(state="normal")
-                self.log_display.insert(tk.END, msg + "\n", lvl)
-                self.log_display.configure(state="disabled")
-                self.log_display.yview(tk.END)  # Auto-scroll to bottom
-        except queue.Empty:
-            pass
+
+    def refresh(self):
+        self.show_logs()
+        self.show_progress()
+        self.root.after(REFRESH_MS, self.refresh)
+
+    def show_logs(self):
+        records = drain(self.gui_handler.queue)
+        if not records:
+            return
+        # Older lines of a long batch would be trimmed right away
+        records = records[-MAX_LOG_LINES:]
+        self.log_display.configure(state="normal")
+        for lvl, msg in records:
+            self.log_display.insert(tk.END, msg + "\n", lvl)
+        lines = int(self.log_display.index("end-1c").split(".")[0]) - 1
+        if lines > MAX_LOG_LINES:
+            self.log_display.delete("1.0", f"{lines - MAX_LOG_LINES + 1}.0")
+        self.log_display.configure(state="disabled")
+        self.log_display.yview(tk.END)  # Auto-scroll to bottom
+
+    def show_progress(self):
+        events = drain(self.events)
+        if self.progress.started is None and not events:
+            return
+        changed = set()
+        for event in events:
+            if self.progress.update(event):
+                self.jobs.insert("", tk.END, iid=event.item, text=event.item)
+            changed.add(event.item)
+        for item in changed:
+            state = self.progress.states.get(item, "")
+            self.jobs.item(item, values=(state, self.progress.steps.get(item, "")))
+        self.summary.configure(text=self.progress.summary())
+
+
+def drain(items: queue.Queue) -> list:
+    drained = []
+    try:
+        while True:
+            drained.append(items.get(block=False))
+    except queue.Empty:
+        return drained
 
 
 if __name__ == "__main__":
@@ -0,0 +1,118 @@
+#
+# Copyright (c) 2024 Rafał Kuźnia <rafal.kuznia@protonmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+import errno
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from fnmatch import fnmatchcase
+from pathlib import Path
+from typing import Iterator
+
+logger = logging.getLogger(__name__)
+
+# A cached listing is trusted for this many seconds before the directory's
+# mtime is checked again
+REVALIDATE_INTERVAL = 2.0
+
+
+@dataclass
+class Listing:
+    mtime_ns: int
+    checked: float
+    entries: dict[str, tuple[str, bool]] = field(default_factory=dict)
+
+
+# Case-folded index of a directory tree. Every directory is listed with a
+# single os.scandir call the first time it is needed, and the listing is shared
+# by all lookups and scans during the run. Listings are re-read when the
+# directory's modification time changes.
+class DirectoryIndex:
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.listings: dict[Path, Listing] = {}
+        self.lock = threading.Lock()
+
+    def _scan(self, directory: Path) -> Listing:
+        entries = {}
+        with os.scandir(directory) as it:
+            mtime_ns = os.stat(directory).st_mtime_ns
+            for entry in it:
+                try:
+                    # Like rglob, symlinked directories are not descended
+                    # into, a link back up the tree would never end
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    is_dir = False
+                entries[entry.name.casefold()] = (entry.name, is_dir)
+        return Listing(mtime_ns=mtime_ns, checked=time.monotonic(), entries=entries)
+
+    def listdir(self, directory: Path) -> dict[str, tuple[str, bool]]:
+        with self.lock:
+            listing = self.listings.get(directory)
+        now = time.monotonic()
+        if listing and now - listing.checked > REVALIDATE_INTERVAL:
+            try:
+                if os.stat(directory).st_mtime_ns == listing.mtime_ns:
+                    listing.checked = now
+                else:
+                    logger.debug(f"{directory} changed, rescanning")
+                    listing = None
+            except FileNotFoundError:
+                listing = None
+        if listing is None:
+            listing = self._scan(directory)
+            with self.lock:
+                self.listings[directory] = listing
+        return listing.entries
+
+    def invalidate(self, directory: Path | None = None):
+        with self.lock:
+            if directory is None:
+                self.listings.clear()
+            else:
+                self.listings.pop(directory, None)
+
+    def resolve(self, target: Path) -> Path:
+        target = Path(target)
+        try:
+            relative = target.relative_to(self.root)
+        except ValueError:
+            raise ValueError("Invalid argument: stem is not a prefix of path") from None
+        current = self.root
+        for part in relative.parts:
+            try:
+                entry = self.listdir(current).get(part.casefold())
+            except (FileNotFoundError, NotADirectoryError):
+                entry = None
+            if entry is None:
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), str(target))
+            current = current / entry[0]
+        return current
+
+    def walk(self, directory: Path) -> Iterator[tuple[Path, bool]]:
+        pending = [directory]
+        while pending:
+            current = pending.pop()
+            for name, is_dir in sorted(self.listdir(current).values()):
+                path = current / name
+                yield path, is_dir
+                if is_dir:
+                    pending.append(path)
+
+    def glob(self, directory: Path, pattern: str) -> Iterator[Path]:
+        # Same matches as Path.rglob(pattern, case_sensitive=False)
+        parts = [part.casefold() for part in Path(pattern).parts]
+        depth = len(directory.parts)
+        for path, _ in self.walk(directory):
+            relative = path.parts[depth:]
+            if len(relative) < len(parts):
+                continue
+            tail = relative[len(relative) - len(parts) :]
+            if all(fnmatchcase(name.casefold(), part) for name, part in zip(tail, parts)):
+                yield path
@@ -7,17 +7,51 @@
 import logging
 import os
 import subprocess
-from sys import version
-import time
+import sys
+from concurrent.futures import Executor
 from pathlib import Path
 from typing import TextIO
 
 import click
-from yaml import safe_load
 
-from spt_pipeline.dsl import Root
+from spt_pipeline.addon import (
+    AddonError,
+    AddonStamp,
+    extension_manifests,
+    installed_manifest,
+    wait_for_install,
+)
+from spt_pipeline.artifacts import DEFAULT_STORE_SIZE, open_store
+from spt_pipeline.blender_pool import BlenderPool
+from spt_pipeline.cache import BuildCache, PlanCache
+from spt_pipeline.cancel import Cancelled, CancelScope, set_cancel_scope
+from spt_pipeline.concurrency import ConcurrencyPolicy, MiB
+from spt_pipeline.distributed import Coordinator, parse_address
+from spt_pipeline.dsl import OptimizeGLB, uses_action
+from spt_pipeline.events import Events, set_events
+from spt_pipeline.metrics import (
+    Metrics,
+    MetricsServer,
+    MetricsWriter,
+    get_metrics,
+    set_metrics,
+)
+from spt_pipeline.node import serve
+from spt_pipeline.planner import CostModel, Planner
 from spt_pipeline.processor import PipelineProcessor
-from spt_pipeline.utils import run_process, get_manifest, format_paths, run_winget
+from spt_pipeline.retry import DEFAULT_RETRIES, DEFAULT_TIMEOUTS, RetryPolicy
+from spt_pipeline.tracing import Tracer, set_tracer
+from spt_pipeline.utils import (
+    CACHE_DIR,
+    format_paths,
+    get_manifest,
+    run_process,
+    run_winget,
+    user_cache_dir,
+)
+from spt_pipeline.watch import watch as watch_sources
+
+ADDON_INSTALL_TIMEOUT = 30
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -26,13 +60,261 @@ ch.setLevel(logging.INFO)
 logger.addHandler(ch)
 
 
+def parse_limits(ctx, param, values: tuple[str, ...]) -> dict[str, int]:
+    limits = {}
+    for value in values:
+        kind, _, count = value.partition("=")
+        if not count.isdigit() or int(count) < 1:
+            raise click.BadParameter(f"Expected KIND=N, got {value!r}")
+        limits[kind] = int(count)
+    return limits
+
+
+def parse_timeouts(ctx, param, values: tuple[str, ...]) -> dict[str, float | None]:
+    timeouts: dict[str, float | None] = {}
+    for value in values:
+        kind, _, seconds = value.rpartition("=")
+        try:
+            timeout = float(seconds)
+        except ValueError:
+            raise click.BadParameter(f"Expected [KIND=]SECONDS, got {value!r}")
+        for key in [kind] if kind else DEFAULT_TIMEOUTS:
+            timeouts[key] = timeout or None
+    return timeouts
+
+
+def parse_listen(ctx, param, value: str | None) -> tuple[str, int] | None:
+    if value is None:
+        return None
+    try:
+        return parse_address(value if ":" in value else f":{value}")
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def parse_coordinator(ctx, param, value: str) -> tuple[str, int]:
+    try:
+        host, port = parse_address(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    return host or "localhost", port
+
+
 @click.command()
 @click.option("--source", "-s", type=click.Path(path_type=Path))
 @click.option("--destination", "-d", type=click.Path(path_type=Path))
 @click.option("--blender", "-b", type=click.Path(path_type=Path))
 @click.option("--ffmpeg", "-f", type=click.Path(path_type=Path))
+@click.option(
+    "--blender-workers",
+    type=click.IntRange(min=0),
+    default=0,
+    help="Number of persistent Blender worker processes (0 = one Blender per asset)",
+)
+@click.option("--cache/--no-cache", default=True, help="Skip conversions that are up to date")
+@click.option(
+    "--hash-contents",
+    is_flag=True,
+    help="Fingerprint inputs by content instead of size and modification time",
+)
+@click.option(
+    "--artifacts",
+    metavar="DIR|URL",
+    help="Share conversion outputs through this artifact store, a directory (local or on a"
+    " shared file system) or an HTTP server such as tools/artifact_server.py",
+)
+@click.option(
+    "--artifacts-size",
+    type=click.IntRange(min=1),
+    help="Size in MiB above which the least recently used artifacts are evicted from a"
+    f" directory store (default: {DEFAULT_STORE_SIZE // MiB})",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=1),
+    help="Number of concurrently scheduled jobs (default: number of CPUs)",
+)
+@click.option(
+    "--memory-budget",
+    type=click.IntRange(min=1),
+    help="Memory in MiB that concurrent Blender/Godot processes may use (default: 80% of available)",
+)
+@click.option(
+    "--limit",
+    "limits",
+    multiple=True,
+    callback=parse_limits,
+    metavar="KIND=N",
+    help="Maximum concurrent jobs of a kind (track, car, godot)",
+)
+@click.option(
+    "--trace",
+    type=click.Path(dir_okay=False, writable=True, path_type=Path),
+    help="Write a Chrome trace of the run to this file and log a timing summary",
+)
+@click.option(
+    "--reinstall-addon",
+    is_flag=True,
+    help="Install the speedtools addon even if the same version is already installed",
+)
+@click.option(
+    "--plan",
+    is_flag=True,
+    help="List the jobs the pipeline would run with predicted durations, then exit",
+)
+@click.option(
+    "--timeout",
+    "timeouts",
+    multiple=True,
+    callback=parse_timeouts,
+    metavar="[KIND=]SECONDS",
+    help="Kill a track, car or godot job running longer than this (0 = no limit)."
+    " Without KIND= it applies to all kinds",
+)
+@click.option(
+    "--retries",
+    type=click.IntRange(min=0),
+    default=DEFAULT_RETRIES,
+    show_default=True,
+    help="Times a crashed job is retried. Timed out jobs are not retried",
+)
+@click.option(
+    "--listen",
+    callback=parse_listen,
+    metavar="[HOST:]PORT",
+    help="Send Blender conversions to build nodes (spt-worker) connecting on this address."
+    " Use --jobs to set how many conversions may be in flight",
+)
+@click.option(
+    "--metrics",
+    callback=parse_listen,
+    metavar="[HOST:]PORT",
+    help="Serve live job, process and throughput metrics in the Prometheus format on this"
+    " address (localhost unless HOST is given)",
+)
+@click.option(
+    "--metrics-file",
+    type=click.Path(dir_okay=False, writable=True, path_type=Path),
+    help="Rewrite this file with the metrics in the Prometheus format every few seconds",
+)
+@click.option(
+    "--watch",
+    is_flag=True,
+    help="After the run, keep converting the tracks and cars whose files change until Ctrl-C",
+)
 @click.argument("file", type=click.File())
-def run(source: Path, destination: Path, blender: Path, ffmpeg: Path, file: TextIO) -> None:
+def run(
+    source: Path,
+    destination: Path,
+    blender: Path,
+    ffmpeg: Path,
+    blender_workers: int,
+    cache: bool,
+    hash_contents: bool,
+    artifacts: str | None,
+    artifacts_size: int | None,
+    jobs: int | None,
+    memory_budget: int | None,
+    limits: dict[str, int],
+    trace: Path | None,
+    reinstall_addon: bool,
+    plan: bool,
+    timeouts: dict[str, float | None],
+    retries: int,
+    listen: tuple[str, int] | None,
+    metrics: tuple[str, int] | None,
+    metrics_file: Path | None,
+    watch: bool,
+    file: TextIO,
+) -> None:
+    manifest = get_manifest()
+    paths = format_paths(manifest)
+
+    if blender:
+        paths["blender"] = blender
+
+    if ffmpeg:
+        paths["ffmpeg"] = ffmpeg
+
+    succeeded = main(
+        source=source,
+        file=file,
+        paths=paths,
+        blender_workers=blender_workers,
+        use_cache=cache,
+        hash_contents=hash_contents,
+        artifacts=artifacts,
+        artifacts_size=artifacts_size * MiB if artifacts_size else DEFAULT_STORE_SIZE,
+        policy=ConcurrencyPolicy(
+            workers=jobs,
+            memory_budget=memory_budget * MiB if memory_budget else None,
+            limits=limits,
+        ),
+        trace=trace,
+        reinstall_addon=reinstall_addon,
+        plan=plan,
+        listen=listen,
+        retry=RetryPolicy(retries=retries, timeouts=timeouts),
+        metrics=metrics,
+        metrics_file=metrics_file,
+        watch=watch,
+    )
+    if not succeeded:
+        sys.exit(1)
+
+
+@click.command()
+@click.option("--blender", "-b", type=click.Path(path_type=Path))
+@click.option("--ffmpeg", "-f", type=click.Path(path_type=Path))
+@click.option(
+    "--blender-workers",
+    type=click.IntRange(min=0),
+    default=0,
+    help="Number of persistent Blender worker processes (0 = one Blender per asset)",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=1),
+    help="Number of conversions run at once (default: number of CPUs)",
+)
+@click.option(
+    "--memory-budget",
+    type=click.IntRange(min=1),
+    help="Memory in MiB that concurrent Blender processes may use (default: 80% of available)",
+)
+@click.option(
+    "--limit",
+    "limits",
+    multiple=True,
+    callback=parse_limits,
+    metavar="KIND=N",
+    help="Maximum concurrent jobs of a kind (track, car)",
+)
+@click.option(
+    "--reinstall-addon",
+    is_flag=True,
+    help="Install the speedtools addon even if the same version is already installed",
+)
+@click.option(
+    "--metrics",
+    callback=parse_listen,
+    metavar="[HOST:]PORT",
+    help="Serve live process metrics in the Prometheus format on this address",
+)
+@click.argument("coordinator", callback=parse_coordinator, metavar="HOST:PORT")
+def worker(
+    blender: Path,
+    ffmpeg: Path,
+    blender_workers: int,
+    jobs: int | None,
+    memory_budget: int | None,
+    limits: dict[str, int],
+    reinstall_addon: bool,
+    metrics: tuple[str, int] | None,
+    coordinator: tuple[str, int],
+) -> None:
     manifest = get_manifest()
     paths = format_paths(manifest)
 
@@ -42,10 +324,41 @@ def run(source: Path, destination: Path, blender: Path, ffmpeg: Path, file: Text
     if ffmpeg:
         paths["ffmpeg"] = ffmpeg
 
-    main(source=source, file=file, paths=paths)
+    try:
+        install_addon(
+            blender=paths["blender"],
+            addon_path=paths["speedtools"],
+            version=manifest["speedtools"],
+            force=reinstall_addon,
+        )
+    except (AddonError, subprocess.CalledProcessError) as e:
+        logger.error(str(e))
+        sys.exit(1)
+    policy = ConcurrencyPolicy(
+        workers=jobs,
+        memory_budget=memory_budget * MiB if memory_budget else None,
+        limits=limits,
+    )
+    blender_pool = BlenderPool(paths, size=blender_workers) if blender_workers else None
+    metrics_server = None
+    if metrics:
+        set_metrics(Metrics())
+        metrics_server = MetricsServer(metrics, get_metrics())
+    try:
+        serve(coordinator, paths, policy, blender_pool)
+    finally:
+        if blender_pool:
+            blender_pool.close()
+        if metrics_server:
+            metrics_server.close()
 
 
-def install_addon(blender: Path, addon_path: Path):
+def install_addon(blender: Path, addon_path: Path, version: str, force: bool = False):
+    stamp = AddonStamp(CACHE_DIR / "speedtools.json", blender, addon_path, version)
+    if not force and stamp.is_current():
+        logger.info(f"Addon {addon_path} is already installed")
+        return
+    stamp.clear()
     logger.info(f"Installing addon {addon_path}")
     try:
         run_process(
@@ -60,7 +373,16 @@ def install_addon(blender: Path, addon_path: Path):
                 addon_path,
             ]
         )
-        time.sleep(3)  # Apparently needed for Blender to finish installation
+        # Blender may return before the extension is fully unpacked. That is
+        # only waited for where another speedtools install shows that Blender
+        # keeps its extensions in the usual place, portable, snap and flatpak
+        # builds keep them elsewhere.
+        manifest = installed_manifest(version)
+        if not manifest and extension_manifests():
+            manifest = wait_for_install(version, timeout=ADDON_INSTALL_TIMEOUT)
+            if not manifest:
+                logger.warning(f"Could not find the manifest of speedtools {version}")
+        stamp.record(manifest)
         logger.info("Addon installed successfuly")
     except subprocess.CalledProcessError as e:
         logger.error("Addon installation failed")
@@ -82,26 +404,136 @@ def main(
     file: TextIO,
     paths: dict[str, Path],
     blender_install: bool = False,
-) -> None:
+    blender_workers: int = 0,
+    use_cache: bool = True,
+    hash_contents: bool = False,
+    artifacts: str | None = None,
+    artifacts_size: int = DEFAULT_STORE_SIZE,
+    policy: ConcurrencyPolicy | None = None,
+    trace: Path | None = None,
+    reinstall_addon: bool = False,
+    plan: bool = False,
+    listen: tuple[str, int] | None = None,
+    retry: RetryPolicy | None = None,
+    scope: CancelScope | None = None,
+    events: Events | None = None,
+    metrics: tuple[str, int] | None = None,
+    metrics_file: Path | None = None,
+    watch: bool = False,
+) -> bool:
     logger.info("Installation started")
     manifest = get_manifest()
-    paths = format_paths(manifest)
     destination = Path(".")
+    policy = policy if policy else ConcurrencyPolicy()
+    retry = retry if retry else RetryPolicy()
+    tracer = Tracer(enabled=trace is not None)
+    set_tracer(tracer)
+    # Cancelling the scope (Ctrl-C, closing the GUI) kills the running children
+    set_cancel_scope(scope if scope else CancelScope())
+    set_events(events if events else Events())
+    set_metrics(Metrics(enabled=bool(metrics or metrics_file)))
+    blender_pool: BlenderPool | Coordinator | None = None
+    if listen and not plan:
+        blender_pool = Coordinator(listen)
+    elif blender_workers:
+        blender_pool = BlenderPool(paths, size=blender_workers)
+    build_cache = None
+    if use_cache:
+        build_cache = BuildCache(
+            destination / CACHE_DIR / "build.json", manifest, hash_contents=hash_contents
+        )
+    store = open_store(artifacts, manifest, artifacts_size) if artifacts else None
+    cost_model = CostModel(destination / CACHE_DIR / "timings.json")
+    process_pool: Executor | None = None
+    metrics_server = MetricsServer(metrics, get_metrics()) if metrics and not plan else None
+    metrics_writer = (
+        MetricsWriter(metrics_file, get_metrics()) if metrics_file and not plan else None
+    )
     try:
+        config = PlanCache(user_cache_dir() / "plans").load(file.read())
+        logger.debug(config)
+        if uses_action(config.pipelines, OptimizeGLB):
+            # GLB optimisation is pure Python and CPU bound. Worker processes are
+            # only started once the first OptimizeGLB action runs.
+            from concurrent.futures import ProcessPoolExecutor
+            from multiprocessing import get_context
+
+            process_pool = ProcessPoolExecutor(policy.workers, mp_context=get_context("spawn"))
+        processor = PipelineProcessor(
+            source=source,
+            destination=destination,
+            paths=paths,
+            blender_pool=blender_pool,
+            build_cache=build_cache,
+            artifacts=store,
+            policy=policy,
+            cost_model=cost_model,
+            retry=retry,
+            process_pool=process_pool,
+        )
+        if plan:
+            planner = Planner(processor, cost_model)
+            logger.info(planner.report(config.pipelines, workers=policy.workers))
+            return True
+
         if blender_install:
             install_blender()
 
-        install_addon(blender=paths["blender"], addon_path=paths["speedtools"])
+        install_addon(
+            blender=paths["blender"],
+            addon_path=paths["speedtools"],
+            version=manifest["speedtools"],
+            force=reinstall_addon,
+        )
 
-        data = safe_load(file)
-        config = Root.from_dict(data)
-        logger.debug(config)
-        processor = PipelineProcessor(source=source, destination=destination, paths=paths)
         processor.run_actions(config.pipelines)
+        if watch:
+            if retry.failures:
+                logger.error(retry.summary())
+                retry.clear()
+
+            def save():
+                if build_cache:
+                    build_cache.save()
+                cost_model.save()
+
+            watch_sources(processor, config.pipelines, on_rerun=save)
+            return True
+        if retry.failures:
+            logger.error(retry.summary())
+            return False
         logger.info("Success. You can now close the window.")
+        return True
+    except Cancelled as e:
+        logger.error(f"Import cancelled: {e}")
+        return False
+    except AddonError as e:
+        logger.error(str(e))
+        return False
+    except KeyboardInterrupt:
+        logger.error("Import interrupted")
+        return False
     except Exception as ex:
         logger.error("Import failed")
         logger.exception(ex)
         raise
     finally:
+        if metrics_server:
+            metrics_server.close()
+        if metrics_writer:
+            metrics_writer.close()
+        if process_pool:
+            process_pool.shutdown()
+        if blender_pool:
+            blender_pool.close()
+        if build_cache and not plan:
+            build_cache.save()
+            build_cache.report()
+        if store and not plan:
+            store.report()
+        if not plan:
+            cost_model.save()
+        if trace:
+            tracer.export_chrome(trace)
+            logger.info(tracer.summary(workers=policy.workers))
         logger.debug("Clearing temporary files")
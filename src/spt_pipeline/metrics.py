@@ -0,0 +1,189 @@
+#
+# Copyright (c) 2024 Rafał Kuźnia <rafal.kuznia@protonmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+logger = logging.getLogger(__name__)
+
+METRICS_INTERVAL = 5.0
+# Seconds, from GodotPostprocess batches up to the longest track conversions
+DURATION_BUCKETS = (0.1, 1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+
+# Name: (type, help) of everything the pipeline reports
+METRICS = {
+    "spt_jobs_queued": ("gauge", "Jobs waiting for their dependencies or a worker thread"),
+    "spt_jobs_running": ("gauge", "Jobs running on a worker thread"),
+    "spt_jobs_total": ("counter", "Finished jobs by status (done, failed, cancelled)"),
+    "spt_job_duration_seconds": ("histogram", "Time jobs spent running"),
+    "spt_processes_running": ("gauge", "Blender and Godot processes working on a job"),
+    "spt_glb_bytes_written_total": ("counter", "Bytes of GLB files written"),
+}
+
+Labels = tuple[tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+# Live counters of the run, rendered in the Prometheus text format. Like the
+# tracer, a disabled instance makes every update a no-op.
+class Metrics:
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.values: dict[str, dict[Labels, float]] = {}
+        self.histograms: dict[str, dict[Labels, Histogram]] = {}
+        self.lock = threading.Lock()
+
+    def add(self, name: str, value: float = 1, **labels):
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            values = self.values.setdefault(name, {})
+            values[key] = values.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            histograms = self.histograms.setdefault(name, {})
+            histograms.setdefault(key, Histogram()).observe(value)
+
+    @contextmanager
+    def inflight(self, name: str, **labels) -> Iterator[None]:
+        self.add(name, 1, **labels)
+        try:
+            yield
+        finally:
+            self.add(name, -1, **labels)
+
+    def render(self) -> str:
+        with self.lock:
+            lines = []
+            for name, (kind, help) in METRICS.items():
+                lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+                for labels, value in sorted(self.values.get(name, {}).items()):
+                    lines.append(f"{name}{_labels(labels)} {value:g}")
+                for labels, histogram in sorted(self.histograms.get(name, {}).items()):
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        bucket = labels + (("le", f"{bound:g}"),)
+                        lines.append(f"{name}_bucket{_labels(bucket)} {count}")
+                    bucket = labels + (("le", "+Inf"),)
+                    lines.append(f"{name}_bucket{_labels(bucket)} {histogram.count}")
+                    lines.append(f"{name}_sum{_labels(labels)} {histogram.sum:g}")
+                    lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: Path):
+        # Replaced atomically so that a collector never reads half a file
+        temporary = path.with_name(f".{path.name}.tmp")
+        with open(temporary, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(temporary, path)
+
+
+def _labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (key, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+# Serves /metrics on a local port for the whole run
+class MetricsServer:
+    def __init__(self, address: tuple[str, int], metrics: Metrics):
+        # Only runs that serve metrics pay for importing http.server
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(f"Metrics request: {format % args}")
+
+        # Without a host only this machine can scrape the run
+        host, port = address
+        self.server = ThreadingHTTPServer((host or "localhost", port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, name="metrics", daemon=True
+        )
+        self.thread.start()
+        host, port = self.server.server_address[:2]
+        logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# Rewrites a metrics file every interval, e.g. for the node exporter textfile
+# collector, and once more when the run ends
+class MetricsWriter:
+    def __init__(self, path: Path, metrics: Metrics, interval: float = METRICS_INTERVAL):
+        self.path = path
+        self.metrics = metrics
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._loop, name="metrics", daemon=True)
+        self.thread.start()
+
+    def _loop(self):
+        while not self.stopped.wait(self.interval):
+            self._write()
+
+    def _write(self):
+        try:
+            self.metrics.write(self.path)
+        except OSError as e:
+            logger.warning(f"Could not write metrics to {self.path}: {e}")
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self._write()
+
+
+_metrics = Metrics(enabled=False)
+
+
+def get_metrics() -> Metrics:
+    return _metrics
+
+
+def set_metrics(metrics: Metrics):
+    global _metrics
+    _metrics = metrics
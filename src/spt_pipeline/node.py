@@ -0,0 +1,197 @@
+#
+# Copyright (c) 2024 Rafał Kuźnia <rafal.kuznia@protonmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+# Build node for distributed builds. Connects to a coordinator (see
+# distributed.py), runs the Blender conversions it is sent in a scratch
+# directory and ships the outputs back. The node reconnects if the connection
+# drops and exits when the coordinator says so.
+
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
+from typing import Any
+
+from spt_pipeline.blender_pool import BlenderPool
+from spt_pipeline.cancel import Cancelled, CancelScope, set_cancel_scope
+from spt_pipeline.concurrency import ConcurrencyPolicy
+from spt_pipeline.distributed import (
+    HEARTBEAT_INTERVAL,
+    JOB_DIR,
+    ProtocolError,
+    pack_directory,
+    read_message,
+    send_message,
+)
+from spt_pipeline.processor import PipelineProcessor
+from spt_pipeline.retry import JobFailed, JobTimeout
+
+logger = logging.getLogger(__name__)
+
+RECONNECT_DELAY = 5.0
+
+
+class JobLog(logging.Handler):
+    # Collects the records logged by the thread running a job. Blender output
+    # is logged from reader threads at debug level and is not forwarded; the
+    # tail of it is part of the error records when a conversion fails.
+    def __init__(self):
+        super().__init__(logging.INFO)
+        self.thread = threading.get_ident()
+        self.records: list[tuple[int, str]] = []
+
+    def emit(self, record: logging.LogRecord):
+        if record.thread == self.thread:
+            self.records.append((record.levelno, record.getMessage()))
+
+
+class NodeProcessor(PipelineProcessor):
+    def __init__(self, session: "Session", job: int, **kwargs):
+        super().__init__(**kwargs)
+        self.session = session
+        self.job = job
+
+    def report_progress(self, done, total):
+        self.session.send({"type": "progress", "job": self.job, "done": done, "total": total})
+
+
+class Session:
+    def __init__(
+        self,
+        sock: socket.socket,
+        paths: dict[str, Path],
+        policy: ConcurrencyPolicy,
+        blender_pool: BlenderPool | None,
+    ):
+        self.sock = sock
+        self.paths = paths
+        self.policy = policy
+        self.blender_pool = blender_pool
+        self.send_lock = threading.Lock()
+        self.closed = threading.Event()
+
+    def send(self, header: dict[str, Any], blobs: list[bytes] = []):
+        with self.send_lock:
+            try:
+                send_message(self.sock, header, blobs)
+            except OSError as e:
+                logger.debug(f"Could not send {header['type']}: {e}")
+
+    def _heartbeat(self):
+        while not self.closed.wait(HEARTBEAT_INTERVAL):
+            self.send({"type": "heartbeat"})
+
+    def serve(self, name: str) -> bool:
+        # Jobs still running when the session ends are killed. The coordinator
+        # reassigns the jobs of a lost node, and has no use for them on exit.
+        scope = CancelScope()
+        set_cancel_scope(scope)
+        self.send({"type": "hello", "name": name, "slots": self.policy.workers})
+        threading.Thread(target=self._heartbeat, daemon=True).start()
+        stream = self.sock.makefile("rb")
+        try:
+            with ThreadPoolExecutor(self.policy.workers) as executor:
+                try:
+                    while message := read_message(stream):
+                        header, blobs = message
+                        if header["type"] == "exit":
+                            return True
+                        if header["type"] == "job":
+                            executor.submit(self.run_job, header, blobs)
+                finally:
+                    scope.cancel("session ended")
+        except (OSError, ProtocolError) as e:
+            logger.warning(f"Connection to coordinator lost: {e}")
+        finally:
+            self.closed.set()
+            self.sock.close()
+        return False
+
+    def run_job(self, header: dict[str, Any], blobs: list[bytes]):
+        job = header["job"]
+        handler = JobLog()
+        logging.getLogger().addHandler(handler)
+        try:
+            with tempfile.TemporaryDirectory(prefix="spt-job-") as temp:
+                directory = Path(temp)
+                unpack(directory / "input", header["inputs"], blobs)
+                args = substitute(header["args"], temp)
+                logger.info(f"Running {header['script']} job {job}")
+                processor = NodeProcessor(
+                    self,
+                    job,
+                    source=directory,
+                    destination=directory,
+                    path=Path(args["input"]),
+                    paths=self.paths,
+                    blender_pool=self.blender_pool,
+                    policy=self.policy,
+                )
+                seconds = processor.run_blender(header["script"], header.get("timeout"), **args)
+                # Outputs may be directories, e.g. the chunks of a track
+                names, outputs = pack_directory(directory / "out")
+                names = [f"out/{name}" for name in names]
+                result = {"status": "ok", "outputs": names, "seconds": seconds}
+        except JobTimeout as e:
+            result, outputs = {"status": "timeout", "error": str(e)}, []
+        except Cancelled as e:
+            result, outputs = {"status": "error", "error": f"cancelled: {e}"}, []
+        except JobFailed as e:
+            result, outputs = {"status": "error", "error": str(e)}, []
+        except Exception as e:
+            # Not a failed conversion but an error on the node, which would
+            # happen again on a retry
+            logger.exception(e)
+            result, outputs = {"status": "error", "error": repr(e), "retry": False}, []
+        finally:
+            logging.getLogger().removeHandler(handler)
+        self.send({"type": "result", "job": job, "log": handler.records} | result, outputs)
+
+
+def unpack(directory: Path, names: list[str], blobs: list[bytes]):
+    for name, blob in zip(names, blobs):
+        relative = PurePosixPath(name)
+        if relative.is_absolute() or ".." in relative.parts:
+            raise ProtocolError(f"Refusing to write input file {name}")
+        path = directory.joinpath(*relative.parts)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(blob)
+    (directory.parent / "out").mkdir(exist_ok=True)
+
+
+def substitute(value, directory: str):
+    if isinstance(value, dict):
+        return {k: substitute(v, directory) for k, v in value.items()}
+    if isinstance(value, list):
+        return [substitute(item, directory) for item in value]
+    if isinstance(value, str) and value.startswith(JOB_DIR):
+        return directory + value[len(JOB_DIR) :]
+    return value
+
+
+def serve(
+    address: tuple[str, int],
+    paths: dict[str, Path],
+    policy: ConcurrencyPolicy,
+    blender_pool: BlenderPool | None = None,
+):
+    name = f"{socket.gethostname()}:{os.getpid()}"
+    while True:
+        try:
+            sock = socket.create_connection(address)
+        except OSError as e:
+            logger.warning(f"Cannot reach coordinator {address[0]}:{address[1]}: {e}")
+            time.sleep(RECONNECT_DELAY)
+            continue
+        logger.info(f"Connected to coordinator {address[0]}:{address[1]} as {name}")
+        if Session(sock, paths, policy, blender_pool).serve(name):
+            logger.info("Coordinator finished, exiting")
+            return
+        time.sleep(RECONNECT_DELAY)
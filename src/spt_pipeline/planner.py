@@ -0,0 +1,158 @@
+#
+# Copyright (c) 2024 Rafał Kuźnia <rafal.kuznia@protonmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+import heapq
+import json
+import logging
+import os
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+
+from spt_pipeline.dsl import Car2GLTF, Foreach, GetFiles, GodotRun, Track2GLTF
+
+logger = logging.getLogger(__name__)
+
+MiB = 1024 * 1024
+
+# Seconds per MiB of input used until the history has samples of a kind
+DEFAULT_RATES = {
+    "Track2GLTF": 6.0,
+    "Car2GLTF": 15.0,
+}
+DEFAULT_COST = 1.0
+SMOOTHING = 0.5
+COSTED_ACTIONS = (Track2GLTF, Car2GLTF, GodotRun)
+
+
+def input_size(path: Path) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.stat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def variant_count(action) -> int:
+    return 1 + len(getattr(action, "variants", []))
+
+
+def history_key(path) -> str:
+    return str(path) if isinstance(path, Path) else ""
+
+
+class CostModel:
+    def __init__(self, path: Path):
+        self.path = path
+        self.history: dict[str, dict[str, dict[str, float]]] = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.history = dict(json.load(f))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable timing history {self.path}: {e}")
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.lock:
+            temp = self.path.with_suffix(".tmp")
+            with open(temp, "w", encoding="utf-8") as f:
+                json.dump(self.history, f, indent=1, sort_keys=True)
+            os.replace(temp, self.path)
+
+    def _rate(self, kind: str) -> float:
+        samples = [s for s in self.history.get(kind, {}).values() if s.get("size")]
+        size = sum(s["size"] for s in samples)
+        if size:
+            return sum(s["seconds"] / s["variants"] for s in samples) / (size / MiB)
+        return DEFAULT_RATES.get(kind, 0.0)
+
+    def predict(self, action, path) -> float:
+        if not isinstance(action, COSTED_ACTIONS):
+            return 0.0
+        kind = type(action).__name__
+        key = history_key(path)
+        with self.lock:
+            sample = self.history.get(kind, {}).get(key)
+            if sample:
+                return sample["seconds"] * variant_count(action) / sample["variants"]
+            rate = self._rate(kind)
+        if isinstance(path, Path) and rate:
+            return rate * variant_count(action) * input_size(path) / MiB
+        return DEFAULT_COST
+
+    def predict_chain(self, actions, path) -> float:
+        return sum(self.predict(action, path) for action in actions)
+
+    def record(self, action, path, seconds: float):
+        kind = type(action).__name__
+        size = input_size(path) if isinstance(path, Path) else 0
+        with self.lock:
+            samples = self.history.setdefault(kind, {})
+            previous = samples.get(history_key(path))
+            if previous and previous["variants"] == variant_count(action):
+                seconds = SMOOTHING * seconds + (1 - SMOOTHING) * previous["seconds"]
+            samples[history_key(path)] = {
+                "seconds": seconds,
+                "size": size,
+                "variants": variant_count(action),
+            }
+
+
+@dataclass
+class PlannedJob:
+    action: str
+    path: Path | str
+    seconds: float
+
+
+def makespan(durations: list[float], workers: int) -> float:
+    # List scheduling in the given order onto the least loaded worker
+    loads = [0.0] * max(1, workers)
+    for duration in durations:
+        heapq.heapreplace(loads, loads[0] + duration)
+    return max(loads)
+
+
+class Planner:
+    def __init__(self, processor, cost_model: CostModel):
+        self.processor = processor
+        self.cost_model = cost_model
+
+    def expand(self, actions, path=None) -> list[PlannedJob]:
+        jobs = []
+        for action in actions:
+            if isinstance(action, GetFiles):
+                path = self.processor._with_ctx(action, path=path)
+            elif isinstance(action, Foreach):
+                for item in path:
+                    jobs += self.expand(action.actions, item)
+            elif isinstance(action, COSTED_ACTIONS):
+                seconds = self.cost_model.predict(action, path)
+                shown = path if isinstance(path, Path) else ""
+                jobs.append(PlannedJob(type(action).__name__, shown, seconds))
+        return jobs
+
+    def report(self, actions, workers: int) -> str:
+        jobs = self.expand(actions, self.processor.path)
+        ordered = sorted(jobs, key=lambda job: -job.seconds)
+        total = sum(job.seconds for job in jobs)
+        lines = [f"{len(jobs)} jobs, {total:.0f}s of work on {workers} workers"]
+        for job in ordered:
+            lines.append(f"  {job.seconds:9.1f}s {job.action:<12} {job.path}")
+        lines.append(
+            f"Expected makespan {makespan([j.seconds for j in ordered], workers):.0f}s"
+            f" longest first, {makespan([j.seconds for j in jobs], workers):.0f}s in scan order"
+        )
+        return "\n".join(lines)
@@ -4,36 +4,181 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 #
 
+import json
 import logging
 import os
-import subprocess
-from concurrent.futures import ThreadPoolExecutor
-from contextlib import AbstractContextManager, chdir, suppress
-from functools import singledispatchmethod
+import time
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from contextlib import AbstractContextManager, contextmanager, suppress
+from dataclasses import asdict
+from functools import partial, singledispatchmethod
 from pathlib import Path
-import sys
+from typing import Iterator
 
+from spt_pipeline.artifacts import ArtifactStore
+from spt_pipeline.assets import (
+    AssetError,
+    DuplicateSet,
+    fingerprint,
+    link,
+    unshare,
+)
+from spt_pipeline.blender_pool import BlenderPool
+from spt_pipeline.cache import BuildCache
+from spt_pipeline.cancel import get_cancel_scope
+from spt_pipeline.changes import ChangeSet
+from spt_pipeline.concurrency import ConcurrencyPolicy, MiB, ProcessMonitor
+from spt_pipeline.distributed import Coordinator
 from spt_pipeline.dsl import (
     Car2GLTF,
     Foreach,
     GetFiles,
     GodotPostprocess,
     GodotRun,
+    OptimizeGLB,
     Track2GLTF,
 )
-from spt_pipeline.utils import RESOURCE_DIR, run_blender, run_godot, get_path_case_insensitive
+from spt_pipeline.events import (
+    DONE,
+    FAILED,
+    PROGRESS,
+    QUEUED,
+    RUNNING,
+    UP_TO_DATE,
+    get_events,
+)
+from spt_pipeline.glb import ALREADY_OPTIMISED, optimize_file, read_document
+from spt_pipeline.index import DirectoryIndex
+from spt_pipeline.metrics import get_metrics
+from spt_pipeline.planner import CostModel
+from spt_pipeline.retry import RetryPolicy, job_errors
+from spt_pipeline.scheduler import Job, Scheduler
+from spt_pipeline.tracing import get_tracer
+from spt_pipeline.utils import CACHE_DIR, RESOURCE_DIR, run_blender, run_godot
+from spt_pipeline.watch import ForeachItems
 
 logger = logging.getLogger(__name__)
 
+BARRIER_ACTIONS = (GodotRun,)
+SCRIPT_KINDS = {"track2gltf": "track", "car2gltf": "car"}
+# Paths passed to one Godot process, well below the 32 KiB Windows limit
+BATCH_ARG_CHARS = 24000
+MANIFEST_VERSION = 1
+
+
+def project_imported(directory: Path) -> bool:
+    return (directory / ".godot").is_dir()
+
+
+def project_root(script: Path, default: Path) -> Path:
+    for parent in script.parents:
+        if (parent / "project.godot").is_file():
+            return parent
+    return default
+
+
+def split_batched(actions: list) -> tuple[list, list]:
+    # Trailing GodotPostprocess actions of a Foreach run once for all items
+    split = len(actions)
+    while split and isinstance(actions[split - 1], GodotPostprocess):
+        split -= 1
+    return actions[:split], actions[split:]
+
+
+def batches(files: list[Path], count: int, limit: int = BATCH_ARG_CHARS) -> list[list[Path]]:
+    # Up to count batches of similar size, split further if the command line
+    # would get too long
+    if not files:
+        return []
+    size = -(-len(files) // max(1, count))
+    result = []
+    for start in range(0, len(files), size):
+        batch: list[Path] = []
+        length = 0
+        for file in files[start : start + size]:
+            if batch and length + len(str(file)) > limit:
+                result.append(batch)
+                batch, length = [], 0
+            batch.append(file)
+            length += len(str(file)) + 1
+        result.append(batch)
+    return result
+
+
+# track2gltf.py writes the chunks of an export into NAME.chunks. The names in
+# it do not depend on NAME, so that the index stays valid when the directory is
+# linked for a duplicate.
+def chunk_directory(output: Path) -> Path:
+    return output.with_name(f"{output.stem}.chunks")
+
+
+def chunk_paths(output: Path, chunks: int) -> list[Path]:
+    return [chunk_directory(output) / f"{index:03}{output.suffix}" for index in range(chunks)]
+
+
+def manifest_path(output: Path) -> Path:
+    return chunk_directory(output) / "index.json"
+
+
+def write_manifest(manifest: Path, chunks: list[Path]):
+    # Index of a chunked track for the engine to stream from. The bounds come
+    # from the scene extras that track2gltf.py stores in each chunk.
+    entries = []
+    for chunk in chunks:
+        scenes = read_document(chunk).get("scenes") or [{}]
+        bounds = scenes[0].get("extras", {}).get("spt_chunk", {})
+        entries.append({"file": chunk.name, "min": bounds.get("min"), "max": bounds.get("max")})
+    document = {"version": MANIFEST_VERSION, "chunks": entries}
+    manifest.write_text(json.dumps(document, indent=2) + "\n", encoding="utf-8")
+
+
+def run_inline(fn, *args) -> Future:
+    future: Future = Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
 
 class PipelineProcessor(AbstractContextManager):
-    def __init__(self, source, destination, path=None, paths: dict[str, Path] = {}, executor=None):
+    def __init__(
+        self,
+        source,
+        destination,
+        path=None,
+        paths: dict[str, Path] = {},
+        executor=None,
+        blender_pool: BlenderPool | Coordinator | None = None,
+        build_cache: BuildCache | None = None,
+        artifacts: ArtifactStore | None = None,
+        scheduler: Scheduler | None = None,
+        policy: ConcurrencyPolicy | None = None,
+        index: DirectoryIndex | None = None,
+        cost_model: CostModel | None = None,
+        retry: RetryPolicy | None = None,
+        process_pool: Executor | None = None,
+        changes: ChangeSet | None = None,
+        duplicates: DuplicateSet | None = None,
+        items: ForeachItems | None = None,
+    ):
         self.source = source
         self.destination = destination
         self.path = path
         self.paths: dict[str, Path] = paths
-        max_workers = 1 if sys.platform == "win32" else 6
-        self.executor = executor if executor else ThreadPoolExecutor(max_workers=max_workers)
+        self.policy = policy if policy else ConcurrencyPolicy()
+        self.executor = executor if executor else ThreadPoolExecutor(self.policy.workers)
+        self.scheduler = scheduler if scheduler else Scheduler(self.executor, policy=self.policy)
+        self.index = index if index else DirectoryIndex(source)
+        self.cost_model = cost_model
+        self.retry = retry if retry else RetryPolicy()
+        self.process_pool = process_pool
+        self.changes = changes if changes else ChangeSet()
+        self.duplicates = duplicates if duplicates else DuplicateSet()
+        self.items = items if items else ForeachItems()
+        self.blender_pool = blender_pool
+        self.build_cache = build_cache
+        self.artifacts = artifacts
 
     def __enter__(self):
         return self
@@ -43,120 +188,512 @@ class PipelineProcessor(AbstractContextManager):
 
     def _with_ctx(self, action, **kwargs):
         path = kwargs.get("path", None)
-        with PipelineProcessor(
-            source=self.source,
-            destination=self.destination,
-            path=path,
-            paths=self.paths,
-            executor=self.executor,
-        ) as local:
-            return local.run_action(action)
-
-    def format(self, string) -> str:
-        filename = self.path.name.lower() if isinstance(self.path, Path) else None
+        job = self.scheduler.current_job()
+        queued = job.queued if job else None
+        item = path if isinstance(path, Path) else ""
+        with get_tracer().span(type(action).__name__, "action", queued=queued, path=item):
+            with PipelineProcessor(
+                source=self.source,
+                destination=self.destination,
+                path=path,
+                paths=self.paths,
+                executor=self.executor,
+                blender_pool=self.blender_pool,
+                build_cache=self.build_cache,
+                artifacts=self.artifacts,
+                scheduler=self.scheduler,
+                policy=self.policy,
+                index=self.index,
+                cost_model=self.cost_model,
+                retry=self.retry,
+                process_pool=self.process_pool,
+                changes=self.changes,
+                duplicates=self.duplicates,
+                items=self.items,
+            ) as local:
+                return local.run_action(action)
+
+    def format(self, string, path=None, **extra) -> str:
+        path = self.path if path is None else path
+        filename = path.name.lower() if isinstance(path, Path) else None
         f = {
             "_source": self.source,
             "_destination": self.destination,
             "_filename": filename,
-            "_path": self.path,
+            "_path": path,
         }
-        return string.format(**f)
+        return string.format(**f, **extra)
 
-    def format_path(self, string) -> Path:
-        return Path(self.format(string))
+    def format_path(self, string, path=None) -> Path:
+        return Path(self.format(string, path))
 
-    def spawn_blender(self, args):
-        try:
-            run_blender(args, self.paths)
-            return True
-        except subprocess.CalledProcessError:
-            return False
+    def spawn_blender(self, script, timeout=None, **kwargs) -> float | None:
+        # Returns the seconds Blender spent on the successful attempt, or None
+        # when every attempt failed
+        timeout = self.retry.timeout(SCRIPT_KINDS[script], timeout)
+        seconds = []
+        if not self.retry.call(
+            lambda: seconds.append(self.run_blender(script, timeout, **kwargs)), script, self.path
+        ):
+            return None
+        return seconds[-1]
+
+    def run_blender(self, script, timeout=None, **kwargs) -> float:
+        # Returns the seconds the conversion itself took, without the time
+        # spent waiting for a slot, a pool worker or a build node
+        if isinstance(self.blender_pool, Coordinator):
+            # Build nodes apply their own concurrency limits
+            get_events().emit(self.path, RUNNING, action=script)
+            return self.blender_pool.run(
+                script, on_progress=self.report_progress, timeout=timeout, **kwargs
+            )
+        with self.slot(SCRIPT_KINDS[script]) as monitor:
+            get_events().emit(self.path, RUNNING, action=script)
+            if self.blender_pool:
+                return self.blender_pool.run(
+                    script,
+                    on_progress=self.report_progress,
+                    timeout=timeout,
+                    monitor=monitor,
+                    **kwargs,
+                )
+            start = time.monotonic()
+            self._spawn_blender(script, monitor, timeout, **kwargs)
+            return time.monotonic() - start
+
+    @contextmanager
+    def slot(self, kind: str) -> Iterator[ProcessMonitor]:
+        # Jobs the scheduler ran with a kind already hold their slot. Build
+        # nodes run conversions outside of a scheduler and wait for one here.
+        job = self.scheduler.current_job()
+        if job and job.slot:
+            yield job.slot.monitor
+            return
+        with self.policy.slot(kind) as monitor:
+            yield monitor
+
+    def report_progress(self, done, total):
+        logger.info(f"{self.path}: step {done} of {total} done")
+        get_events().emit(self.path, PROGRESS, done=done, total=total)
+
+    def _spawn_blender(self, script, monitor, timeout, **kwargs):
+        args = ["--background", "--python", RESOURCE_DIR / f"{script}.py", "--"]
+        for key, value in kwargs.items():
+            if value is True:
+                args.append(f"--{key}")
+            elif isinstance(value, list):
+                for item in value:
+                    args += [f"--{key}", json.dumps(item)]
+            elif value is not False:
+                args += [f"--{key}", str(value)]
+        with job_errors():
+            run_blender(
+                args,
+                self.paths,
+                on_spawn=monitor.watch,
+                on_progress=self.report_progress,
+                timeout=timeout,
+            )
 
     @singledispatchmethod
     def run_action(self, action) -> str:
         raise NotImplementedError(f"Action {action} not implemented")
 
+    def convert(self, action, script, manifests={}, **kwargs):
+        # Manifests map to the chunks they index
+        outputs = self.destinations(action, self.path)
+        destination = outputs[0]
+        script_path = RESOURCE_DIR / f"{script}.py"
+        # The timeout does not change the output
+        params = {k: v for k, v in asdict(action).items() if k != "timeout"}
+        key = None
+        if self.build_cache:
+            key = self.build_cache.key(script_path, self.path, params)
+            if self.build_cache.is_fresh(outputs, key):
+                logger.info(f"{destination} is up to date")
+                get_events().emit(self.path, UP_TO_DATE, action=type(action).__name__)
+                return outputs + self.link_duplicates(action, outputs)
+        artifact = None
+        if self.artifacts:
+            artifact = self.artifacts.key(script_path, self.path, params)
+            if self.artifacts.fetch(artifact, outputs):
+                logger.info(f"Fetched {destination} from the artifact store")
+                if self.build_cache and key:
+                    self.build_cache.record(outputs, key)
+                self.changes.add(outputs)
+                return outputs + self.link_duplicates(action, outputs)
+        logger.info(f"Converting {self.path} into {destination}")
+        for output in outputs:
+            with suppress(FileExistsError):
+                os.makedirs(output.parent)
+            # Blender writes in place, an output still linked to the output of
+            # a former duplicate (see link_duplicates) or to the artifact store
+            # must not change it too
+            if output.exists() and output.stat().st_nlink > 1:
+                output.unlink()
+        kind = None if isinstance(self.blender_pool, Coordinator) else SCRIPT_KINDS[script]
+
+        def run():
+            seconds = self.spawn_blender(script, timeout=action.timeout, input=self.path, **kwargs)
+            if seconds is None:
+                logger.error(f"Failed to convert {self.path}")
+                get_events().emit(self.path, FAILED, action=type(action).__name__)
+                self.scheduler.mark_failed()
+                if self.build_cache:
+                    self.build_cache.forget(outputs)
+                return None
+            for manifest, chunks in manifests.items():
+                write_manifest(manifest, chunks)
+            logger.info(f"Successfuly converted {self.path}")
+            if self.cost_model:
+                self.cost_model.record(action, self.path, seconds)
+            if self.build_cache and key:
+                self.build_cache.record(outputs, key)
+            if self.artifacts and artifact:
+                self.artifacts.publish(artifact, outputs)
+            self.changes.add(outputs)
+            metrics = get_metrics()
+            if metrics.enabled:
+                glbs = [output for output in outputs if output.suffix == ".glb"]
+                written = sum(glb.stat().st_size for glb in glbs if glb.exists())
+                metrics.add("spt_glb_bytes_written_total", written, action=type(action).__name__)
+            return outputs + self.link_duplicates(action, outputs)
+
+        # Queued until the concurrency policy has a slot for it, see Scheduler.
+        # Named after the script, the action job that returns it is counted
+        # separately in the job metrics.
+        return self.scheduler.add(run, kind=kind, name=script)
+
+    def exports(self, action, path) -> list[Path]:
+        # The GLB of the track or car and those of the track variants
+        variants = action.variants if isinstance(action, Track2GLTF) else []
+        return [self.format_path(action.destination, path)] + [
+            self.format_path(variant.destination, path) for variant in variants
+        ]
+
+    def destinations(self, action, path) -> list[Path]:
+        # What convert() writes for the asset in path, in the same order
+        exports = self.exports(action, path)
+        chunks = action.chunks if isinstance(action, Track2GLTF) else 0
+        if chunks <= 1:
+            return exports
+        return [chunk for export in exports for chunk in chunk_paths(export, chunks)] + [
+            manifest_path(export) for export in exports
+        ]
+
+    def link_duplicates(self, action, outputs: list[Path]) -> list[Path]:
+        linked = []
+        written = []
+        for duplicate in self.duplicates.of(self.path):
+            for output, destination in zip(outputs, self.destinations(action, duplicate)):
+                if link(output, destination):
+                    written.append(destination)
+                linked.append(destination)
+        if written:
+            logger.info(f"Linked {len(written)} outputs of {self.path} for its duplicates")
+            self.changes.add(written)
+        return linked
+
     @run_action.register
     def _(self, action: Track2GLTF):
         logger.debug(action)
-        destination = self.format_path(action.destination)
-        logger.info(f"Converting track {self.path} into {destination}")
-        with suppress(FileExistsError):
-            os.makedirs(destination.parent)
-        args = [
-            "--background",
-            "--python",
-            RESOURCE_DIR / "track2gltf.py",
-            "--",
-            "--input",
-            self.path,
-            "--output",
-            destination,
+        destination, *outputs = self.exports(action, self.path)
+        track = {"night": action.night, "weather": action.weather}
+        variants = [
+            {"output": str(output), "night": variant.night, "weather": variant.weather}
+            for output, variant in zip(outputs, action.variants)
         ]
-        if action.night:
-            args.append("--night")
-        if action.weather:
-            args.append("--weather")
-        if self.spawn_blender(args):
-            logger.info(f"Successfuly converted {self.path}")
-        else:
-            logger.error(f"Failed to convert {self.path}")
+        if action.chunks <= 1:
+            return self.convert(
+                action, "track2gltf", output=destination, variants=variants, **track
+            )
+        # Each export goes into the directory of its chunks, see chunk_paths
+        for variant in variants:
+            variant["output"] = str(chunk_directory(Path(variant["output"])))
+        manifests = {
+            manifest_path(export): chunk_paths(export, action.chunks)
+            for export in [destination, *outputs]
+        }
+        return self.convert(
+            action,
+            "track2gltf",
+            manifests,
+            output=chunk_directory(destination),
+            variants=variants,
+            chunks=action.chunks,
+            **track,
+        )
 
     @run_action.register
     def _(self, action: Car2GLTF):
         logger.debug(action)
-        destination = self.format_path(action.destination)
-        logger.info(f"Converting car {self.path} into {destination}")
-        with suppress(FileExistsError):
-            os.makedirs(destination.parent)
-        args = [
-            "--background",
-            "--python",
-            RESOURCE_DIR / "car2gltf.py",
-            "--",
-            "--input",
-            self.path,
-            "--output",
-            destination,
-        ]
-        if self.spawn_blender(args):
-            logger.info(f"Successfuly converted {self.path}")
-        else:
-            logger.error(f"Failed to convert {self.path}")
+        return self.convert(action, "car2gltf", output=self.format_path(action.destination))
 
     @run_action.register
     def _(self, action: Foreach):
         logger.debug(action)
-        return list(
-            self.executor.map(lambda x: self.run_actions_int(action.actions, path=x), self.path)
-        )
+        paths = self.path
+        if self.cost_model and isinstance(paths, list):
+            # Longest chains are queued first to keep the tail of the run short
+            costs = {path: self.cost_model.predict_chain(action.actions, path) for path in paths}
+            paths = sorted(paths, key=lambda path: -costs[path])
+        return self.schedule_foreach(action, paths)
+
+    def schedule_foreach(self, action: Foreach, paths) -> Job:
+        actions, batched = split_batched(action.actions)
+        # A streaming GetFiles is consumed here, each item starts as it is found
+        ends = []
+        for path in paths:
+            for item in [path] + self.duplicates.of(path):
+                self.items.add(item, action)
+            ends.append(self.schedule_item(actions, path))
+        join = self.scheduler.add(lambda *results: list(results), deps=ends, name="Join")
+        for postprocess in batched:
+            join = self.scheduler.add(
+                partial(self.postprocess, postprocess), deps=[join], name="GodotPostprocess"
+            )
+        return join
 
     @run_action.register
     def _(self, action: GetFiles):
         logger.debug(f"{action} p={self.path}")
+        matches = self.scan(action)
+        if action.dedupe:
+            return self.dedupe(list(matches))
+        files = (path.parent for path in matches)
+        return files if action.stream else list(files)
+
+    def scan(self, action: GetFiles) -> Iterator[Path]:
+        # One match per directory
         match = self.format(action.match)
         directory = Path(self.format(action.directory))
-        directory = get_path_case_insensitive(self.source, directory)
-        files = list({p.parent for p in directory.rglob(match, case_sensitive=False)})
-        if action.required and not files:
+        directory = self.index.resolve(directory)
+        scope = get_cancel_scope()
+        found: set[Path] = set()
+        for path in self.index.glob(directory, match):
+            scope.check()
+            if path.parent not in found:
+                found.add(path.parent)
+                yield path
+        if action.required and not found:
             raise FileNotFoundError(f"No files found in {directory}")
-        elif not files:
+        elif not found:
             logger.warning(f"No files found in {directory}")
-        return files
+
+    def dedupe(self, matches: list[Path]) -> list[Path]:
+        # Returns the directories to convert. Fingerprinting is I/O bound and
+        # hashlib releases the GIL, so the matches are read in parallel.
+        scope = get_cancel_scope()
+        pool = ThreadPoolExecutor(self.policy.workers)
+        try:
+            futures = [pool.submit(fingerprint, path) for path in matches]
+            originals: dict[str, Path] = {}
+            for path, future in zip(matches, futures):
+                scope.check()
+                try:
+                    key = future.result()
+                except (AssetError, OSError) as e:
+                    self.retry.fail("GetFiles", path, f"rejected, {e}")
+                    get_events().emit(path.parent, FAILED, action="GetFiles")
+                    continue
+                original = originals.setdefault(key, path.parent)
+                if original != path.parent:
+                    logger.info(f"{path.parent} is a duplicate of {original}")
+                    self.duplicates.add(original, path.parent)
+        finally:
+            pool.shutdown(cancel_futures=True)
+        return list(originals.values())
+
+    @run_action.register
+    def _(self, action: OptimizeGLB):
+        # Runs on the GLBs returned by the conversion before it in the chain
+        logger.debug(action)
+        if not self.path:
+            return self.path
+        paths = self.path if isinstance(self.path, list) else [self.path]
+        # Chunked tracks also return their manifests
+        paths = [path for path in paths if Path(path).suffix == ".glb"]
+        submit = self.process_pool.submit if self.process_pool else run_inline
+        futures = [submit(optimize_file, path, action.quantize, action.strip) for path in paths]
+        for path, future in zip(paths, futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                self.retry.fail("OptimizeGLB", path, str(e))
+                continue
+            if result.skipped:
+                level = logging.DEBUG if result.skipped == ALREADY_OPTIMISED else logging.INFO
+                logger.log(level, f"Not optimising {path}: {result.skipped}")
+                continue
+            logger.info(
+                f"Optimised {path}: {result.size_before / MiB:.1f} MiB ->"
+                f" {result.size_after / MiB:.1f} MiB, merged {result.views_merged} buffer"
+                f" views and {result.accessors_merged} accessors, quantised"
+                f" {result.attributes_quantized} attributes"
+            )
+            get_metrics().add(
+                "spt_glb_bytes_written_total", result.size_after, action="OptimizeGLB"
+            )
+            if self.build_cache:
+                self.build_cache.refresh([path])
+            self.changes.add([path])
+        return self.path
 
     @run_action.register
     def _(self, action: GodotPostprocess):
+        # Outside the tail of a Foreach the batch is just this item
         logger.debug(action)
+        job = self.postprocess(action, [self.path])
+        return self.scheduler.add(lambda results: results[0], deps=[job], name="Batches")
+
+    def postprocess(self, action: GodotPostprocess, results: list) -> Job:
+        # Each result is what the action before GodotPostprocess returned for
+        # one item. The GLBs written in this run are grouped by script and each
+        # group goes to as few headless Godot processes as the godot limit
+        # allows, so Godot starts once per batch rather than once per file.
+        groups: dict[Path, list[Path]] = {}
+        for result in results:
+            if not result:
+                continue
+            files = result if isinstance(result, list) else [result]
+            script = self.format_path(action.script, result)
+            groups.setdefault(script, []).extend(
+                f for f in files if f in self.changes and Path(f).suffix == ".glb"
+            )
+        jobs = []
+        for script, files in groups.items():
+            if not files:
+                logger.info(f"Nothing to postprocess with {script}")
+            for batch in batches(files, self.policy.limits["godot"]):
+                jobs.append(
+                    self.scheduler.add(
+                        partial(self.run_postprocess, action, script, batch),
+                        name="postprocess",
+                        kind="godot",
+                    )
+                )
+        return self.scheduler.add(lambda *_: results, deps=jobs, name="Batches")
+
+    def run_postprocess(self, action: GodotPostprocess, script: Path, files: list[Path]):
+        directory = project_root(script, self.destination)
+        args = ["--headless", "--script", str(script), "--"] + [str(file) for file in files]
+        timeout = self.retry.timeout("postprocess", action.timeout)
+        if timeout:
+            timeout *= len(files)
+
+        def run():
+            # The script may rewrite the GLBs in place, which must not reach
+            # the duplicates or the artifact store they are linked to
+            for file in files:
+                unshare(file)
+            with self.slot("godot") as monitor, job_errors():
+                run_godot(args, self.paths, cwd=directory, on_spawn=monitor.watch, timeout=timeout)
+
+        logger.info(f"Postprocessing {len(files)} files with {script}")
+        with get_tracer().span("GodotPostprocess", "batch", files=len(files)) as span:
+            ok = self.retry.call(run, "GodotPostprocess", script)
+            span["status"] = "ok" if ok else "failed"
+        if self.build_cache and ok:
+            self.build_cache.refresh(files)
+        elif self.build_cache:
+            # Converted again next time, so that the postprocess is retried
+            self.build_cache.forget(files)
+        if not ok:
+            self.scheduler.mark_failed()
 
     @run_action.register
     def _(self, action: GodotRun):
-        directory = self.format(action.workdir)
-        with chdir(directory):
-            run_godot(action.args, self.paths)
+        directory = self.format_path(action.workdir)
+        changed = self.changes.under(directory)
+        if action.only_changed and not changed and project_imported(directory):
+            logger.info(f"Nothing changed in {directory}, skipping Godot")
+            return
+        changes_file = directory / CACHE_DIR / "changes.txt"
+        self.changes.write(changes_file, directory)
+        logger.info(f"Running Godot in {directory}, {len(changed)} changed files")
+        args = [self.format(arg, _changes=changes_file) for arg in action.args]
+        timeout = self.retry.timeout("godot", action.timeout)
+
+        seconds = 0.0
+
+        def attempt():
+            nonlocal seconds
+            with self.slot("godot") as monitor, job_errors():
+                start = time.monotonic()
+                run_godot(args, self.paths, cwd=directory, on_spawn=monitor.watch, timeout=timeout)
+                seconds = time.monotonic() - start
+
+        def run():
+            events = get_events()
+            events.emit(directory, RUNNING, action="GodotRun")
+            if not self.retry.call(attempt, "GodotRun", directory):
+                events.emit(directory, FAILED, action="GodotRun")
+                self.scheduler.mark_failed()
+                return
+            events.emit(directory, DONE, action="GodotRun")
+            if self.cost_model:
+                self.cost_model.record(action, self.path, seconds)
+
+        # Queued until the policy has a godot slot for it, see Scheduler
+        return self.scheduler.add(run, kind="godot", name="godot")
+
+    def schedule_item(self, actions, item) -> Job:
+        events = get_events()
+        end = self.schedule_actions(actions, self.scheduler.value(item))
+        if not events.listeners:
+            return end
+        events.emit(item, QUEUED)
+
+        def finished(result):
+            events.emit(item, DONE)
+            return result
+
+        return self.scheduler.add(finished, deps=[end], name="Item")
+
+    def schedule_action(self, action, deps: list[Job]) -> Job:
+        return self.scheduler.add(
+            lambda path, *_: self._with_ctx(action, path=path),
+            deps=deps,
+            name=type(action).__name__,
+        )
+
+    def schedule_actions(self, actions, input: Job) -> Job:
+        # Each action consumes the result of the previous one, except GetFiles,
+        # which starts an independent chain from the sequence input. Barrier
+        # actions wait for everything scheduled before them in the sequence.
+        jobs: list[Job] = []
+        previous = barrier = input
+        for action in actions:
+            if isinstance(action, BARRIER_ACTIONS):
+                job = self.schedule_action(action, list(dict.fromkeys([previous, input] + jobs)))
+                barrier = job
+            elif isinstance(action, GetFiles):
+                job = self.schedule_action(action, [input, barrier])
+            else:
+                job = self.schedule_action(action, [previous])
+            jobs.append(job)
+            previous = job
+        last = previous
+        return self.scheduler.add(lambda *_: last.result, deps=jobs, name="Sequence")
 
-    def run_actions_int(self, actions, path):
+    def rerun(self, items: list[Path], actions):
+        # Watch mode: the Foreach chains of the changed items, then the GodotRun
+        # actions of the pipeline, which only see the files written now. An
+        # item that was deduplicated no longer shares its outputs.
+        self.changes = ChangeSet()
+        groups: dict[int, tuple[Foreach, dict[Path, None]]] = {}
+        for item in items:
+            action = self.items.action(item)
+            members = groups.setdefault(id(action), (action, {}))[1]
+            members.update(dict.fromkeys(self.duplicates.detach(item)))
+        deps = [self.schedule_foreach(action, list(paths)) for action, paths in groups.values()]
+        deps.insert(0, self.scheduler.value(self.path))
         for action in actions:
-            path = self._with_ctx(action, path=path)
+            if isinstance(action, GodotRun):
+                deps = [self.schedule_action(action, deps)]
+        self.scheduler.wait()
 
     def run_actions(self, actions):
-        self.run_actions_int(actions, self.path)
+        end = self.schedule_actions(actions, self.scheduler.value(self.path))
+        self.scheduler.wait()
+        return end.result
@@ -10,28 +10,47 @@ from itertools import dropwhile
 
 import bpy
 
-try:
-    argv = list(dropwhile(lambda x: x != "--", sys.argv))
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-i", "--input")
-    parser.add_argument("-o", "--output")
-    args = parser.parse_args(argv[1:])
+
+def setup():
+    # Once per Blender process
     bpy.ops.wm.read_factory_settings(use_empty=True)
     # bpy.ops.preferences.addon_enable(module="io_nfs4_import")
     bpy.ops.preferences.addon_enable(module="bl_ext.user_default.speedtools")
     bpy.ops.preferences.addon_enable(module="io_scene_gltf2")
+
+
+def reset():
+    # Between conversions in the same process. Only the scene data goes, the
+    # preferences and the enabled addons stay.
+    bpy.ops.wm.read_homefile(use_empty=True)
+
+
+def convert(input, output):
     bpy.ops.import_scene.nfs4car(
-        directory=args.input,
+        directory=input,
         import_lights=True,
         import_audio=True,
         import_interior=True,
     )
+    print("SPT-PROGRESS 1/2", flush=True)
     bpy.ops.export_scene.gltf(
-        filepath=args.output,
+        filepath=output,
         export_attributes=True,
         export_extras=True,
         export_lights=True,
         export_cameras=True,
     )
-except:
-    exit(1)
+    print("SPT-PROGRESS 2/2", flush=True)
+
+
+if __name__ == "__main__":
+    try:
+        argv = list(dropwhile(lambda x: x != "--", sys.argv))
+        parser = argparse.ArgumentParser()
+        parser.add_argument("-i", "--input")
+        parser.add_argument("-o", "--output")
+        args = parser.parse_args(argv[1:])
+        setup()
+        convert(args.input, args.output)
+    except:
+        exit(1)
@@ -5,35 +5,109 @@
 #
 
 import argparse
+import json
+import os
 import sys
 from itertools import dropwhile
 
 import bpy
 
-try:
-    argv = list(dropwhile(lambda x: x != "--", sys.argv))
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-i", "--input")
-    parser.add_argument("-o", "--output")
-    parser.add_argument("-n", "--night", type=bool, default=False)
-    parser.add_argument("-w", "--weather", type=bool, default=False)
-    args = parser.parse_args(argv[1:])
+
+def setup():
+    # Once per Blender process
     bpy.ops.wm.read_factory_settings(use_empty=True)
     # bpy.ops.preferences.addon_enable(module="io_nfs4_import")
     bpy.ops.preferences.addon_enable(module="bl_ext.user_default.speedtools")
     bpy.ops.preferences.addon_enable(module="io_scene_gltf2")
+
+
+def reset():
+    # Between conversions in the same process. Only the scene data goes, the
+    # preferences and the enabled addons stay.
+    bpy.ops.wm.read_homefile(use_empty=True)
+
+
+def convert(input, output, night=False, weather=False, variants=(), chunks=1):
+    # All variants are exported from this Blender session. The importer bakes
+    # the night/weather lighting into the scene, so the track is re-imported
+    # into a clean scene for each variant.
+    exports = [{"output": output, "night": night, "weather": weather}, *variants]
+    for index, variant in enumerate(exports):
+        if index:
+            reset()
+        export_variant(input, chunks=int(chunks), **variant)
+        print(f"SPT-PROGRESS {index + 1}/{len(exports)}", flush=True)
+
+
+def split_chunks(chunks):
+    # The importer does not record which FRD block an object came from, so the
+    # meshes are split into strips of equal object count along the longer
+    # horizontal axis of the track. Everything else (cameras, lights, sound
+    # sources) goes with the first chunk. Returns the objects of each chunk.
+    from mathutils import Vector
+
+    objects = list(bpy.context.scene.objects)
+    centres = {
+        o.name: sum((o.matrix_world @ Vector(corner) for corner in o.bound_box), Vector()) / 8
+        for o in objects
+        if o.type == "MESH"
+    }
+    split = [[o for o in objects if o.name not in centres]] + [[] for _ in range(chunks - 1)]
+    if centres:
+        extent = [
+            max(c[axis] for c in centres.values()) - min(c[axis] for c in centres.values())
+            for axis in (0, 1)
+        ]
+        axis = 0 if extent[0] >= extent[1] else 1
+        meshes = sorted(
+            (o for o in objects if o.name in centres), key=lambda o: centres[o.name][axis]
+        )
+        size = -(-len(meshes) // chunks)
+        for chunk in range(chunks):
+            split[chunk] += meshes[chunk * size : (chunk + 1) * size]
+    return split
+
+
+def select_chunk(selected, chunk, chunks):
+    from mathutils import Vector
+
+    for o in bpy.context.scene.objects:
+        o.select_set(o in selected)
+    corners = [o.matrix_world @ Vector(corner) for o in selected for corner in o.bound_box]
+    bounds = {"index": chunk, "count": chunks}
+    if corners:
+        bounds["min"] = [min(c[i] for c in corners) for i in range(3)]
+        bounds["max"] = [max(c[i] for c in corners) for i in range(3)]
+    # Exported as scene extras, the pipeline collects them into the manifest
+    bpy.context.scene["spt_chunk"] = bounds
+
+
+def export_variant(input, output, night=False, weather=False, chunks=1):
     bpy.ops.import_scene.nfs4trk(
-        directory=args.input,
+        directory=input,
         import_shading=True,
         import_collision=True,
         import_cameras=True,
         import_ambient=True,
         import_audio=True,
-        night=args.night,
-        weather=args.weather,
+        night=night,
+        weather=weather,
     )
+    if chunks <= 1:
+        export_gltf(output)
+        return
+    # The track is imported once and every chunk is exported from it, into the
+    # output directory under the names processor.chunk_paths expects
+    os.makedirs(output, exist_ok=True)
+    for chunk, selected in enumerate(split_chunks(chunks)):
+        select_chunk(selected, chunk, chunks)
+        export_gltf(os.path.join(output, f"{chunk:03}.glb"), use_selection=True)
+
+
+def export_gltf(output, use_selection=False):
     bpy.ops.export_scene.gltf(
-        filepath=args.output,
+        filepath=output,
+        use_selection=use_selection,
         export_attributes=True,
         export_cameras=True,
         export_extras=True,
@@ -43,5 +117,27 @@ try:
         export_unused_images=True,
         export_apply=True,
     )
-except:
-    exit(1)
+
+
+if __name__ == "__main__":
+    try:
+        argv = list(dropwhile(lambda x: x != "--", sys.argv))
+        parser = argparse.ArgumentParser()
+        parser.add_argument("-i", "--input")
+        parser.add_argument("-o", "--output")
+        parser.add_argument("-n", "--night", action="store_true")
+        parser.add_argument("-w", "--weather", action="store_true")
+        parser.add_argument("--variants", action="append", type=json.loads, default=[])
+        parser.add_argument("--chunks", type=int, default=1)
+        args = parser.parse_args(argv[1:])
+        setup()
+        convert(
+            args.input,
+            args.output,
+            night=args.night,
+            weather=args.weather,
+            variants=args.variants,
+            chunks=args.chunks,
+        )
+    except:
+        exit(1)
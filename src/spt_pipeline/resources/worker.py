@@ -0,0 +1,49 @@
+#
+# Copyright (c) 2024 Rafał Kuźnia <rafal.kuznia@protonmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+# Long-lived Blender worker. Reads one JSON request per line from stdin and
+# runs the `convert` entry point of the requested resource script. Replies are
+# written to stdout prefixed with REPLY_PREFIX, so that they can be told apart
+# from whatever Blender and the addons print on their own.
+
+import importlib
+import json
+import sys
+import traceback
+from pathlib import Path
+
+REPLY_PREFIX = "@spt-worker "
+SCRIPTS = {"car2gltf", "track2gltf"}
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+
+def reply(**kwargs):
+    sys.stdout.write(REPLY_PREFIX + json.dumps(kwargs) + "\n")
+    sys.stdout.flush()
+
+
+def serve():
+    modules = {name: importlib.import_module(name) for name in SCRIPTS}
+    # The scripts enable the same addons, preferences are set up once and
+    # only the scene is reset between jobs
+    for module in modules.values():
+        module.setup()
+    reply(status="ready")
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+            module = modules[request["script"]]
+            module.reset()
+            module.convert(**request["args"])
+            reply(status="ok")
+        except Exception:
+            reply(status="error", error=traceback.format_exc())
+
+
+serve()
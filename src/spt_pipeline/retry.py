@@ -0,0 +1,124 @@
+#
+# Copyright (c) 2024 Rafał Kuźnia <rafal.kuznia@protonmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+import logging
+import subprocess
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Iterator
+
+from spt_pipeline.cancel import get_cancel_scope
+
+logger = logging.getLogger(__name__)
+
+# Seconds a single Blender/Godot run may take before its process group is
+# killed. A kind mapped to None (or 0 on the command line) has no limit.
+DEFAULT_TIMEOUTS: dict[str, float | None] = {
+    "track": 3600,
+    "car": 900,
+    "godot": 3600,
+    "postprocess": 300,
+}
+DEFAULT_RETRIES = 1
+RETRY_BACKOFF = 2.0
+
+
+class JobFailed(Exception):
+    pass
+
+
+# A failure that would happen again on every attempt, e.g. an error in the
+# pipeline itself rather than in the conversion. It is not retried.
+class JobBroken(JobFailed):
+    pass
+
+
+class JobTimeout(JobFailed):
+    def __init__(self, timeout: float):
+        super().__init__(f"timed out after {timeout:.0f}s")
+        self.timeout = timeout
+
+
+@contextmanager
+def job_errors() -> Iterator[None]:
+    try:
+        yield
+    except subprocess.TimeoutExpired as e:
+        raise JobTimeout(e.timeout) from e
+    except subprocess.CalledProcessError as e:
+        raise JobFailed(f"exit code {e.returncode}") from e
+
+
+@dataclass
+class Failure:
+    action: str
+    item: str
+    reason: str
+    attempts: int
+
+
+class RetryPolicy:
+    def __init__(
+        self,
+        retries: int = DEFAULT_RETRIES,
+        timeouts: dict[str, float | None] = {},
+        backoff: float = RETRY_BACKOFF,
+    ):
+        self.retries = retries
+        self.timeouts = DEFAULT_TIMEOUTS | timeouts
+        self.backoff = backoff
+        self.failures: list[Failure] = []
+        self.lock = threading.Lock()
+
+    def timeout(self, kind: str, override: float | None = None) -> float | None:
+        timeout = override if override is not None else self.timeouts.get(kind)
+        return timeout or None
+
+    def call(self, fn: Callable[[], None], action: str, item) -> bool:
+        # Crashes are retried with exponential backoff. Timeouts and broken
+        # jobs are not, a hang on a malformed asset would most likely just
+        # happen again. A job killed because the run was cancelled raises
+        # Cancelled instead.
+        scope = get_cancel_scope()
+        attempt = 1
+        while True:
+            scope.check()
+            try:
+                fn()
+                return True
+            except JobFailed as e:
+                scope.check()
+                reason = str(e)
+                if not isinstance(e, (JobTimeout, JobBroken)) and attempt <= self.retries:
+                    delay = self.backoff * 2 ** (attempt - 1)
+                    logger.warning(f"{action} {item} failed ({reason}), retrying in {delay:.1f}s")
+                    scope.sleep(delay)
+                    attempt += 1
+                    continue
+            self.fail(action, item, reason, attempt)
+            return False
+
+    def fail(self, action: str, item, reason: str, attempts: int = 1):
+        logger.error(f"{action} {item} failed: {reason}")
+        with self.lock:
+            self.failures.append(Failure(action, str(item), reason, attempts))
+
+    def clear(self):
+        with self.lock:
+            self.failures = []
+
+    def summary(self) -> str:
+        with self.lock:
+            failures = list(self.failures)
+        lines = [f"{len(failures)} job(s) failed:"]
+        for failure in failures:
+            attempts = "attempt" if failure.attempts == 1 else "attempts"
+            lines.append(
+                f"  {failure.action:<12} {failure.item}: {failure.reason}"
+                f" ({failure.attempts} {attempts})"
+            )
+        return "\n".join(lines)
@@ -0,0 +1,252 @@
+#
+# Copyright (c) 2024 Rafał Kuźnia <rafal.kuznia@protonmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from concurrent.futures import Executor
+from typing import Any, Callable, Iterable
+
+from spt_pipeline.cancel import Cancelled, CancelScope, get_cancel_scope
+from spt_pipeline.concurrency import ConcurrencyPolicy, Slot
+from spt_pipeline.metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    def __init__(
+        self, name: str, fn: Callable[..., Any] | None, deps: list[Job], kind: str | None = None
+    ):
+        self.name = name
+        self.fn = fn
+        self.deps = deps
+        self.kind = kind
+        self.slot: Slot | None = None
+        self.dependents: list[Job] = []
+        self.followers: list[Job] = []
+        self.pending = 0
+        self.done = False
+        # Failed without raising, see Scheduler.mark_failed
+        self.failed = False
+        self.result: Any = None
+        self.exception: BaseException | None = None
+        self.queued: float | None = None
+
+    def __repr__(self) -> str:
+        return f"Job({self.name})"
+
+
+# Runs a dynamically growing graph of jobs on a single executor. A job runs
+# once all of its dependencies have finished and is called with their results.
+# A job may return another job, in which case it finishes together with that
+# job. This lets a job expand into a subgraph (e.g. one chain per Foreach item)
+# without blocking an executor thread while the subgraph runs.
+#
+# A job added with a kind (track, car, godot) also waits until the concurrency
+# policy admits it, and holds that slot while it runs. It waits in the
+# scheduler rather than in an executor thread, so that jobs of a kind that is
+# at its limit do not hold up the jobs queued behind them.
+#
+# Like a task group, the first failing job cancels the scope of the run: the
+# running child processes are killed and jobs that have not started yet finish
+# with Cancelled. wait() raises that first failure. Interrupting wait() (e.g.
+# with Ctrl-C) cancels the scope and waits for the running jobs to wind down.
+class Scheduler:
+    def __init__(
+        self,
+        executor: Executor,
+        scope: CancelScope | None = None,
+        policy: ConcurrencyPolicy | None = None,
+    ):
+        self.executor = executor
+        self.scope = scope if scope else get_cancel_scope()
+        self.policy = policy
+        self.waiting: list[Job] = []
+        self.lock = threading.Lock()
+        self.finished = threading.Condition(self.lock)
+        self.active = 0
+        self.errors: list[BaseException] = []
+        self.local = threading.local()
+
+    def value(self, value: Any, name: str = "value") -> Job:
+        job = Job(name, None, [])
+        job.done = True
+        job.result = value
+        return job
+
+    def add(
+        self,
+        fn: Callable[..., Any],
+        deps: Iterable[Job] = (),
+        name: str = "",
+        kind: str | None = None,
+    ) -> Job:
+        job = Job(name, fn, list(deps), kind)
+        get_metrics().add("spt_jobs_queued", job=name)
+        with self.lock:
+            self.active += 1
+            for dep in job.deps:
+                if not dep.done:
+                    dep.dependents.append(job)
+                    job.pending += 1
+            ready = job.pending == 0
+        if ready:
+            self._submit(job)
+        return job
+
+    def _submit(self, job: Job):
+        job.queued = time.perf_counter()
+        if job.kind and self.policy:
+            with self.lock:
+                self.waiting.append(job)
+            self._admit()
+            return
+        self.executor.submit(self._run, job)
+
+    def _admit(self):
+        # Submits the waiting jobs the policy has a slot for, in the order they
+        # became ready. A job that is going to be cancelled needs no slot.
+        assert self.policy
+        admitted = []
+        with self.lock:
+            for job in list(self.waiting):
+                if not self.scope.cancelled and all(dep.exception is None for dep in job.deps):
+                    job.slot = self.policy.acquire(job.kind)
+                    if job.slot is None:
+                        continue
+                self.waiting.remove(job)
+                admitted.append(job)
+        for job in admitted:
+            self.executor.submit(self._run, job)
+
+    def current_job(self) -> Job | None:
+        return getattr(self.local, "job", None)
+
+    def mark_failed(self):
+        # For a job that handles its own failure, e.g. a conversion whose
+        # failure RetryPolicy records while the run goes on. It finishes as
+        # usual but counts as failed in the metrics.
+        job = self.current_job()
+        if job:
+            job.failed = True
+
+    def _count(self, job: Job):
+        status = "failed" if job.failed else "done"
+        get_metrics().add("spt_jobs_total", job=job.name, status=status)
+
+    def _run(self, job: Job):
+        self.local.job = job
+        try:
+            self._run_job(job)
+        finally:
+            self.local.job = None
+            if job.slot and self.policy:
+                self.policy.release(job.slot)
+                job.slot = None
+            if self.waiting:
+                self._admit()
+
+    def _run_job(self, job: Job):
+        metrics = get_metrics()
+        metrics.add("spt_jobs_queued", -1, job=job.name)
+        failed = next((dep for dep in job.deps if dep.exception is not None), None)
+        if failed is not None:
+            metrics.add("spt_jobs_total", job=job.name, status="cancelled")
+            self._finish(job, exception=failed.exception, origin=False)
+            return
+        if self.scope.cancelled:
+            metrics.add("spt_jobs_total", job=job.name, status="cancelled")
+            self._finish(job, exception=Cancelled(self.scope.reason), origin=False)
+            return
+        start = time.perf_counter()
+        try:
+            assert job.fn
+            with metrics.inflight("spt_jobs_running", job=job.name):
+                result = job.fn(*[dep.result for dep in job.deps])
+        except BaseException as e:
+            status = "cancelled" if isinstance(e, Cancelled) else "failed"
+            metrics.add("spt_jobs_total", job=job.name, status=status)
+            metrics.observe("spt_job_duration_seconds", time.perf_counter() - start, job=job.name)
+            logger.debug(f"{job} failed: {e!r}")
+            if not isinstance(e, Cancelled) and not self.scope.cancelled:
+                logger.warning(f"{job.name} failed, cancelling the remaining jobs")
+                self.scope.cancel(f"{job.name} failed")
+            self._finish(job, exception=e)
+            return
+        metrics.observe("spt_job_duration_seconds", time.perf_counter() - start, job=job.name)
+        if isinstance(result, Job):
+            # Counted once that job has finished, with its status
+            with self.lock:
+                if not result.done:
+                    result.followers.append(job)
+                    return
+            self._follow(job, result)
+            return
+        self._count(job)
+        self._finish(job, result)
+
+    def _follow(self, job: Job, result: Job):
+        job.failed = result.failed
+        if result.exception is None:
+            self._count(job)
+        else:
+            status = "cancelled" if isinstance(result.exception, Cancelled) else "failed"
+            get_metrics().add("spt_jobs_total", job=job.name, status=status)
+        self._finish(job, result.result, result.exception, origin=False)
+
+    def _finish(
+        self,
+        job: Job,
+        result: Any = None,
+        exception: BaseException | None = None,
+        origin: bool = True,
+    ):
+        ready = []
+        with self.lock:
+            job.done = True
+            job.result = result
+            job.exception = exception
+            if exception is not None and origin:
+                self.errors.append(exception)
+            for dependent in job.dependents:
+                dependent.pending -= 1
+                if dependent.pending == 0:
+                    ready.append(dependent)
+            followers = job.followers
+            job.dependents = []
+            job.followers = []
+            self.active -= 1
+            self.finished.notify_all()
+        for follower in followers:
+            self._follow(follower, job)
+        for dependent in ready:
+            self._submit(dependent)
+
+    def _drain(self):
+        with self.lock:
+            while self.active:
+                self.finished.wait()
+
+    def wait(self):
+        try:
+            self._drain()
+        except BaseException:
+            self.scope.cancel("interrupted")
+            if self.waiting:
+                self._admit()
+            self._drain()
+            raise
+        with self.lock:
+            errors = self.errors
+            self.errors = []
+        failures = [e for e in errors if not isinstance(e, Cancelled)]
+        if failures:
+            raise failures[0]
+        if errors or self.scope.cancelled:
+            raise Cancelled(self.scope.reason)
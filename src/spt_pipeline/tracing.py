@@ -0,0 +1,142 @@
+#
+# Copyright (c) 2024 Rafał Kuźnia <rafal.kuznia@protonmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Iterator
+
+
+@dataclass
+class Span:
+    name: str
+    category: str
+    start: float
+    end: float = 0.0
+    queued: float | None = None
+    thread: int = 0
+    thread_name: str = ""
+    args: dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class Tracer:
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.spans: list[Span] = []
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+
+    @contextmanager
+    def span(
+        self, name: str, category: str, queued: float | None = None, **args
+    ) -> Iterator[dict[str, Any]]:
+        if not self.enabled:
+            yield args
+            return
+        thread = threading.current_thread()
+        span = Span(
+            name=name,
+            category=category,
+            start=time.perf_counter(),
+            queued=queued,
+            thread=thread.ident or 0,
+            thread_name=thread.name,
+            args=args,
+        )
+        try:
+            yield span.args
+        except BaseException as e:
+            span.args["error"] = repr(e)
+            raise
+        finally:
+            span.end = time.perf_counter()
+            with self.lock:
+                self.spans.append(span)
+
+    def _us(self, timestamp: float) -> float:
+        return round((timestamp - self.origin) * 1e6, 1)
+
+    def chrome_events(self) -> list[dict[str, Any]]:
+        pid = os.getpid()
+        events: list[dict[str, Any]] = []
+        threads: dict[int, str] = {}
+        with self.lock:
+            spans = list(self.spans)
+        for span in spans:
+            threads[span.thread] = span.thread_name
+            args = {
+                k: v if isinstance(v, (int, float, bool)) else str(v) for k, v in span.args.items()
+            }
+            if span.queued is not None:
+                args["queue_wait_ms"] = round((span.start - span.queued) * 1e3, 3)
+            events.append(
+                {
+                    "name": span.name,
+                    "cat": span.category,
+                    "ph": "X",
+                    "ts": self._us(span.start),
+                    "dur": round(span.duration * 1e6, 1),
+                    "pid": pid,
+                    "tid": span.thread,
+                    "args": args,
+                }
+            )
+        for tid, name in threads.items():
+            events.append(
+                {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+            )
+        return events
+
+    def export_chrome(self, path: Path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": self.chrome_events(), "displayTimeUnit": "ms"}, f)
+
+    def summary(self, workers: int, top: int = 10) -> str:
+        with self.lock:
+            actions = [span for span in self.spans if span.category == "action"]
+        if not actions:
+            return "No actions were traced"
+        wall = max(span.end for span in actions) - min(span.start for span in actions)
+        busy = sum(span.duration for span in actions)
+        waits = [span.start - span.queued for span in actions if span.queued is not None]
+        per_type: dict[str, list[float]] = defaultdict(list)
+        for span in actions:
+            per_type[span.name].append(span.duration)
+
+        lines = [f"Wall time {wall:.2f}s, pool utilisation {busy / (workers * wall or 1):.0%}"]
+        if waits:
+            lines.append(f"Queue wait: mean {sum(waits) / len(waits):.2f}s, max {max(waits):.2f}s")
+        lines.append("Per action:")
+        for name, durations in sorted(per_type.items(), key=lambda x: -sum(x[1])):
+            lines.append(
+                f"  {name:<18} {len(durations):>5}x total {sum(durations):9.2f}s"
+                f" mean {sum(durations) / len(durations):7.2f}s"
+            )
+        lines.append(f"Slowest {top}:")
+        for span in sorted(actions, key=lambda s: -s.duration)[:top]:
+            lines.append(f"  {span.duration:9.2f}s {span.name:<18} {span.args.get('path', '')}")
+        return "\n".join(lines)
+
+
+_tracer = Tracer(enabled=False)
+
+
+def get_tracer() -> Tracer:
+    return _tracer
+
+
+def set_tracer(tracer: Tracer):
+    global _tracer
+    _tracer = tracer
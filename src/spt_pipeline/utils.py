@@ -1,11 +1,21 @@
+import errno
+import json
+import logging
 import os
+import re
+import signal
 import subprocess
 import sys
+import threading
+from collections import deque
+from functools import partial
 from pathlib import Path
-import json
-import logging
 from typing import Sequence, TypeVar
-import errno
+
+from spt_pipeline.cancel import get_cancel_scope
+from spt_pipeline.concurrency import ProcessMonitor
+from spt_pipeline.metrics import get_metrics
+from spt_pipeline.tracing import get_tracer
 
 logger = logging.getLogger(__name__)
 
@@ -15,6 +25,7 @@ Ty = TypeVar("Ty")
 
 
 RESOURCE_DIR = Path(__file__).parent / "resources"
+CACHE_DIR = Path(".spt-cache")
 ADDON_URL = "https://github.com/e-rk/speedtools/releases/download/v{speedtools}/speedtools-{speedtools}.zip"
 
 SPEEDTOOLS_PATH = "speedtools-{speedtools}.zip"
@@ -30,6 +41,24 @@ else:
     BLENDER_PATH = Path("blender")
     FFMPEG_PATH = Path("ffmpeg")
 
+
+def user_cache_dir() -> Path:
+    # Per-user cache for data that does not belong to one destination
+    if os.name == "nt":
+        base = Path(os.environ.get("LOCALAPPDATA", Path.home() / "AppData" / "Local"))
+    elif sys.platform == "darwin":
+        base = Path.home() / "Library" / "Caches"
+    else:
+        base = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"))
+    return base / "spt-pipeline"
+
+
+OUTPUT_TAIL_LINES = 200
+MAX_LINE_LENGTH = 64 * 1024
+# Resource scripts report progress by printing e.g. "SPT-PROGRESS 2/4"
+PROGRESS_PATTERN = re.compile(r"^SPT-PROGRESS (?P<done>\d+)/(?P<total>\d+)")
+ERROR_PATTERN = re.compile(r"^(error|traceback|exception)\b", re.IGNORECASE)
+
 DEFAULT_MANIFEST = {
     "speedtools": "0.26.0",
     "blender": "5.0.1",
@@ -37,7 +66,7 @@ DEFAULT_MANIFEST = {
 }
 
 
-def run_process(args: list, env={}) -> subprocess.CompletedProcess[bytes]:
+def process_env(env={}) -> dict[str, str]:
     this_env = dict(os.environ)  # make a copy of the environment
     if sys.platform == "linux":
         lp_key = "LD_LIBRARY_PATH"  # for GNU/Linux and *BSD.
@@ -48,8 +77,127 @@ def run_process(args: list, env={}) -> subprocess.CompletedProcess[bytes]:
             # This happens when LD_LIBRARY_PATH was not set.
             # Remove the env var as a last resort:
             this_env.pop(lp_key, None)
-    run_env = this_env | env
-    return subprocess.run(args, check=True, capture_output=True, env=run_env)
+    return this_env | env
+
+
+# Children get their own process group, so that whatever they spawn is killed
+# together with them when a job times out
+if os.name == "nt":
+    PROCESS_GROUP = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+else:
+    PROCESS_GROUP = {"start_new_session": True}
+
+
+def kill_process_tree(process: subprocess.Popen):
+    if process.poll() is not None:
+        return
+    if os.name == "nt":
+        subprocess.run(
+            ["taskkill", "/F", "/T", "/PID", str(process.pid)],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+    else:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    process.kill()
+
+
+def _read_stream(stream, name: str, tail: deque[str], on_line):
+    for raw in iter(lambda: stream.readline(MAX_LINE_LENGTH), b""):
+        line = raw.decode("utf-8", errors="replace").rstrip("\r\n")
+        tail.append(line)
+        if on_line:
+            on_line(name, line)
+
+
+def run_process(
+    args: list, env={}, cwd=None, on_spawn=None, on_line=None, timeout=None
+) -> subprocess.CompletedProcess[bytes]:
+    # Output is consumed while the process runs. Only the last OUTPUT_TAIL_LINES
+    # lines of each stream are kept for the returned result and error reports.
+    tails: dict[str, deque[str]] = {
+        "stdout": deque(maxlen=OUTPUT_TAIL_LINES),
+        "stderr": deque(maxlen=OUTPUT_TAIL_LINES),
+    }
+    tracer = get_tracer()
+    monitor = ProcessMonitor()
+    scope = get_cancel_scope()
+    scope.check()
+    with (
+        tracer.span(Path(args[0]).name, "process", command=" ".join(map(str, args))) as span,
+        subprocess.Popen(
+            args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=process_env(env),
+            cwd=cwd,
+            **PROCESS_GROUP,
+        ) as process,
+        scope.guard(partial(kill_process_tree, process)),
+        get_metrics().inflight("spt_processes_running", program=Path(args[0]).stem),
+    ):
+        span["pid"] = process.pid
+        if tracer.enabled:
+            monitor.watch(process)
+        if on_spawn:
+            on_spawn(process)
+        readers = [
+            threading.Thread(
+                target=_read_stream,
+                args=(getattr(process, name), name, tail, on_line),
+                daemon=True,
+            )
+            for name, tail in tails.items()
+        ]
+        timed_out = False
+        try:
+            for reader in readers:
+                reader.start()
+            try:
+                retcode = process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                timed_out = True
+                kill_process_tree(process)
+                retcode = process.wait()
+            for reader in readers:
+                reader.join()
+        except:
+            kill_process_tree(process)
+            raise
+        monitor.join()
+        span["exit_code"] = retcode
+        span["timed_out"] = timed_out
+        if monitor.peak:
+            span["peak_rss"] = monitor.peak
+    stdout, stderr = ("\n".join(tail).encode("utf-8") for tail in tails.values())
+    if retcode:
+        # Killed because the run was cancelled
+        scope.check()
+    if timed_out:
+        raise subprocess.TimeoutExpired(args, timeout, output=stdout, stderr=stderr)
+    if retcode:
+        raise subprocess.CalledProcessError(retcode, args, output=stdout, stderr=stderr)
+    return subprocess.CompletedProcess(args, retcode, stdout, stderr)
+
+
+def parse_progress(line: str) -> tuple[int, int] | None:
+    match = PROGRESS_PATTERN.match(line)
+    if match:
+        return int(match["done"]), int(match["total"])
+    return None
+
+
+def log_line(line: str, on_progress=None):
+    progress = parse_progress(line)
+    if progress:
+        if on_progress:
+            on_progress(*progress)
+        return
+    level = logging.WARNING if ERROR_PATTERN.match(line) else logging.DEBUG
+    logger.log(level, line)
 
 
 def format_paths(manifest: dict[str, str]) -> dict[str, Path]:
@@ -91,40 +239,52 @@ def run_winget(id: str, version: str):
         raise
 
 
-def run_log(args: list, env={}):
+def run_log(args: list, env={}, cwd=None, on_spawn=None, on_progress=None, timeout=None):
     try:
-        result = run_process(args, env)
-        stdout = result.stdout.decode("utf-8")
-        if stdout:
-            logger.debug(stdout)
-        stderr = result.stderr.decode("utf-8")
-        if stderr:
-            logger.debug(stderr)
-    except subprocess.CalledProcessError as e:
+        run_process(
+            args,
+            env,
+            cwd,
+            on_spawn,
+            on_line=lambda _, line: log_line(line, on_progress),
+            timeout=timeout,
+        )
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
         logger.error(f"Blender args: {args}")
-        logger.error("Blender failed")
-        stdout = e.stdout.decode("utf-8")
+        if isinstance(e, subprocess.TimeoutExpired):
+            logger.error(f"Timed out after {timeout}s, process group killed")
+        else:
+            logger.error("Blender failed")
+        stdout = (e.stdout or b"").decode("utf-8")
         if stdout:
             logger.error(stdout)
-        stderr = e.stderr.decode("utf-8")
+        stderr = (e.stderr or b"").decode("utf-8")
         if stderr:
             logger.error(stderr)
-            raise
+        raise
 
 
-def run_blender(args: list, paths: dict[str, Path]):
-    this_env = dict(os.environ)
+def blender_env(paths: dict[str, Path]) -> dict[str, str]:
     ffmpeg_dir = paths["ffmpeg"].parent.resolve()
-    path_var = this_env["PATH"]
+    path_var = os.environ["PATH"]
     new_path = f"{ffmpeg_dir}{os.pathsep}{path_var}"
-    new_env = {"PATH": new_path}
+    return {"PATH": new_path}
+
+
+def run_blender(args: list, paths: dict[str, Path], on_spawn=None, on_progress=None, timeout=None):
     blender_exe = paths["blender"]
-    run_log([blender_exe] + args, env=new_env)
+    run_log(
+        [blender_exe] + args,
+        env=blender_env(paths),
+        on_spawn=on_spawn,
+        on_progress=on_progress,
+        timeout=timeout,
+    )
 
 
-def run_godot(args: list, paths: dict[str, Path]):
+def run_godot(args: list, paths: dict[str, Path], cwd=None, on_spawn=None, timeout=None):
     godot_exe = paths["godot"]
-    run_log([godot_exe] + args)
+    run_log([godot_exe] + args, cwd=cwd, on_spawn=on_spawn, timeout=timeout)
 
 
 def list_startswith(a: Sequence[T], b: Sequence[Ty]) -> bool:
@@ -0,0 +1,212 @@
+#
+# Copyright (c) 2024 Rafał Kuźnia <rafal.kuznia@protonmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+# Watch mode. After the first run the processor stays resident (with its
+# Blender workers, build cache and directory index) and the directories of
+# the Foreach items are watched. A burst of saves under an item reruns only
+# that item's Foreach chain, followed by the GodotRun actions of the pipeline.
+
+import logging
+import os
+import struct
+import sys
+import threading
+from pathlib import Path
+from typing import Callable
+
+from spt_pipeline.cancel import CancelScope, get_cancel_scope, set_cancel_scope
+from spt_pipeline.dsl import Foreach
+
+logger = logging.getLogger(__name__)
+
+# Seconds without a new change before a burst of saves is acted on
+DEBOUNCE = 0.5
+POLL_INTERVAL = 1.0
+
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_ISDIR = 0x40000000
+IN_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+# Foreach items seen during the run and the Foreach that processed each
+class ForeachItems:
+    def __init__(self):
+        self.items: dict[Path, Foreach] = {}
+        self.lock = threading.Lock()
+
+    def add(self, item: Path, action: Foreach):
+        with self.lock:
+            self.items[Path(item)] = action
+
+    def directories(self) -> list[Path]:
+        with self.lock:
+            return list(self.items)
+
+    def find(self, path: Path) -> Path | None:
+        # The item that contains path
+        with self.lock:
+            for parent in [path, *path.parents]:
+                if parent in self.items:
+                    return parent
+        return None
+
+    def action(self, item: Path) -> Foreach:
+        with self.lock:
+            return self.items[item]
+
+
+def walk_directories(roots: list[Path]) -> list[Path]:
+    directories = []
+    for root in roots:
+        for current, _, _ in os.walk(root):
+            directories.append(Path(current))
+    return directories
+
+
+class PollingWatcher:
+    def __init__(self, roots: list[Path], interval: float = POLL_INTERVAL):
+        self.roots = roots
+        self.interval = interval
+        self.snapshot = self._snapshot()
+
+    def _snapshot(self) -> dict[Path, tuple[int, int]]:
+        files = {}
+        for directory in walk_directories(self.roots):
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        if entry.is_file():
+                            stat = entry.stat()
+                            files[Path(entry.path)] = (stat.st_mtime_ns, stat.st_size)
+            except FileNotFoundError:
+                continue
+        return files
+
+    def poll(self, timeout: float) -> set[Path]:
+        get_cancel_scope().sleep(max(timeout, self.interval))
+        old, self.snapshot = self.snapshot, self._snapshot()
+        return {
+            path
+            for path in old.keys() | self.snapshot.keys()
+            if old.get(path) != self.snapshot.get(path)
+        }
+
+    def close(self):
+        pass
+
+
+# Linux only, through libc so that no extra dependency is needed
+class InotifyWatcher:
+    def __init__(self, roots: list[Path]):
+        import ctypes
+        import ctypes.util
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.roots = roots
+        self.watches: dict[int, Path] = {}
+        for directory in walk_directories(roots):
+            self._add(directory)
+
+    def _add(self, directory: Path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_MASK)
+        if wd < 0:
+            logger.warning(f"Cannot watch {directory}")
+            return
+        self.watches[wd] = directory
+
+    def poll(self, timeout: float) -> set[Path]:
+        import select
+
+        scope = get_cancel_scope()
+        scope.check()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        scope.check()
+        if not readable:
+            return set()
+        changed = set()
+        data = os.read(self.fd, 65536)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            name = data[offset + INOTIFY_EVENT.size : offset + INOTIFY_EVENT.size + length]
+            offset += INOTIFY_EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, everything may have changed
+                changed.update(self.roots)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            path = directory / os.fsdecode(name.rstrip(b"\0"))
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                for subdirectory in walk_directories([path]):
+                    self._add(subdirectory)
+            changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def open_watcher(roots: list[Path]) -> InotifyWatcher | PollingWatcher:
+    if sys.platform == "linux":
+        try:
+            return InotifyWatcher(roots)
+        except (OSError, AttributeError) as e:
+            logger.warning(f"inotify is not available ({e}), polling for changes instead")
+    return PollingWatcher(roots)
+
+
+def wait_for_changes(watcher: InotifyWatcher | PollingWatcher) -> set[Path]:
+    changed: set[Path] = set()
+    while not changed:
+        changed = watcher.poll(POLL_INTERVAL)
+    while True:
+        more = watcher.poll(DEBOUNCE)
+        if not more:
+            return changed
+        changed |= more
+
+
+def watch(processor, actions: list, on_rerun: Callable[[], None]):
+    # Returns when interrupted with Ctrl-C
+    watcher = open_watcher(processor.items.directories())
+    logger.info(f"Watching {len(processor.items.directories())} items for changes, Ctrl-C stops")
+    try:
+        while True:
+            changed = wait_for_changes(watcher)
+            items = sorted({item for path in changed if (item := processor.items.find(path))})
+            if not items:
+                continue
+            for item in items:
+                logger.info(f"{item} changed")
+            try:
+                processor.rerun(items, actions)
+            except Exception as e:
+                # A failed job cancels the scope of the run, the next rerun
+                # needs a new one
+                logger.error(f"Rerun failed: {e!r}")
+                scope = CancelScope()
+                set_cancel_scope(scope)
+                processor.scheduler.scope = scope
+            if processor.retry.failures:
+                logger.error(processor.retry.summary())
+                processor.retry.clear()
+            on_rerun()
+            logger.info("Watching for changes")
+    except KeyboardInterrupt:
+        logger.info("Stopped watching")
+    finally:
+        watcher.close()
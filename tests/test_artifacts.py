@@ -0,0 +1,111 @@
+#
+# Copyright (c) 2024 Rafał Kuźnia <rafal.kuznia@protonmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+import hashlib
+import os
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from artifact_server import Handler
+from spt_pipeline.artifacts import META, HttpStore, LocalStore
+
+
+def make_key(name: str) -> str:
+    return hashlib.sha256(name.encode()).hexdigest()
+
+
+def outputs(directory, name: str, size: int = 100):
+    directory.mkdir(parents=True, exist_ok=True)
+    paths = [directory / f"{name}.glb", directory / f"{name}.json"]
+    for path in paths:
+        path.write_bytes(name.encode() * (size // len(name)))
+    return paths
+
+
+def age(store: LocalStore, key: str, seconds: float):
+    meta = store.path(key) / META
+    used = meta.stat().st_mtime - seconds
+    os.utime(meta, (used, used))
+
+
+def test_local_store_round_trip(tmp_path):
+    store = LocalStore(tmp_path / "store")
+    key = make_key("a")
+    sources = outputs(tmp_path / "build", "a")
+    targets = [tmp_path / "fetched" / "model.glb", tmp_path / "fetched" / "model.json"]
+    assert not store.fetch(key, targets)
+    store.publish(key, sources)
+    assert store.fetch(key, targets)
+    assert [t.read_bytes() for t in targets] == [s.read_bytes() for s in sources]
+    assert (store.fetched, store.published) == (1, 1)
+
+
+def test_local_store_evicts_least_recently_used(tmp_path):
+    # Room for two artifacts of 200 bytes
+    store = LocalStore(tmp_path / "store", max_size=450)
+    keys = {name: make_key(name) for name in "abc"}
+    store.publish(keys["a"], outputs(tmp_path / "a", "a"))
+    store.publish(keys["b"], outputs(tmp_path / "b", "b"))
+    age(store, keys["a"], 20)
+    age(store, keys["b"], 10)
+    # Fetching a makes b the least recently used
+    assert store.fetch(keys["a"], [tmp_path / "out.glb", tmp_path / "out.json"])
+    store.publish(keys["c"], outputs(tmp_path / "c", "c"))
+    assert (store.path(keys["a"]) / META).exists()
+    assert not store.path(keys["b"]).exists()
+    assert (store.path(keys["c"]) / META).exists()
+    assert not store.fetch(keys["b"], [tmp_path / "b.glb", tmp_path / "b.json"])
+
+
+def test_local_store_rejects_bad_keys(tmp_path):
+    store = LocalStore(tmp_path / "store")
+    with pytest.raises(ValueError):
+        store.path("../" + make_key("a")[3:])
+    with pytest.raises(ValueError):
+        store.file(make_key("a"), "../meta.json")
+
+
+@pytest.fixture
+def server(tmp_path):
+    Handler.store = LocalStore(tmp_path / "server", max_size=450)
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    host, port = httpd.server_address[:2]
+    yield f"http://{host}:{port}"
+    httpd.shutdown()
+    httpd.server_close()
+    thread.join()
+
+
+def test_http_store_round_trip(tmp_path, server):
+    store = HttpStore(server)
+    key = make_key("a")
+    sources = outputs(tmp_path / "build", "a")
+    targets = [tmp_path / "fetched" / "model.glb", tmp_path / "fetched" / "model.json"]
+    assert not store.fetch(key, targets)
+    store.publish(key, sources)
+    assert (Handler.store.path(key) / META).exists()
+    assert store.fetch(key, targets)
+    assert [t.read_bytes() for t in targets] == [s.read_bytes() for s in sources]
+    assert (store.fetched, store.published) == (1, 1)
+    # A different number of outputs is a miss rather than a partial fetch
+    assert not store.fetch(key, targets[:1])
+
+
+def test_http_store_evicts_on_the_server(tmp_path, server):
+    store = HttpStore(server)
+    keys = {name: make_key(name) for name in "abc"}
+    store.publish(keys["a"], outputs(tmp_path / "a", "a"))
+    store.publish(keys["b"], outputs(tmp_path / "b", "b"))
+    age(Handler.store, keys["a"], 20)
+    age(Handler.store, keys["b"], 10)
+    assert store.fetch(keys["a"], [tmp_path / "out.glb", tmp_path / "out.json"])
+    store.publish(keys["c"], outputs(tmp_path / "c", "c"))
+    assert not store.fetch(keys["b"], [tmp_path / "b.glb", tmp_path / "b.json"])
+    assert store.fetch(keys["c"], [tmp_path / "c.glb", tmp_path / "c.json"])
@@ -0,0 +1,130 @@
+#
+# Copyright (c) 2024 Rafał Kuźnia <rafal.kuznia@protonmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+import os
+import socket
+import subprocess
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+from spt_pipeline.distributed import Coordinator, read_message, send_message
+from spt_pipeline.glb import read_document
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+TOOLS_DIR = REPO_DIR / "tools"
+# A build node with the stand-in Blender from tools/, one job at a time
+NODE = """
+import sys
+from pathlib import Path
+from spt_pipeline.concurrency import ConcurrencyPolicy
+from spt_pipeline.node import serve
+tools = Path(sys.argv[3])
+paths = {
+    "blender": tools / "fake_blender.py",
+    "godot": tools / "fake_godot.py",
+    "ffmpeg": Path("ffmpeg"),
+}
+serve((sys.argv[1], int(sys.argv[2])), paths, ConcurrencyPolicy(workers=1))
+"""
+
+
+@pytest.fixture
+def coordinator():
+    with Coordinator(("127.0.0.1", 0)) as coordinator:
+        yield coordinator
+
+
+@pytest.fixture
+def start_node(coordinator):
+    nodes = []
+
+    def start():
+        host, port = coordinator.address
+        env = os.environ | {"PYTHONPATH": str(REPO_DIR / "src")}
+        args = [sys.executable, "-c", NODE, host, str(port), str(TOOLS_DIR)]
+        nodes.append(subprocess.Popen(args, env=env))
+
+    yield start
+    # Closing the coordinator tells the nodes to exit
+    coordinator.close()
+    for node in nodes:
+        try:
+            node.wait(10)
+        except subprocess.TimeoutExpired:
+            node.kill()
+            node.wait()
+            raise
+
+
+def make_input(directory: Path, *names: str) -> Path:
+    directory.mkdir(parents=True)
+    for name in names:
+        (directory / name).write_bytes(name.encode() * 16)
+    return directory
+
+
+def imported(path: Path) -> dict[str, str]:
+    # The stand-in Blender stores the import arguments in the asset extras
+    return read_document(path)["asset"]["extras"]
+
+
+def test_remote_conversion(tmp_path, coordinator, start_node):
+    start_node()
+    car = make_input(tmp_path / "input" / "car", "CAR.VIV", "CARP.TXT")
+    output = tmp_path / "out" / "car.glb"
+    progress = []
+    seconds = coordinator.run(
+        "car2gltf", on_progress=lambda *step: progress.append(step), input=car, output=output
+    )
+    assert seconds > 0
+    assert progress
+    # Paths are rewritten into the job directory on the node
+    assert imported(output)["operator"] == "import_scene.nfs4car"
+    assert imported(output)["directory"] != str(car)
+
+
+def test_remote_chunked_track(tmp_path, coordinator, start_node):
+    start_node()
+    track = make_input(tmp_path / "input" / "track", "TR.FRD", "TR.COL", "TR0.QFS")
+    output = tmp_path / "out" / "track.chunks"
+    night = tmp_path / "out" / "track_night.chunks"
+    variants = [{"output": str(night), "night": True, "weather": False}]
+    coordinator.run("track2gltf", input=track, output=output, chunks=3, variants=variants)
+    for directory, lighting in ((output, "False"), (night, "True")):
+        chunks = sorted(path.name for path in directory.iterdir())
+        assert chunks == ["000.glb", "001.glb", "002.glb"]
+        assert imported(directory / "000.glb")["night"] == lighting
+
+
+def test_lost_node_job_is_reassigned(tmp_path, coordinator, start_node):
+    # A node that takes a job and disconnects without a result
+    lost = socket.create_connection(coordinator.address)
+    send_message(lost, {"type": "hello", "name": "lost", "slots": 1})
+    car = make_input(tmp_path / "input" / "car", "CAR.VIV")
+    output = tmp_path / "out" / "car.glb"
+    result = {}
+
+    def run():
+        try:
+            result["seconds"] = coordinator.run("car2gltf", input=car, output=output)
+        except Exception as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    header, _ = read_message(lost.makefile("rb"))
+    assert (header["type"], header["script"]) == ("job", "car2gltf")
+    assert header["inputs"] == ["CAR.VIV"]
+    lost.close()
+    start_node()
+    thread.join(60)
+    assert not thread.is_alive()
+    assert "error" not in result, result
+    assert output.is_file()
+    assert imported(output)["operator"] == "import_scene.nfs4car"
@@ -0,0 +1,141 @@
+#
+# Copyright (c) 2024 Rafał Kuźnia <rafal.kuznia@protonmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+import math
+import struct
+
+import pytest
+
+from spt_pipeline.glb import optimize_file, parse_glb, write_glb
+
+FLOAT = 5126
+SHORT = 5122
+SIZES = {"SCALAR": 1, "VEC2": 2, "VEC3": 3, "VEC4": 4}
+
+POSITIONS = [(-1.5, 0.25, 3.0), (2.0, -4.0, 3.5), (0.125, 1.0, -2.75), (1.0, 1.0, 1.0)]
+# Identical accessors are merged, so the animated mesh gets its own positions
+MOVED = [(x, y, z + 1.0) for x, y, z in POSITIONS]
+NORMALS = [(0.0, 0.0, 1.0), (0.6, 0.8, 0.0), (-0.48, 0.6, 0.64), (0.0, -1.0, 0.0)]
+# A quarter turn around Z maps (x, y, z) to (-y, x, z)
+QUARTER_TURN = [0.0, 0.0, math.sqrt(0.5), math.sqrt(0.5)]
+
+
+class Builder:
+    def __init__(self):
+        self.document = {
+            "asset": {"version": "2.0"},
+            "accessors": [],
+            "bufferViews": [],
+            "meshes": [],
+            "nodes": [],
+        }
+        self.binary = b""
+
+    def accessor(self, kind: str, values: list[tuple[float, ...]]) -> int:
+        data = b"".join(struct.pack(f"<{len(v)}f", *v) for v in values)
+        views = self.document["bufferViews"]
+        views.append({"buffer": 0, "byteOffset": len(self.binary), "byteLength": len(data)})
+        self.binary += data
+        accessor = {"bufferView": len(views) - 1, "componentType": FLOAT}
+        accessor |= {"count": len(values), "type": kind}
+        if kind == "VEC3":
+            accessor["min"] = [min(v[i] for v in values) for i in range(3)]
+            accessor["max"] = [max(v[i] for v in values) for i in range(3)]
+        self.document["accessors"].append(accessor)
+        return len(self.document["accessors"]) - 1
+
+    def mesh(self, positions: list[tuple[float, ...]], **node) -> int:
+        attributes = {
+            "POSITION": self.accessor("VEC3", positions),
+            "NORMAL": self.accessor("VEC3", NORMALS),
+        }
+        self.document["meshes"].append({"primitives": [{"attributes": attributes}]})
+        self.document["nodes"].append({"mesh": len(self.document["meshes"]) - 1} | node)
+        return len(self.document["nodes"]) - 1
+
+    def write(self, path):
+        self.document["buffers"] = [{"byteLength": len(self.binary)}]
+        write_glb(path, self.document, [self.binary])
+
+
+def read_accessor(document, binary, index: int) -> list[tuple[float, ...]]:
+    accessor = document["accessors"][index]
+    view = document["bufferViews"][accessor["bufferView"]]
+    width = SIZES[accessor["type"]]
+    code, size = {FLOAT: ("f", 4), SHORT: ("h", 2)}[accessor["componentType"]]
+    stride = view.get("byteStride", width * size)
+    start = view.get("byteOffset", 0) + accessor.get("byteOffset", 0)
+    values = [
+        struct.unpack_from(f"<{width}{code}", binary, start + i * stride)
+        for i in range(accessor["count"])
+    ]
+    if accessor.get("normalized"):
+        values = [tuple(max(v / 32767, -1.0) for v in value) for value in values]
+    return values
+
+
+def attributes(document, node: int) -> dict[str, int]:
+    mesh = document["meshes"][document["nodes"][node]["mesh"]]
+    return mesh["primitives"][0]["attributes"]
+
+
+@pytest.fixture
+def optimised(tmp_path):
+    builder = Builder()
+    static = builder.mesh(POSITIONS, translation=[10.0, -2.0, 0.5], rotation=QUARTER_TURN)
+    animated = builder.mesh(MOVED, translation=[1.0, 2.0, 3.0])
+    times = builder.accessor("SCALAR", [(0.0,), (1.0,)])
+    path = builder.accessor("VEC3", [(1.0, 2.0, 3.0), (1.0, 5.0, 3.0)])
+    builder.document["animations"] = [
+        {
+            "channels": [{"sampler": 0, "target": {"node": animated, "path": "translation"}}],
+            "samplers": [{"input": times, "output": path}],
+        }
+    ]
+    glb = tmp_path / "model.glb"
+    builder.write(glb)
+    stats = optimize_file(glb, quantize=True)
+    document, binary = parse_glb(memoryview(glb.read_bytes()))
+    return stats, document, bytes(binary), static, animated
+
+
+def test_quantised_positions_keep_their_place(optimised):
+    stats, document, binary, static, _ = optimised
+    assert stats.attributes_quantized > 0
+    assert "KHR_mesh_quantization" in document["extensionsRequired"]
+    node = document["nodes"][static]
+    position = document["accessors"][attributes(document, static)["POSITION"]]
+    assert position["componentType"] == SHORT
+    assert node["rotation"] == QUARTER_TURN
+    (sx, sy, sz), (tx, ty, tz) = node["scale"], node["translation"]
+    decoded = read_accessor(document, binary, attributes(document, static)["POSITION"])
+    # One quantisation step, half of the largest extent (Z) over 32767
+    tolerance = 3.125 / 32767
+    for (x, y, z), (qx, qy, qz) in zip(POSITIONS, decoded):
+        expected = (10.0 - y, -2.0 + x, 0.5 + z)
+        actual = (tx - sy * qy, ty + sx * qx, tz + sz * qz)
+        assert actual == pytest.approx(expected, abs=tolerance)
+
+
+def test_quantised_normals(optimised):
+    _, document, binary, static, animated = optimised
+    for node in (static, animated):
+        normal = document["accessors"][attributes(document, node)["NORMAL"]]
+        assert normal["componentType"] == SHORT
+        assert normal["normalized"]
+        decoded = read_accessor(document, binary, attributes(document, node)["NORMAL"])
+        for expected, actual in zip(NORMALS, decoded):
+            assert actual == pytest.approx(expected, abs=1e-4)
+
+
+def test_animated_nodes_are_not_folded(optimised):
+    _, document, binary, _, animated = optimised
+    node = document["nodes"][animated]
+    assert node == {"mesh": node["mesh"], "translation": [1.0, 2.0, 3.0]}
+    position = attributes(document, animated)["POSITION"]
+    assert document["accessors"][position]["componentType"] == FLOAT
+    assert read_accessor(document, binary, position) == MOVED
+    assert document["animations"][0]["channels"][0]["target"]["node"] == animated
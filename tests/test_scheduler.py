@@ -0,0 +1,82 @@
+#
+# Copyright (c) 2024 Rafał Kuźnia <rafal.kuznia@protonmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from spt_pipeline.cancel import Cancelled, CancelScope
+from spt_pipeline.scheduler import Scheduler
+
+
+@pytest.fixture
+def scheduler():
+    with ThreadPoolExecutor(4) as executor:
+        yield Scheduler(executor, CancelScope())
+
+
+def test_dependencies_run_first(scheduler):
+    order = []
+    lock = threading.Lock()
+
+    def step(name, value):
+        def fn(*inputs):
+            with lock:
+                order.append(name)
+            return value + sum(inputs)
+
+        return fn
+
+    a = scheduler.add(step("a", 1), name="a")
+    b = scheduler.add(step("b", 10), name="b")
+    c = scheduler.add(step("c", 100), [a, b], name="c")
+    d = scheduler.add(step("d", 1000), [c], name="d")
+    scheduler.wait()
+    assert order.index("c") > max(order.index("a"), order.index("b"))
+    assert order[-1] == "d"
+    assert c.result == 111
+    assert d.result == 1111
+
+
+def test_values_and_returned_jobs(scheduler):
+    def expand(value):
+        return scheduler.add(lambda: value * 2, name="inner")
+
+    outer = scheduler.add(expand, [scheduler.value(21)], name="outer")
+    after = scheduler.add(lambda value: value + 1, [outer], name="after")
+    scheduler.wait()
+    assert outer.result == 42
+    assert after.result == 43
+
+
+def test_first_failure_cancels_the_rest(scheduler):
+    started = threading.Event()
+    ran = []
+
+    def fail():
+        started.wait(5)
+        raise ValueError("broken")
+
+    def slow():
+        started.set()
+        # Woken up by the cancellation rather than by the timeout
+        scheduler.scope.sleep(5)
+        ran.append("slow")
+
+    failing = scheduler.add(fail, name="fail")
+    running = scheduler.add(slow, name="slow")
+    dependent = scheduler.add(lambda _: ran.append("dependent"), [failing], name="dependent")
+    with pytest.raises(ValueError, match="broken"):
+        scheduler.wait()
+    later = scheduler.add(lambda: ran.append("later"), name="later")
+    with pytest.raises(Cancelled):
+        scheduler.wait()
+    assert scheduler.scope.cancelled
+    assert ran == []
+    assert isinstance(running.exception, Cancelled)
+    assert isinstance(dependent.exception, ValueError)
+    assert isinstance(later.exception, Cancelled)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2024 Rafał Kuźnia <rafal.kuznia@protonmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+# Stand-in for a shared artifact store server, for `run --artifacts URL`. It
+# serves a store directory over HTTP. GET returns the files of complete
+# artifacts and marks them as recently used. PUT uploads a file into a staging
+# directory, and the PUT of meta.json publishes the artifact, evicting the
+# least recently used ones when the store is larger than --max-size.
+#
+#   artifact_server.py DIRECTORY [--host HOST] [--port PORT] [--max-size MIB]
+
+import argparse
+import json
+import shutil
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from spt_pipeline.artifacts import DEFAULT_STORE_SIZE, META, LocalStore
+
+MiB = 1024 * 1024
+
+
+class Handler(BaseHTTPRequestHandler):
+    store: LocalStore
+    # Staging directory of each artifact being uploaded
+    uploads: dict[str, Path] = {}
+    lock = threading.Lock()
+
+    def target(self) -> tuple[str, str] | None:
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if len(parts) != 3 or parts[1][:2] != parts[0]:
+            return None
+        try:
+            self.store.file(parts[1], parts[2])
+        except ValueError:
+            return None
+        return parts[1], parts[2]
+
+    def do_GET(self):
+        target = self.target()
+        if not target:
+            self.send_error(404)
+            return
+        key, name = target
+        if name == META:
+            meta = self.store.open(key)
+            if meta is None:
+                self.send_error(404)
+                return
+            self.reply(200, json.dumps(meta).encode("utf-8"))
+            return
+        try:
+            f = open(self.store.file(key, name), "rb")
+        except FileNotFoundError:
+            self.send_error(404)
+            return
+        with f:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(Path(f.name).stat().st_size))
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile)
+
+    def do_PUT(self):
+        target = self.target()
+        if not target:
+            self.send_error(404)
+            return
+        key, name = target
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.lock:
+            staging = self.uploads.get(key)
+            if staging is None:
+                staging = self.uploads[key] = self.store.stage()
+            if name == META:
+                del self.uploads[key]
+        if name != META:
+            (staging / name).write_bytes(data)
+            self.reply(201)
+            return
+        files = json.loads(data)["files"]
+        if not all((staging / file).is_file() for file in files):
+            shutil.rmtree(staging, ignore_errors=True)
+            self.send_error(400, "Artifact files missing")
+            return
+        self.store.commit(key, staging, files)
+        self.reply(201)
+
+    def reply(self, status: int, body: bytes = b""):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", type=Path)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max-size", type=int, default=DEFAULT_STORE_SIZE // MiB)
+    args = parser.parse_args(argv)
+    Handler.store = LocalStore(args.directory, max_size=args.max_size * MiB)
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    host, port = server.server_address[:2]
+    print(f"Serving artifacts from {args.directory} on http://{host}:{port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2024 Rafał Kuźnia <rafal.kuznia@protonmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+# Stand-in for the Blender executable. It accepts the same command line the
+# pipeline uses (`--background --python script.py -- args`), provides a stub
+# `bpy` module and runs the resource script with it. Exporters write a minimal
+# GLB file to the requested path.
+#
+# Environment variables:
+#   FAKE_BLENDER_DELAY   seconds to sleep per import operator call (default 0)
+#   FAKE_BLENDER_LINES   lines printed to stdout per import operator call (default 0)
+#   FAKE_BLENDER_FAIL    substring of an input path that makes the import fail
+#   FAKE_BLENDER_HANG    substring of an input path that makes the import hang,
+#                        with a child process that hangs along with it
+#
+# `--command extension install-file ... FILE.zip` unpacks the extension into
+# $BLENDER_USER_RESOURCES/extensions/user_default when that variable is set.
+
+import json
+import os
+import runpy
+import struct
+import subprocess
+import sys
+import time
+import tomllib
+import types
+import zipfile
+from pathlib import Path
+
+
+def minimal_glb(extras: dict, scene: dict) -> bytes:
+    document = json.dumps(
+        {"asset": {"version": "2.0", "extras": extras}, "scenes": [{"extras": scene}]}
+    ).encode()
+    document += b" " * (-len(document) % 4)
+    length = 12 + 8 + len(document)
+    return (
+        struct.pack("<4sII", b"glTF", 2, length)
+        + struct.pack("<II", len(document), 0x4E4F534A)
+        + document
+    )
+
+
+class Operator:
+    def __init__(self, name: str):
+        self.name = name
+
+    def __getattr__(self, name: str) -> "Operator":
+        return Operator(f"{self.name}.{name}" if self.name else name)
+
+    def __call__(self, **kwargs):
+        category = self.name.split(".")[0]
+        if category == "import_scene":
+            directory = kwargs.get("directory", "")
+            fail = os.environ.get("FAKE_BLENDER_FAIL")
+            if fail and fail in str(directory):
+                raise RuntimeError(f"Import of {directory} failed")
+            hang = os.environ.get("FAKE_BLENDER_HANG")
+            if hang and hang in str(directory):
+                subprocess.Popen([sys.executable, "-c", "import time; time.sleep(3600)"])
+                time.sleep(3600)
+            for i in range(int(os.environ.get("FAKE_BLENDER_LINES", "0"))):
+                print(f"{self.name}: processing {directory} line {i}")
+            time.sleep(float(os.environ.get("FAKE_BLENDER_DELAY", "0")))
+            bpy.context.scene["imported"] = {"operator": self.name, **kwargs}
+        elif category == "export_scene":
+            extras = {k: str(v) for k, v in bpy.context.scene.get("imported", {}).items()}
+            scene = {k: v for k, v in bpy.context.scene.items() if k != "imported"}
+            Path(kwargs["filepath"]).write_bytes(minimal_glb(extras, scene))
+        elif self.name in ("wm.read_factory_settings", "wm.read_homefile"):
+            bpy.context.scene.clear()
+        return {"FINISHED"}
+
+
+# The scene holds no objects, only the custom properties the scripts set
+class Scene(dict):
+    objects: list = []
+
+
+bpy = types.ModuleType("bpy")
+bpy.ops = Operator("")  # type: ignore[attr-defined]
+bpy.context = types.SimpleNamespace(scene=Scene())  # type: ignore[attr-defined]
+mathutils = types.ModuleType("mathutils")
+mathutils.Vector = tuple  # type: ignore[attr-defined]
+
+
+def install_extension(archive: Path):
+    resources = os.environ.get("BLENDER_USER_RESOURCES")
+    if not resources:
+        return
+    with zipfile.ZipFile(archive) as z:
+        manifest = next(name for name in z.namelist() if name.endswith("blender_manifest.toml"))
+        prefix = manifest[: -len("blender_manifest.toml")]
+        extension_id = tomllib.loads(z.read(manifest).decode())["id"]
+        target = Path(resources) / "extensions" / "user_default" / extension_id
+        target.mkdir(parents=True, exist_ok=True)
+        for name in z.namelist():
+            if name.startswith(prefix) and not name.endswith("/"):
+                path = target / name[len(prefix) :]
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_bytes(z.read(name))
+
+
+def main(argv: list[str]) -> int:
+    if "--command" in argv:
+        if "install-file" in argv:
+            install_extension(Path(argv[-1]))
+        return 0
+    args = argv[: argv.index("--")] if "--" in argv else argv
+    if "--python" not in args:
+        print("fake_blender: nothing to do", file=sys.stderr)
+        return 1
+    script = args[args.index("--python") + 1]
+    sys.modules["bpy"] = bpy
+    sys.modules["mathutils"] = mathutils
+    sys.argv = ["blender"] + argv
+    try:
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
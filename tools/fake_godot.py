@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2024 Rafał Kuźnia <rafal.kuznia@protonmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+# Stand-in for the Godot executable. It accepts any command line, prints
+# FAKE_GODOT_LINES lines, sleeps FAKE_GODOT_DELAY seconds and exits with
+# FAKE_GODOT_EXIT (default 0). With --import it creates the .godot directory
+# of the project in the working directory. When FAKE_GODOT_LOG is set, the
+# command line and working directory of every call are appended to that file
+# as a JSON line.
+
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+
+def main(argv: list[str]) -> int:
+    log = os.environ.get("FAKE_GODOT_LOG")
+    if log:
+        with open(log, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"argv": argv, "cwd": os.getcwd()}) + "\n")
+    if "--import" in argv:
+        (Path.cwd() / ".godot" / "imported").mkdir(parents=True, exist_ok=True)
+    for i in range(int(os.environ.get("FAKE_GODOT_LINES", "0"))):
+        print(f"fake_godot: {' '.join(argv)} line {i}")
+    time.sleep(float(os.environ.get("FAKE_GODOT_DELAY", "0")))
+    return int(os.environ.get("FAKE_GODOT_EXIT", "0"))
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))